@@ -0,0 +1,235 @@
+"""main-x.py 재실행 경로 벤치마크.
+
+Streamlit의 AppTest로 앱을 화면 없이 돌리면서, 지침 set 수 · 최근 입력 수 · 결과 길이를
+늘려갈 때 재실행 시간, 설정 불러오기/저장 시간, 메모리가 어떻게 변하는지 잰다.
+LLM 호출은 가짜 백엔드(fake_llm.py)로 대신하므로 네트워크와 비용이 들지 않는다.
+
+    python bench_rerun.py                      # 기본 스윕, 결과 JSON을 표준 출력으로
+    python bench_rerun.py --sets 5,500 --repeats 10 --out bench.json
+    python bench_rerun.py --storage sqlite,json
+
+기준점(sets=5, history=10, output=1000)에서 한 번에 한 축만 늘려가며 잰다.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main-x.py")
+BASELINE = {"sets": 5, "history": 10, "output_chars": 1000}
+INST_KEYS = [
+    "inst_role",
+    "inst_tone",
+    "inst_structure",
+    "inst_depth",
+    "inst_forbidden",
+    "inst_format",
+    "inst_user_intent",
+]
+
+
+def parse_sizes(text: str) -> list:
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def build_config(n_sets: int, n_history: int) -> dict:
+    """지침 set n개와 최근 입력 n개를 가진 config.json 내용."""
+    sets = []
+    for i in range(n_sets):
+        s = {"id": f"set-{i:05d}", "name": f"벤치 지침 {i}"}
+        for key in INST_KEYS:
+            s[key] = f"{key} 지침 {i}: " + "문장은 짧고 간결하게 쓴다. " * 8
+        s["inst_format"] = f"전체 분량은 {500 + i % 10 * 100}자 이상으로 작성한다."
+        sets.append(s)
+    data = {key: sets[0][key] for key in INST_KEYS} if sets else {}
+    data["history"] = [f"벤치 주제 {i}" for i in range(n_history)]
+    data["instruction_sets"] = sets
+    data["active_instruction_set_id"] = sets[0]["id"] if sets else None
+    return data
+
+
+def summarize(samples: list) -> dict:
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def timed_run(at, timeout: float) -> float:
+    started = time.perf_counter()
+    at.run(timeout=timeout)
+    elapsed = time.perf_counter() - started
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return elapsed
+
+
+def run_scenario(storage: str, n_sets: int, n_history: int, output_chars: int,
+                 repeats: int, timeout: float) -> dict:
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+
+    workdir = tempfile.mkdtemp(prefix="scriptking-bench-")
+    previous_cwd = os.getcwd()
+    os.environ["SCRIPTKING_STORAGE"] = storage
+    # 저장소·캐시·클라이언트는 cache_resource라 시나리오마다 비워야 새 경로를 연다.
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    try:
+        os.chdir(workdir)
+        config = build_config(n_sets, n_history)
+        with open("config.json", "w", encoding="utf-8") as f:
+            json.dump(config, f, ensure_ascii=False)
+        config_bytes = os.path.getsize("config.json")
+
+        at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+        # 첫 실행: 설정 불러오기(SQLite는 config.json 이전 포함)가 들어간다.
+        cold = timed_run(at, timeout)
+
+        at.session_state["last_output"] = "가" * output_chars
+        timed_run(at, timeout)
+
+        # 아무 입력 없는 재실행: 매 상호작용마다 드는 고정 비용
+        rerun = []
+        for _ in range(repeats):
+            rerun.append(timed_run(at, timeout))
+        # tracemalloc은 실행을 느리게 하므로 시간 측정과 따로 한 번 더 돌려 최대 할당량만 본다.
+        tracemalloc.start()
+        timed_run(at, timeout)
+        _, rerun_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # 지침 저장: 활성 set의 필드 하나를 바꾸는 상호작용
+        save = []
+        for i in range(repeats):
+            at.text_area(key="inst_tone_edit").input(f"벤치 톤 지침 {i}")
+            at.button(key="save_tone").click()
+            save.append(timed_run(at, timeout))
+
+        # 생성: 가짜 백엔드로 주제 하나를 생성 (스트리밍 포함)
+        generate = []
+        for i in range(repeats):
+            at.text_input(key="current_input").input(f"벤치 생성 {i}")
+            generate.append(timed_run(at, timeout))
+
+        # 설정 불러오기만 따로: 새 세션은 config_loaded가 없어 load_config부터 다시 한다.
+        load = []
+        for _ in range(repeats):
+            fresh = AppTest.from_file(APP_PATH, default_timeout=timeout)
+            load.append(timed_run(fresh, timeout))
+
+        return {
+            "storage": storage,
+            "sets": n_sets,
+            "history": n_history,
+            "output_chars": output_chars,
+            "config_json_bytes": config_bytes,
+            "cold_start_ms": round(cold * 1000, 3),
+            "rerun": summarize(rerun),
+            "rerun_peak_alloc_kb": round(rerun_peak / 1024, 1),
+            "save_set_field": summarize(save),
+            "generate": summarize(generate),
+            "new_session_load": summarize(load),
+        }
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(APP_PATH), text=True, stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def max_rss_kb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser(description="main-x.py 재실행 경로 벤치마크")
+    parser.add_argument("--sets", default="5,50,500", help="지침 set 수 (쉼표 구분)")
+    parser.add_argument("--history", default="10,100,1000", help="최근 입력 수 (쉼표 구분)")
+    parser.add_argument("--output-chars", default="1000,20000,100000", help="결과 글자 수 (쉼표 구분)")
+    parser.add_argument("--storage", default="sqlite", help="저장소 엔진: sqlite,json")
+    parser.add_argument("--repeats", type=int, default=5, help="측정 반복 횟수")
+    parser.add_argument("--timeout", type=float, default=60, help="재실행 한 번의 제한 시간 (초)")
+    parser.add_argument("--out", help="결과 JSON을 저장할 경로 (없으면 표준 출력)")
+    args = parser.parse_args()
+
+    # 벤치마크는 항상 가짜 백엔드로, 지연 없이 돌린다.
+    os.environ["SCRIPTKING_BACKEND"] = "fake"
+    # 측정하는 동안 Prometheus 포트를 열지 않는다 (실행 중인 앱과 포트가 겹치지 않게).
+    os.environ["SCRIPTKING_PROMETHEUS_PORT"] = "0"
+    os.environ.setdefault("SCRIPTKING_FAKE_LATENCY", "0")
+    os.environ.setdefault("SCRIPTKING_FAKE_TOKEN_RATE", "0")
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    logging.disable(logging.WARNING)
+
+    grid = []
+    for storage in args.storage.split(","):
+        points = [dict(BASELINE)]
+        for axis, sizes in (
+            ("sets", parse_sizes(args.sets)),
+            ("history", parse_sizes(args.history)),
+            ("output_chars", parse_sizes(args.output_chars)),
+        ):
+            for size in sizes:
+                point = dict(BASELINE, **{axis: size})
+                if point not in points:
+                    points.append(point)
+        grid += [(storage.strip(), point) for point in points]
+
+    results = []
+    for storage, point in grid:
+        print(f"[bench] {storage} {point}", file=sys.stderr)
+        results.append(run_scenario(
+            storage, point["sets"], point["history"], point["output_chars"],
+            args.repeats, args.timeout,
+        ))
+
+    import streamlit
+
+    report = {
+        "benchmark": "rerun",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "streamlit": streamlit.__version__,
+        "platform": platform.platform(),
+        "repeats": args.repeats,
+        "max_rss_kb": max_rss_kb(),
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
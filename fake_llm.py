@@ -0,0 +1,172 @@
+"""OpenAI 호출 없이 chat.completions.create를 흉내 내는 가짜 백엔드.
+
+부하 테스트·벤치마크용이다. 같은 메시지에는 항상 같은 결과를 돌려주고,
+첫 토큰 지연·초당 토큰 수·오류 주입을 환경변수로 조절한다.
+
+    SCRIPTKING_BACKEND=fake streamlit run main-x.py
+
+    SCRIPTKING_FAKE_LATENCY      첫 토큰까지 지연 (초, 기본 0.3)
+    SCRIPTKING_FAKE_TOKEN_RATE   초당 생성 토큰 수 (기본 80, 0이면 지연 없음)
+    SCRIPTKING_FAKE_ERROR_RATE   요청이 실패할 확률 0~1 (기본 0)
+    SCRIPTKING_FAKE_ERROR_STATUS 주입할 HTTP 상태 코드 (기본 429)
+    SCRIPTKING_FAKE_RETRY_AFTER  429일 때 보낼 Retry-After 초 (기본 1)
+    SCRIPTKING_FAKE_FILL         max_tokens 대비 출력 길이 비율 (기본 0.8, 1 이상이면 잘림)
+"""
+
+import hashlib
+import os
+import random
+import threading
+import time
+import types
+
+import httpx
+import openai
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+API_URL = "https://api.openai.com/v1/chat/completions"
+
+# 한글 내레이션처럼 보이도록 조합하는 조각. 하나가 토큰 하나로 센다.
+WORDS = [
+    "우리는", " 오늘", " 이야기", "를", " 따라", " 걸어", "간다", ".", " 그", " 시절",
+    " 사람들", "은", " 조용히", " 변화", "를", " 맞이", "했다", ",", " 그리고", " 세상",
+    "은", " 다시", " 움직", "이기", " 시작", "했다", ".", "\n\n",
+]
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+class FakeBackendConfig:
+    def __init__(self, latency=None, token_rate=None, error_rate=None, error_status=None,
+                 retry_after=None, fill=None):
+        self.latency = _env_float("SCRIPTKING_FAKE_LATENCY", 0.3) if latency is None else latency
+        self.token_rate = _env_float("SCRIPTKING_FAKE_TOKEN_RATE", 80) if token_rate is None else token_rate
+        self.error_rate = _env_float("SCRIPTKING_FAKE_ERROR_RATE", 0.0) if error_rate is None else error_rate
+        self.error_status = (
+            int(os.getenv("SCRIPTKING_FAKE_ERROR_STATUS", "429")) if error_status is None else error_status
+        )
+        self.retry_after = _env_float("SCRIPTKING_FAKE_RETRY_AFTER", 1) if retry_after is None else retry_after
+        self.fill = _env_float("SCRIPTKING_FAKE_FILL", 0.8) if fill is None else fill
+
+
+class FakeStream:
+    """openai.Stream처럼 순회·close·with 문을 지원한다."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def __iter__(self):
+        return self._chunks
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        self._chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeCompletions:
+    def __init__(self, config: FakeBackendConfig):
+        self.config = config
+        self._rng = random.Random()
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def create(self, model: str, messages: list, max_tokens=None, stream: bool = False,
+               stream_options=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            failed = self._rng.random() < self.config.error_rate
+        if failed:
+            time.sleep(self.config.latency)
+            raise self._error()
+
+        prompt_text = "".join(m.get("content") or "" for m in messages)
+        seed = hashlib.sha256(f"{model}\x00{prompt_text}".encode("utf-8")).digest()
+        rng = random.Random(seed)
+        budget = max_tokens or 600
+        count = max(1, int(budget * self.config.fill))
+        pieces = [rng.choice(WORDS) for _ in range(min(count, budget))]
+        finish_reason = "length" if count >= budget else "stop"
+        # 한글은 대략 글자당 1토큰이므로 입력 토큰은 글자 수로 어림한다.
+        usage = {
+            "prompt_tokens": len(prompt_text),
+            "completion_tokens": len(pieces),
+            "total_tokens": len(prompt_text) + len(pieces),
+        }
+        completion_id = "chatcmpl-fake-" + seed.hex()[:12]
+        created = int(time.time())
+
+        if stream:
+            include_usage = bool((stream_options or {}).get("include_usage"))
+            return FakeStream(self._stream(
+                completion_id, created, model, pieces, finish_reason, usage if include_usage else None
+            ))
+
+        time.sleep(self.config.latency + self._generation_time(len(pieces)))
+        return ChatCompletion.model_validate({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(pieces)},
+                "finish_reason": finish_reason,
+            }],
+            "usage": usage,
+        })
+
+    def _generation_time(self, tokens: int) -> float:
+        if self.config.token_rate <= 0:
+            return 0.0
+        return tokens / self.config.token_rate
+
+    def _stream(self, completion_id, created, model, pieces, finish_reason, usage):
+        def chunk(delta, finish=None, chunk_usage=None, with_choice=True):
+            return ChatCompletionChunk.model_validate({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if with_choice else [],
+                "usage": chunk_usage,
+            })
+
+        time.sleep(self.config.latency)
+        yield chunk({"role": "assistant", "content": ""})
+        interval = 1 / self.config.token_rate if self.config.token_rate > 0 else 0.0
+        for piece in pieces:
+            if interval:
+                time.sleep(interval)
+            yield chunk({"content": piece})
+        yield chunk({}, finish=finish_reason)
+        if usage is not None:
+            yield chunk({}, chunk_usage=usage, with_choice=False)
+
+    def _error(self) -> openai.APIStatusError:
+        status = self.config.error_status
+        headers = {"retry-after": f"{self.config.retry_after:g}"} if status == 429 else {}
+        response = httpx.Response(status, headers=headers, request=httpx.Request("POST", API_URL))
+        if status == 429:
+            return openai.RateLimitError("가짜 백엔드: 요청 한도 초과", response=response, body=None)
+        if status >= 500:
+            return openai.InternalServerError("가짜 백엔드: 서버 오류", response=response, body=None)
+        return openai.APIStatusError(f"가짜 백엔드: HTTP {status}", response=response, body=None)
+
+
+class FakeOpenAI:
+    """OpenAI 클라이언트 중 앱이 쓰는 chat.completions.create만 흉내 낸다."""
+
+    def __init__(self, config: FakeBackendConfig = None):
+        self.config = config or FakeBackendConfig()
+        self.completions = FakeCompletions(self.config)
+        self.chat = types.SimpleNamespace(completions=self.completions)
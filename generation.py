@@ -0,0 +1,101 @@
+"""내레이션 생성 호출과 소요 시간 기록 (main03.py · main_02.py 공용, 오류 안내 문구는 main-x.py도 같이 쓴다).
+
+두 앱에 똑같이 붙여 넣어 두었던 스트리밍·지표 함수를 여기로 모았다.
+OpenAI 오류는 on_change 콜백이나 결과 영역 밖으로 내보내지 않고
+session_state.generation_error에 안내 문구로 남긴다.
+"""
+
+import time
+
+import openai
+import streamlit as st
+
+# 예전부터 두 앱이 쓰던 출력 상한
+DEFAULT_MAX_TOKENS = 600
+METRICS_KEEP = 50
+# 조각마다 다시 그리면 웹소켓 메시지가 너무 많아지므로 이 간격(초)으로 묶는다.
+RENDER_INTERVAL = 0.05
+
+
+def describe_generation_error(error: Exception) -> str:
+    if isinstance(error, openai.RateLimitError):
+        return "OpenAI 요청 한도를 넘었습니다. 잠시 후 다시 시도해주세요."
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return "OpenAI 서버에 연결하지 못했습니다. 네트워크 상태를 확인한 뒤 다시 시도해주세요."
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return f"OpenAI 서버 오류입니다 (HTTP {error.status_code}). 잠시 후 다시 시도해주세요."
+    return f"생성 중 오류가 발생했습니다: {error}"
+
+
+def run_generation_request(client, request: dict, placeholder=None, max_tokens: int = DEFAULT_MAX_TOKENS):
+    """request({"model", "messages"})를 실행해 대본을 돌려준다. 실패하면 None.
+
+    placeholder가 있으면 stream=True로 받아가며 조각을 이어 쓰고, 없으면 한 번에 받는다.
+    """
+    started = time.perf_counter()
+    try:
+        if placeholder is None:
+            with st.spinner("🎬 대본을 작성하는 중입니다..."):
+                res = client.chat.completions.create(
+                    model=request["model"],
+                    messages=request["messages"],
+                    max_tokens=max_tokens,
+                )
+            text, ttft = res.choices[0].message.content, None
+        else:
+            text, ttft = stream_into(client, request, placeholder, max_tokens, started)
+    except openai.OpenAIError as e:
+        if placeholder is not None:
+            placeholder.empty()  # 중간까지 받은 조각은 지운다.
+        st.session_state.generation_error = describe_generation_error(e)
+        return None
+    record_generation_metrics(request["model"], ttft, time.perf_counter() - started)
+    return text
+
+
+def stream_into(client, request: dict, placeholder, max_tokens: int, started: float):
+    """stream=True 응답을 placeholder에 이어 쓰고 (전체 글, 첫 토큰까지 걸린 초)를 돌려준다."""
+    first_token_at = None
+    last_render = 0.0
+    chunks = []
+
+    stream = client.chat.completions.create(
+        model=request["model"],
+        messages=request["messages"],
+        max_tokens=max_tokens,
+        stream=True,
+    )
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        now = time.perf_counter()
+        if first_token_at is None:
+            first_token_at = now
+        chunks.append(delta)
+        if now - last_render >= RENDER_INTERVAL:
+            placeholder.markdown("".join(chunks) + "▌")
+            last_render = now
+
+    text = "".join(chunks)
+    placeholder.markdown(text)
+    ttft = first_token_at - started if first_token_at is not None else None
+    return text, ttft
+
+
+def record_generation_metrics(model: str, ttft, latency: float):
+    metrics = {"model": model, "ttft": ttft, "latency": latency}
+    st.session_state.last_metrics = metrics
+    log = st.session_state.generation_metrics
+    log.append(metrics)
+    st.session_state.generation_metrics = log[-METRICS_KEEP:]
+
+
+def format_generation_metrics(metrics: dict) -> str:
+    parts = [f"모델 {metrics['model']}"]
+    if metrics.get("ttft") is not None:
+        parts.append(f"첫 토큰 {metrics['ttft']:.2f}초")
+    parts.append(f"전체 {metrics['latency']:.2f}초")
+    return "⏱ " + " · ".join(parts)
@@ -1,30 +1,372 @@
 import streamlit as st
-from openai import OpenAI
+import httpx
+import openai
+from openai import OpenAI, DefaultHttpxClient
 import os
 import json
+import logging
+import time
+import hashlib
+import html
+import random
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import weakref
+import atexit
+import csv
+import io
+import math
+import re
+import difflib
+import heapq
+import bisect
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from itertools import islice
+from email.utils import parsedate_to_datetime
 from json import JSONDecodeError
 from uuid import uuid4
 
+from generation import describe_generation_error
+from user_config import user_dir
+
+try:
+    import tiktoken
+except ImportError:  # 토큰 수는 근사치로 대신 센다.
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
 st.set_page_config(page_title="scriptking", page_icon="📝", layout="centered")
 
 api_key = os.getenv("GPT_API_KEY")
-client = OpenAI(api_key=api_key)
 
-CONFIG_PATH = "config.json"
+# LLM 백엔드: "openai"(기본) 또는 "fake"(네트워크 없이 흉내 내는 부하 테스트용, fake_llm.py)
+LLM_BACKEND = os.getenv("SCRIPTKING_BACKEND", "openai").lower()
 
-st.markdown(
+# OpenAI HTTP 연결 풀 (프로세스 하나에서 모든 세션이 같이 쓴다)
+HTTP_MAX_CONNECTIONS = int(os.getenv("SCRIPTKING_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("SCRIPTKING_HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("SCRIPTKING_HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_TIMEOUT = float(os.getenv("SCRIPTKING_HTTP_TIMEOUT", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("SCRIPTKING_HTTP_CONNECT_TIMEOUT", "5"))
+
+# 계정 한도: 모든 세션이 같이 쓰는 분당 요청 수 / 분당 토큰 수
+RATE_LIMIT_RPM = int(os.getenv("SCRIPTKING_RATE_LIMIT_RPM", "500"))
+RATE_LIMIT_TPM = int(os.getenv("SCRIPTKING_RATE_LIMIT_TPM", "200000"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("SCRIPTKING_RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = 0.5  # 초. 시도마다 두 배로 늘리고 그 안에서 무작위로 고른다.
+RETRY_MAX_DELAY = 30.0
+# 같은 요청에 붙은 쪽이 먼저 시작한 요청의 소식을 기다리는 최대 시간 (재시도 대기까지 감안)
+FLIGHT_IDLE_TIMEOUT = HTTP_TIMEOUT + RETRY_MAX_DELAY * RETRY_MAX_ATTEMPTS
+
+
+class PoolStatsTransport(httpx.HTTPTransport):
+    """요청 수와 새로 연 연결 수를 세어 keep-alive 재사용률을 볼 수 있게 한 transport."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._stats_lock = threading.Lock()
+        self._seen_connections = weakref.WeakSet()
+        self.requests = 0
+        self.connections_opened = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def handle_request(self, request):
+        with self._stats_lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return super().handle_request(request)
+        finally:
+            with self._stats_lock:
+                self.in_flight -= 1
+                for conn in self._pool.connections:
+                    if conn not in self._seen_connections:
+                        self._seen_connections.add(conn)
+                        self.connections_opened += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            connections = list(self._pool.connections)
+            requests = self.requests
+            opened = self.connections_opened
+            return {
+                "requests": requests,
+                "connections_opened": opened,
+                "reused_requests": max(requests - opened, 0),
+                "reuse_ratio": (requests - opened) / requests if requests else 0.0,
+                "open_connections": len(connections),
+                "idle_connections": sum(1 for c in connections if c.is_idle()),
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+            }
+
+
+@st.cache_resource
+def get_openai_client(key: str):
+    """세션·재실행과 상관없이 프로세스 전체가 공유하는 OpenAI 클라이언트와 transport."""
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    transport = PoolStatsTransport(limits=limits)
+    timeout = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    http_client = DefaultHttpxClient(transport=transport, timeout=timeout)
+    # 재시도는 RequestScheduler가 계정 한도를 보면서 맡으므로 SDK 자체 재시도는 끈다.
+    return OpenAI(api_key=key, http_client=http_client, timeout=timeout, max_retries=0), transport
+
+
+class TokenBucket:
+    """분당 한도를 초당 비율로 채우는 토큰 버킷. 잠금은 RequestScheduler가 잡는다."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        return max(amount - self.tokens, 0) / self.rate
+
+
+class RequestScheduler:
+    """모든 세션의 OpenAI 호출이 지나가는 관문.
+
+    분당 요청 수·토큰 수를 토큰 버킷으로 맞추고, 429/5xx/연결 오류는 지수 백오프(무작위 지터)로
+    다시 시도한다. Retry-After가 오면 그 시간 동안은 다른 세션의 요청도 함께 멈춘다.
     """
-    <style>
-    textarea {
-        font-size: 0.8rem !important;
-        line-height: 1.3 !important;
-    }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+
+    RETRYABLE_STATUS = {408, 409, 429}
+
+    def __init__(self, rpm: int, tpm: int, max_attempts: int, base_delay: float, max_delay: float,
+                 on_retry=None):
+        self.requests = TokenBucket(rpm)
+        self.token_budget = TokenBucket(tpm)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_retry = on_retry
+        self.cooldown_until = 0.0
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+
+    def acquire(self, tokens: int):
+        # 토큰 한도보다 큰 요청은 버킷을 가득 채워야 나가도록 상한을 둔다.
+        amount = min(tokens, self.token_budget.capacity)
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.token_budget.refill(now)
+                    wait = max(
+                        self.cooldown_until - now,
+                        self.requests.wait_for(1),
+                        self.token_budget.wait_for(amount),
+                    )
+                    if wait <= 0:
+                        self.requests.tokens -= 1
+                        self.token_budget.tokens -= amount
+                        return
+                    self.throttled_seconds += wait
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in self.RETRYABLE_STATUS or error.status_code >= 500
+        return False
+
+    @staticmethod
+    def retry_after(error: Exception):
+        """Retry-After(초 또는 HTTP 날짜)나 retry-after-ms 헤더에서 기다릴 시간을 읽는다."""
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        headers = response.headers
+        if headers.get("retry-after-ms"):
+            try:
+                return float(headers["retry-after-ms"]) / 1000
+            except ValueError:
+                pass
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, fn, tokens: int, model: str):
+        """fn()을 한도 안에서 실행한다. 입력 토큰 + max_tokens를 미리 잡아두는 방식은
+        OpenAI가 한도를 셀 때와 같아서, 실제 사용량이 적어도 따로 돌려주지 않는다."""
+        for attempt in range(self.max_attempts):
+            self.acquire(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                if not self.is_retryable(e) or attempt == self.max_attempts - 1:
+                    raise
+                server_wait = self.retry_after(e)
+                delay = min(server_wait, self.max_delay) if server_wait is not None else self.backoff(attempt)
+                with self._lock:
+                    self.retries += 1
+                    if server_wait is not None:
+                        self.cooldown_until = max(self.cooldown_until, time.monotonic() + delay)
+                if self.on_retry is not None:
+                    self.on_retry(model, getattr(e, "status_code", None) or type(e).__name__)
+                time.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.token_budget.refill(now)
+            return {
+                "waiting": self.waiting,
+                "retries": self.retries,
+                "throttled_seconds": self.throttled_seconds,
+                "requests_left": int(self.requests.tokens),
+                "tokens_left": int(self.token_budget.tokens),
+                "cooldown": max(self.cooldown_until - now, 0),
+            }
+
+
+@st.cache_resource
+def get_fake_client():
+    from fake_llm import FakeOpenAI
+
+    return FakeOpenAI()
+
+
+def get_llm_backend():
+    """(chat.completions.create를 가진 클라이언트, 연결 풀 transport 또는 None)"""
+    if LLM_BACKEND == "fake":
+        return get_fake_client(), None
+    return get_openai_client(api_key)
+
+
+client, http_transport = get_llm_backend()
+
+CONFIG_PATH = "config.json"
+CONFIG_SAVE_DELAY = 0.5  # 초. 이 시간 안에 연달아 들어온 저장 요청은 한 번만 쓴다.
+
+# 설정 저장소: "sqlite"(기본) 또는 "json"(config.json 한 파일)
+STORAGE_ENGINE = os.getenv("SCRIPTKING_STORAGE", "sqlite").lower()
+STORE_PATH = "scriptking.db"
+
+# 사용자별 설정: 로그인(st.user) → 사용자 헤더(켠 경우만) → "default" 순으로 사용자를 정한다.
+# 헤더는 누구나 보낼 수 있으므로 기본값은 꺼짐("")이다. 앞단 프록시가 인증한 뒤 그 헤더를
+# 항상 덮어쓰고(클라이언트가 보낸 값은 지우고) 앱에는 프록시를 거쳐서만 접속할 수 있을 때만
+# SCRIPTKING_USER_HEADER=X-Forwarded-User 처럼 켠다.
+# "default" 사용자는 예전처럼 작업 폴더의 config.json / scriptking.db를 그대로 쓴다.
+USER_HEADER = os.getenv("SCRIPTKING_USER_HEADER", "").strip()
+DEFAULT_USER = "default"
+
+# 성능 지표: LLM 호출과 설정 읽기/쓰기마다 한 줄씩 남긴다.
+METRICS_PATH = "metrics.db"
+METRICS_RETENTION = 30 * 24 * 60 * 60  # 초
+METRICS_MAX_ROWS = 100_000
+
+# Prometheus 수집용 /metrics 엔드포인트. 포트를 0으로 두면 띄우지 않는다.
+PROMETHEUS_HOST = os.getenv("SCRIPTKING_PROMETHEUS_HOST", "127.0.0.1")
+PROMETHEUS_PORT = int(os.getenv("SCRIPTKING_PROMETHEUS_PORT", "9464"))
+ACTIVE_SESSION_WINDOW = 5 * 60  # 초. 이 안에 재실행된 세션을 활성으로 센다.
+
+RESPONSE_CACHE_PATH = "response_cache.db"
+RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60  # 초
+RESPONSE_CACHE_MAX_ENTRIES = 500
+RESPONSE_CACHE_MAX_BYTES = 20 * 1024 * 1024
+
+BATCH_MAX_CONCURRENCY = 8
+EXPERIMENT_MAX_PAIRS = 200  # 주제 × set 조합 상한
+
+# 지침 set 선택기: 한 화면에 보이는 set 수와 검색 설정
+INSTSET_PAGE_SIZE = 8
+INSTSET_RECENT_LIMIT = 5
+INSTSET_FUZZY_CUTOFF = 0.6  # 오타 허용 검색의 최소 유사도
+INSTSET_SEARCH_CACHE = 32  # 기억해둘 검색 결과 수
+
+# 지난 주제 기록: 개수 제한 없이 저장하고, 최근 것만 메모리에 둔다.
+HISTORY_SHOWN = 5  # 입력창 위에 보여줄 최근 주제 수
+HISTORY_CACHE_SIZE = 200  # 사용자마다 메모리에 둘 최근 주제 수
+HISTORY_PAGE_SIZE = 10
+
+# 주제 추천: 지난 주제·생성 아카이브 주제를 자모 단위 접두어 색인으로 찾는다.
+TOPIC_SUGGEST_LIMIT = 8
+TOPIC_INDEX_KEY_LENGTH = 40  # 색인 키로 쓸 최대 자모 수
+TOPIC_INDEX_SCAN = 3000  # 짧은 검색어일 때 순위를 매길 최대 후보 수
+
+# 장편 모드: 개요를 먼저 만들고 섹션별로 나눠 동시에 생성한다.
+LONGFORM_DEFAULT_SECTIONS = ["인트로", "배경", "사건/전개", "결론"]
+LONGFORM_MAX_SECTIONS = 8
+LONGFORM_MAX_CONCURRENCY = 4
+
+# 백그라운드 작업: 생성은 작업 스레드에서 돌리고 페이지는 상태만 주기적으로 확인한다.
+JOB_MAX_WORKERS = int(os.getenv("SCRIPTKING_JOB_WORKERS", "4"))
+JOB_KEEP = 200  # 프로세스 전체에서 보관할 최근 작업 수
+JOB_SESSION_KEEP = 20  # 세션마다 목록에 보여줄 작업 수
+JOB_POLL_INTERVAL = 1.0  # 초
+
+MODEL_OPTIONS = ["gpt-4o-mini", "gpt-4o", "gpt-4.1"]
+
+# 모델별 단가 (USD / 1M 토큰, 입력·출력). 비교 모드의 예상 비용 계산에 쓴다.
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+TOKEN_ENCODING = "o200k_base"  # gpt-4o / gpt-4o-mini / gpt-4.1 공통
+
+# 출력 토큰 예산: 출력 형식 지침의 "N자 이상"에서 길이를 읽어 max_tokens를 정한다.
+DEFAULT_MAX_TOKENS = 600
+MAX_OUTPUT_TOKENS = 4096
+KOREAN_TOKENS_PER_CHAR = 1.0  # o200k 기준 한글 내레이션은 글자당 1토큰 안쪽
+LENGTH_HEADROOM = 2.0  # "이상"이므로 목표 길이의 두 배까지 여유를 둔다
+MESSAGE_TOKEN_OVERHEAD = 3  # 메시지마다 붙는 역할/구분 토큰
+
+INST_KEYS = [
+    "inst_role",
+    "inst_tone",
+    "inst_structure",
+    "inst_depth",
+    "inst_forbidden",
+    "inst_format",
+    "inst_user_intent",
+]
 
 st.session_state.setdefault("history", [])
+st.session_state.setdefault("history_query", "")
+st.session_state.setdefault("history_order", "최근 순")
+st.session_state.setdefault("history_page", 0)
+st.session_state.setdefault("topic_query", "")
 
 st.session_state.setdefault(
     "inst_role",
@@ -58,6 +400,19 @@ st.session_state.setdefault(
 st.session_state.setdefault("current_input", "")
 st.session_state.setdefault("last_output", "")
 st.session_state.setdefault("model_choice", "gpt-4o-mini")
+st.session_state.setdefault("stream_output", True)
+st.session_state.setdefault("pending_generation", None)
+st.session_state.setdefault("generation_error", None)
+st.session_state.setdefault("last_metrics", None)
+st.session_state.setdefault("generation_metrics", [])
+st.session_state.setdefault("force_regenerate", False)
+st.session_state.setdefault("longform_mode", False)
+st.session_state.setdefault("batch_results", None)
+st.session_state.setdefault("background_jobs", False)
+st.session_state.setdefault("my_jobs", [])
+st.session_state.setdefault("compare_models", ["gpt-4o-mini", "gpt-4o"])
+st.session_state.setdefault("compare_results", None)
+st.session_state.setdefault("experiment_results", None)
 
 st.session_state.setdefault("instruction_sets", [])
 st.session_state.setdefault("active_instruction_set_id", None)
@@ -66,182 +421,2979 @@ st.session_state.setdefault("edit_instruction_set_id", None)
 
 st.session_state.setdefault("instset_toolbar_run_id", 0)
 st.session_state.setdefault("instset_delete_mode", False)
+st.session_state.setdefault("instset_query", "")
+st.session_state.setdefault("instset_filter", "전체")
+st.session_state.setdefault("instset_page", None)
+st.session_state.setdefault("instset_del_query", "")
+st.session_state.setdefault("instset_del_page", None)
+st.session_state.setdefault("instset_delete_target", None)
 st.session_state.setdefault("show_reset_confirm", False)
 st.session_state.setdefault("reset_input_value", "")
 
 
-def load_config():
-    if not os.path.exists(CONFIG_PATH):
-        return
+def atomic_write_text(path: str, text: str):
+    """같은 폴더의 임시 파일에 다 쓴 뒤 rename 하므로, 쓰는 도중 죽어도 기존 파일이 남는다."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".config-", suffix=".tmp", dir=directory)
     try:
-        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except JSONDecodeError:
-        return
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-    if isinstance(data.get("inst_role"), str):
-        st.session_state.inst_role = data["inst_role"]
-    elif isinstance(data.get("role_instruction"), str):
-        st.session_state.inst_role = data["role_instruction"]
 
-    for key in [
-        "inst_tone",
-        "inst_structure",
-        "inst_depth",
-        "inst_forbidden",
-        "inst_format",
-        "inst_user_intent",
-    ]:
+class ConfigWriter:
+    """config.json 저장 요청을 모아서 쓰는 프로세스 공용 writer.
+
+    - 마지막으로 쓴 내용과 해시가 같으면 아무것도 하지 않는다.
+    - delay 초 안에 이어서 들어온 요청은 마지막 내용 한 번으로 합쳐 쓴다.
+    - 실제 쓰기는 atomic_write_text로 한다.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._pending = {}
+        self._written = {}
+        self._timer = None
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _digest(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def submit(self, path: str, text: str) -> bool:
+        digest = self._digest(text)
+        with self._lock:
+            if path not in self._pending and self._written.get(path) == digest:
+                return False
+            self._pending[path] = text
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+        return True
+
+    def pending_text(self, path: str):
+        with self._lock:
+            return self._pending.get(path)
+
+    def mark_written(self, path: str, text: str):
+        with self._lock:
+            self._written[path] = self._digest(text)
+
+    def discard(self, path: str):
+        with self._lock:
+            self._pending.pop(path, None)
+            self._written.pop(path, None)
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._timer = None
+            for path, text in pending.items():
+                digest = self._digest(text)
+                if self._written.get(path) == digest:
+                    continue
+                atomic_write_text(path, text)
+                with self._lock:
+                    self._written[path] = digest
+
+
+@st.cache_resource
+def get_config_writer() -> ConfigWriter:
+    return ConfigWriter(CONFIG_SAVE_DELAY)
+
+
+def normalize_config_data(data: dict) -> dict:
+    """config.json(현재/이전 버전 모두)을 저장소가 쓰는 표준 형태로 맞춘다.
+
+    - main03.py 형식: role_instruction → inst_role
+    - main_02.py 형식: instruction → inst_role, task_instruction → inst_user_intent
+    """
+    if not isinstance(data, dict):
+        return {}
+    normalized = {}
+    for key in INST_KEYS:
         if isinstance(data.get(key), str):
-            setattr(st.session_state, key, data[key])
+            normalized[key] = data[key]
+    if "inst_role" not in normalized:
+        for legacy_key in ("role_instruction", "instruction"):
+            if isinstance(data.get(legacy_key), str):
+                normalized["inst_role"] = data[legacy_key]
+                break
+    if "inst_user_intent" not in normalized and isinstance(data.get("task_instruction"), str):
+        normalized["inst_user_intent"] = data["task_instruction"]
 
     hist = data.get("history")
     if isinstance(hist, list):
-        st.session_state.history = hist[-5:]
-
-    if isinstance(data.get("instruction_sets"), list):
-        st.session_state.instruction_sets = data["instruction_sets"]
+        normalized["history"] = [h for h in hist if isinstance(h, str)]
+    stats = data.get("history_stats")
+    if isinstance(stats, dict):
+        normalized["history_stats"] = {
+            topic: [int(v[0]), float(v[1])]
+            for topic, v in stats.items()
+            if isinstance(v, list) and len(v) == 2
+            and all(isinstance(x, (int, float)) for x in v)
+        }
+    sets = data.get("instruction_sets")
+    if isinstance(sets, list):
+        normalized["instruction_sets"] = [
+            s for s in sets if isinstance(s, dict) and s.get("id")
+        ]
     if "active_instruction_set_id" in data:
-        st.session_state.active_instruction_set_id = data["active_instruction_set_id"]
+        normalized["active_instruction_set_id"] = data["active_instruction_set_id"]
+    return normalized
 
 
-def save_config():
-    data = {
-        "inst_role": st.session_state.inst_role,
-        "inst_tone": st.session_state.inst_tone,
-        "inst_structure": st.session_state.inst_structure,
-        "inst_depth": st.session_state.inst_depth,
-        "inst_forbidden": st.session_state.inst_forbidden,
-        "inst_format": st.session_state.inst_format,
-        "inst_user_intent": st.session_state.inst_user_intent,
-        "history": st.session_state.history[-5:],
-        "instruction_sets": st.session_state.get("instruction_sets", []),
-        "active_instruction_set_id": st.session_state.get("active_instruction_set_id"),
+def history_stats(data: dict) -> dict:
+    """주제 기록을 {주제: [사용 횟수, 마지막 사용 시각]}으로, 오래된 것부터 순서대로.
+
+    history_stats가 없는 예전 설정은 history 목록 순서대로 1회씩 쓴 것으로 본다.
+    """
+    stats = data.get("history_stats")
+    if isinstance(stats, dict):
+        return dict(sorted(stats.items(), key=lambda item: item[1][1]))
+    hist = data.get("history") or []
+    now = time.time()
+    # 순서를 보존하려고 오래된 항목일수록 조금씩 이른 시각을 준다.
+    return {h: [1, now - (len(hist) - i) * 1e-3] for i, h in enumerate(hist)}
+
+
+def like_contains(text: str) -> str:
+    """text가 들어간 값을 찾는 LIKE 패턴. %, _, \\는 글자 그대로 찾도록 막는다 (ESCAPE '\\'와 함께 쓴다)."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def history_row(topic: str, count: int, used_at: float) -> dict:
+    return {"topic": topic, "count": count, "used_at": used_at}
+
+
+def storable_set(set_obj: dict) -> dict:
+    """'_'로 시작하는 키는 화면용 파생값이므로 저장하지 않는다."""
+    return {k: v for k, v in set_obj.items() if not k.startswith("_")}
+
+
+class JsonConfigStore:
+    """config.json 한 파일에 전부 저장하는 엔진 (SCRIPTKING_STORAGE=json).
+
+    부분 갱신도 결국 문서 전체를 다시 쓰지만, 쓰기는 ConfigWriter가 모아서 처리한다.
+    """
+
+    def __init__(self, path: str, writer: ConfigWriter):
+        self.path = path
+        self.writer = writer
+        # _doc()가 잠근 채로 load()를 부를 수 있으므로 같은 스레드가 다시 잡을 수 있는 잠금을 쓴다.
+        self._lock = threading.RLock()
+        self._data = None
+
+    def load(self) -> dict:
+        raw = self.writer.pending_text(self.path)
+        if raw is None:
+            if not os.path.exists(self.path):
+                self._data = {}
+                return {}
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = f.read()
+            self.writer.mark_written(self.path, raw)
+        try:
+            data = normalize_config_data(json.loads(raw))
+        except JSONDecodeError:
+            data = {}
+        data["history_stats"] = history_stats(data)
+        data.pop("history", None)
+        with self._lock:
+            self._data = data
+        return json.loads(json.dumps(data))
+
+    def _doc(self) -> dict:
+        if self._data is None:
+            self.load()
+        return self._data
+
+    def _submit(self):
+        text = json.dumps(self._data, ensure_ascii=False, separators=(",", ":"))
+        self.writer.submit(self.path, text)
+
+    def save_all(self, data: dict):
+        with self._lock:
+            previous = self._doc()
+            self._data = json.loads(json.dumps(data))
+            self._data["instruction_sets"] = [
+                storable_set(s) for s in self._data.get("instruction_sets", [])
+            ]
+            # 주제 기록이 들어 있지 않으면(설정만 저장) 기존 기록을 그대로 둔다.
+            if "history" in data or "history_stats" in data:
+                self._data["history_stats"] = history_stats(data)
+            else:
+                self._data["history_stats"] = previous.get("history_stats", {})
+            self._data.pop("history", None)
+            self._submit()
+
+    def set_settings(self, values: dict):
+        with self._lock:
+            self._doc().update(values)
+            self._submit()
+
+    def upsert_set(self, set_obj: dict):
+        with self._lock:
+            sets = self._doc().setdefault("instruction_sets", [])
+            row = storable_set(set_obj)
+            for i, s in enumerate(sets):
+                if s.get("id") == row["id"]:
+                    sets[i] = row
+                    break
+            else:
+                sets.append(row)
+            self._submit()
+
+    def update_set_field(self, set_id: str, field: str, value):
+        with self._lock:
+            for s in self._doc().get("instruction_sets", []):
+                if s.get("id") == set_id:
+                    s[field] = value
+                    break
+            self._submit()
+
+    def delete_set(self, set_id: str):
+        with self._lock:
+            doc = self._doc()
+            doc["instruction_sets"] = [
+                s for s in doc.get("instruction_sets", []) if s.get("id") != set_id
+            ]
+            self._submit()
+
+    def touch_history(self, topic: str) -> dict:
+        with self._lock:
+            stats = self._doc().setdefault("history_stats", {})
+            # 지웠다가 다시 넣어 순서상 맨 뒤(가장 최근)로 옮긴다.
+            count = stats.pop(topic, [0, 0])[0] + 1
+            now = time.time()
+            stats[topic] = [count, now]
+            self._submit()
+        return history_row(topic, count, now)
+
+    def history_recent(self, limit: int) -> list:
+        with self._lock:
+            stats = self._doc().get("history_stats", {})
+            return [history_row(t, c, u) for t, (c, u) in islice(reversed(stats.items()), limit)]
+
+    def history_page(self, query: str = "", offset: int = 0, limit: int = HISTORY_PAGE_SIZE,
+                     order: str = "recent"):
+        with self._lock:
+            stats = self._doc().get("history_stats", {})
+            needle = query.strip().casefold()
+            rows = [
+                history_row(t, c, u) for t, (c, u) in reversed(stats.items())
+                if needle in t.casefold()
+            ]
+        if order == "frequent":
+            rows.sort(key=lambda r: (-r["count"], -r["used_at"]))
+        return rows[offset:offset + limit], len(rows)
+
+    def history_all(self) -> list:
+        with self._lock:
+            stats = self._doc().get("history_stats", {})
+            return [history_row(t, c, u) for t, (c, u) in stats.items()]
+
+    archive_enabled = False
+
+    def add_output(self, topic: str, set_id, model: str, output: str, **details):
+        # JSON 엔진은 생성 결과를 따로 보관하지 않는다.
+        pass
+
+    def search_outputs(self, query: str, limit: int = 20) -> list:
+        return []
+
+    def output_topics(self) -> list:
+        return []
+
+    def model_stats(self) -> list:
+        return []
+
+    def get_output(self, output_id: int):
+        return None
+
+    def reset(self):
+        with self._lock:
+            self.writer.discard(self.path)
+            self._data = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class SqliteConfigStore:
+    """지침 set · 최근 입력 · 생성 결과를 행 단위로 저장하는 SQLite 엔진 (기본값).
+
+    처음 열 때 DB가 비어 있고 config.json이 있으면 한 번 옮겨온다.
+    """
+
+    SCHEMA_VERSION = 4
+    ARCHIVE_COLUMNS = {
+        "cache_key": "TEXT",
+        "prompt_tokens": "INTEGER",
+        "completion_tokens": "INTEGER",
+        "latency": "REAL",
+    }
+    HISTORY_COLUMNS = {
+        "use_count": "INTEGER NOT NULL DEFAULT 1",
     }
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
 
+    def __init__(self, path: str, legacy_json_path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        self._migrate_from_json(legacy_json_path)
+        self._upgrade_schema()
+        self.archive_enabled = True
+        self.fts_tokenizer = self._ensure_fts()
 
-def reset_config():
-    if os.path.exists(CONFIG_PATH):
-        os.remove(CONFIG_PATH)
+    def _create_schema(self):
+        set_columns = ",\n".join(f"{key} TEXT NOT NULL DEFAULT ''" for key in INST_KEYS)
+        with self._conn:
+            self._conn.executescript(
+                f"""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS instruction_sets (
+                    id TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL,
+                    name TEXT NOT NULL DEFAULT '',
+                    {set_columns},
+                    extra TEXT NOT NULL DEFAULT '{{}}',
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS instruction_sets_position
+                    ON instruction_sets (position);
+                CREATE INDEX IF NOT EXISTS instruction_sets_name
+                    ON instruction_sets (name);
+                CREATE TABLE IF NOT EXISTS history (
+                    topic TEXT PRIMARY KEY,
+                    used_at REAL NOT NULL,
+                    use_count INTEGER NOT NULL DEFAULT 1
+                );
+                CREATE INDEX IF NOT EXISTS history_used_at ON history (used_at);
+                CREATE TABLE IF NOT EXISTS outputs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    topic TEXT NOT NULL,
+                    set_id TEXT,
+                    model TEXT NOT NULL,
+                    output TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS outputs_created_at ON outputs (created_at);
+                CREATE INDEX IF NOT EXISTS outputs_set_id ON outputs (set_id);
+                """
+            )
 
-    for key in [
-        "inst_role",
-        "inst_tone",
-        "inst_structure",
-        "inst_depth",
-        "inst_forbidden",
-        "inst_format",
-        "inst_user_intent",
-        "history",
-        "current_input",
-        "last_output",
-        "model_choice",
-        "instruction_sets",
-        "active_instruction_set_id",
-        "show_instruction_set_editor",
-        "edit_instruction_set_id",
-        "instset_toolbar_run_id",
-        "instset_delete_mode",
-        "show_reset_confirm",
-        "reset_input_value",
-    ]:
-        if key in st.session_state:
-            del st.session_state[key]
+    def _migrate_from_json(self, json_path: str):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= 1:
+            return
+        if os.path.exists(json_path):
+            try:
+                with open(json_path, "r", encoding="utf-8") as f:
+                    data = normalize_config_data(json.load(f))
+            except (OSError, JSONDecodeError):
+                data = {}
+            if data:
+                self.save_all(data)
+        self._conn.execute("PRAGMA user_version = 1")
 
-    if "config_loaded" in st.session_state:
-        del st.session_state["config_loaded"]
+    def _upgrade_schema(self):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        with self._conn:
+            existing = {row[1] for row in self._conn.execute("PRAGMA table_info(outputs)")}
+            if "prompt_hash" in existing and "cache_key" not in existing:
+                # v2~v3은 응답 캐시 키를 prompt_hash라는 이름으로 저장했다. 값은 그대로 두고 이름만 바꾼다.
+                self._conn.execute("DROP INDEX IF EXISTS outputs_prompt_hash")
+                self._conn.execute("ALTER TABLE outputs RENAME COLUMN prompt_hash TO cache_key")
+            for table, columns in (("outputs", self.ARCHIVE_COLUMNS),
+                                   ("history", self.HISTORY_COLUMNS)):
+                existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+                for column, column_type in columns.items():
+                    if column not in existing:
+                        self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS outputs_cache_key ON outputs (cache_key)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS history_use_count ON history (use_count, used_at)"
+            )
+        self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
 
-    st.rerun()
+    def _ensure_fts(self):
+        """outputs 전문 검색 색인. 한국어는 띄어쓰기 단위 토큰화가 잘 맞지 않아 trigram을 우선 쓴다."""
+        row = self._conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'outputs_fts'"
+        ).fetchone()
+        if row is not None:
+            return "trigram" if "trigram" in row[0] else "unicode61"
+
+        for tokenizer in ("trigram", "unicode61"):
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        "CREATE VIRTUAL TABLE outputs_fts USING fts5("
+                        "topic, output, content='outputs', content_rowid='id', "
+                        f"tokenize='{tokenizer}')"
+                    )
+            except sqlite3.OperationalError:
+                continue
+            break
+        else:
+            return None
 
+        with self._conn:
+            self._conn.executescript(
+                """
+                CREATE TRIGGER IF NOT EXISTS outputs_fts_insert AFTER INSERT ON outputs BEGIN
+                    INSERT INTO outputs_fts (rowid, topic, output)
+                    VALUES (new.id, new.topic, new.output);
+                END;
+                CREATE TRIGGER IF NOT EXISTS outputs_fts_delete AFTER DELETE ON outputs BEGIN
+                    INSERT INTO outputs_fts (outputs_fts, rowid, topic, output)
+                    VALUES ('delete', old.id, old.topic, old.output);
+                END;
+                INSERT INTO outputs_fts (outputs_fts) VALUES ('rebuild');
+                """
+            )
+        return tokenizer
 
-def apply_instruction_set(set_obj: dict):
-    for key in [
-        "inst_role",
-        "inst_tone",
-        "inst_structure",
-        "inst_depth",
-        "inst_forbidden",
-        "inst_format",
-        "inst_user_intent",
-    ]:
-        if key in set_obj:
-            setattr(st.session_state, key, set_obj.get(key, ""))
-    save_config()
+    @staticmethod
+    def _set_row(set_obj: dict, position: int, now: float) -> tuple:
+        row = storable_set(set_obj)
+        extra = {
+            k: v for k, v in row.items() if k not in ("id", "name") and k not in INST_KEYS
+        }
+        return (
+            row["id"],
+            position,
+            row.get("name", ""),
+            *[row.get(key, "") or "" for key in INST_KEYS],
+            json.dumps(extra, ensure_ascii=False),
+            now,
+        )
+
+    def _upsert_sql(self) -> str:
+        columns = ["id", "position", "name", *INST_KEYS, "extra", "updated_at"]
+        placeholders = ", ".join("?" for _ in columns)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+        return (
+            f"INSERT INTO instruction_sets ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}"
+        )
+
+    def load(self) -> dict:
+        with self._lock:
+            data = {}
+            for key, value in self._conn.execute("SELECT key, value FROM settings"):
+                data[key] = json.loads(value)
+            columns = ["id", "name", *INST_KEYS, "extra"]
+            sets = []
+            for row in self._conn.execute(
+                f"SELECT {', '.join(columns)} FROM instruction_sets ORDER BY position"
+            ):
+                set_obj = dict(zip(columns[:-1], row[:-1]))
+                set_obj.update(json.loads(row[-1]))
+                sets.append(set_obj)
+            data["instruction_sets"] = sets
+        return data
+
+    def save_all(self, data: dict):
+        now = time.time()
+        settings = {k: v for k, v in data.items() if k in INST_KEYS}
+        settings["active_instruction_set_id"] = data.get("active_instruction_set_id")
+        sets = data.get("instruction_sets", [])
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM settings")
+            self._conn.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in settings.items()],
+            )
+            self._conn.execute("DELETE FROM instruction_sets")
+            self._conn.executemany(
+                self._upsert_sql(),
+                [self._set_row(s, i, now) for i, s in enumerate(sets)],
+            )
+            # 주제 기록이 들어 있지 않으면(설정만 저장) 기존 기록을 그대로 둔다.
+            if "history" in data or "history_stats" in data:
+                self._conn.execute("DELETE FROM history")
+                self._conn.executemany(
+                    "INSERT INTO history (topic, use_count, used_at) VALUES (?, ?, ?)",
+                    [(t, c, u) for t, (c, u) in history_stats(data).items()],
+                )
+
+    def set_settings(self, values: dict):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in values.items()],
+            )
+
+    def upsert_set(self, set_obj: dict):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT position FROM instruction_sets WHERE id = ?", (set_obj["id"],)
+            ).fetchone()
+            if row is not None:
+                position = row[0]
+            else:
+                position = self._conn.execute(
+                    "SELECT COALESCE(MAX(position), -1) + 1 FROM instruction_sets"
+                ).fetchone()[0]
+            self._conn.execute(self._upsert_sql(), self._set_row(set_obj, position, time.time()))
+
+    def update_set_field(self, set_id: str, field: str, value):
+        with self._lock, self._conn:
+            if field in INST_KEYS or field == "name":
+                self._conn.execute(
+                    f"UPDATE instruction_sets SET {field} = ?, updated_at = ? WHERE id = ?",
+                    (value, time.time(), set_id),
+                )
+                return
+            row = self._conn.execute(
+                "SELECT extra FROM instruction_sets WHERE id = ?", (set_id,)
+            ).fetchone()
+            if row is None:
+                return
+            extra = json.loads(row[0])
+            extra[field] = value
+            self._conn.execute(
+                "UPDATE instruction_sets SET extra = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(extra, ensure_ascii=False), time.time(), set_id),
+            )
+
+    def delete_set(self, set_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM instruction_sets WHERE id = ?", (set_id,))
+
+    def touch_history(self, topic: str) -> dict:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO history (topic, used_at, use_count) VALUES (?, ?, 1) "
+                "ON CONFLICT(topic) DO UPDATE SET used_at = excluded.used_at, "
+                "use_count = use_count + 1",
+                (topic, now),
+            )
+            count = self._conn.execute(
+                "SELECT use_count FROM history WHERE topic = ?", (topic,)
+            ).fetchone()[0]
+        return history_row(topic, count, now)
+
+    def history_recent(self, limit: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT topic, use_count, used_at FROM history ORDER BY used_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [history_row(*row) for row in rows]
+
+    def history_page(self, query: str = "", offset: int = 0, limit: int = HISTORY_PAGE_SIZE,
+                     order: str = "recent"):
+        """검색어가 들어간 주제 중 한 페이지와 전체 개수. 정렬은 최근순(recent) 또는 많이 쓴 순(frequent)."""
+        where, params = "", []
+        needle = query.strip()
+        if needle:
+            where, params = "WHERE topic LIKE ? ESCAPE '\\'", [like_contains(needle)]
+        order_by = "use_count DESC, used_at DESC" if order == "frequent" else "used_at DESC"
+        with self._lock:
+            total = self._conn.execute(
+                f"SELECT COUNT(*) FROM history {where}", params
+            ).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT topic, use_count, used_at FROM history {where} "
+                f"ORDER BY {order_by} LIMIT ? OFFSET ?",
+                (*params, limit, offset),
+            ).fetchall()
+        return [history_row(*row) for row in rows], total
+
+    def history_all(self) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT topic, use_count, used_at FROM history ORDER BY used_at"
+            ).fetchall()
+        return [history_row(*row) for row in rows]
+
+    def add_output(self, topic: str, set_id, model: str, output: str, cache_key=None,
+                   prompt_tokens=None, completion_tokens=None, latency=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO outputs (topic, set_id, model, output, created_at, cache_key, "
+                "prompt_tokens, completion_tokens, latency) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (topic, set_id, model, output, time.time(), cache_key,
+                 prompt_tokens, completion_tokens, latency),
+            )
+
+    def model_stats(self) -> list:
+        """set × 모델별 누적 생성 수와 평균 소요 시간·토큰. 비교 모드 요약 표에 쓴다."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT set_id, model, COUNT(*), AVG(latency), AVG(prompt_tokens), "
+                "AVG(completion_tokens) FROM outputs GROUP BY set_id, model "
+                "ORDER BY set_id, AVG(latency)"
+            ).fetchall()
+        return [
+            {
+                "set_id": set_id,
+                "model": model,
+                "count": count,
+                "latency": latency,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+            }
+            for set_id, model, count, latency, prompt_tokens, completion_tokens in rows
+        ]
+
+    def search_outputs(self, query: str, limit: int = 20) -> list:
+        """주제·본문 검색. 최신순이 아니라 관련도순(bm25)으로 돌려준다."""
+        terms = query.split()
+        if not terms:
+            return []
+        columns = "o.id, o.topic, o.set_id, o.model, o.created_at"
+        # trigram은 3글자 미만 검색어를 색인으로 찾지 못하므로 그때는 LIKE로 훑는다.
+        use_fts = self.fts_tokenizer is not None and (
+            self.fts_tokenizer != "trigram" or all(len(t) >= 3 for t in terms)
+        )
+        with self._lock:
+            if use_fts:
+                match = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+                rows = self._conn.execute(
+                    f"SELECT {columns}, snippet(outputs_fts, 1, '[', ']', '…', 24) "
+                    "FROM outputs_fts JOIN outputs o ON o.id = outputs_fts.rowid "
+                    "WHERE outputs_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (match, limit),
+                ).fetchall()
+            else:
+                where = " AND ".join(
+                    "(o.topic LIKE ? ESCAPE '\\' OR o.output LIKE ? ESCAPE '\\')" for _ in terms
+                )
+                params = []
+                for t in terms:
+                    params += [like_contains(t), like_contains(t)]
+                rows = self._conn.execute(
+                    f"SELECT {columns}, substr(o.output, 1, 80) FROM outputs o "
+                    f"WHERE {where} ORDER BY o.created_at DESC LIMIT ?",
+                    (*params, limit),
+                ).fetchall()
+        keys = ["id", "topic", "set_id", "model", "created_at", "snippet"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def output_topics(self) -> list:
+        """아카이브에 있는 주제별 (주제, 생성 수, 마지막 생성 시각). 주제 추천 색인을 만들 때 한 번 읽는다."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT topic, COUNT(*), MAX(created_at) FROM outputs GROUP BY topic"
+            ).fetchall()
+        return [history_row(*row) for row in rows]
+
+    def get_output(self, output_id: int):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, topic, set_id, model, output, cache_key, prompt_tokens, "
+                "completion_tokens, latency, created_at FROM outputs WHERE id = ?",
+                (output_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ["id", "topic", "set_id", "model", "output", "cache_key", "prompt_tokens",
+                "completion_tokens", "latency", "created_at"]
+        return dict(zip(keys, row))
+
+    def reset(self):
+        # 생성 기록(outputs)은 추가만 하는 아카이브라 설정 초기화 대상에서 뺀다.
+        with self._lock, self._conn:
+            for table in ("settings", "instruction_sets", "history"):
+                self._conn.execute(f"DELETE FROM {table}")
+
+
+class PrometheusExporter:
+    """카운터·히스토그램을 메모리에 모아 Prometheus 텍스트 형식으로 내보낸다.
+
+    MetricsLog가 기록할 때마다 observe()로 같은 이벤트를 받는다.
+    """
+
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+    CONFIG_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+    METRICS = {
+        "scriptking_generation_requests_total": ("counter", "생성 요청 수 (cache=hit|miss)"),
+        "scriptking_generation_errors_total": ("counter", "실패한 생성 요청 수"),
+        "scriptking_generation_latency_seconds": ("histogram", "캐시를 거치지 않은 생성의 전체 소요 시간"),
+        "scriptking_generation_ttft_seconds": ("histogram", "스트리밍 생성의 첫 토큰까지 걸린 시간"),
+        "scriptking_generation_tokens_total": ("counter", "사용한 토큰 수 (type=prompt|completion)"),
+        "scriptking_llm_retries_total": ("counter", "OpenAI 호출 재시도 횟수"),
+        "scriptking_config_op_seconds": ("histogram", "설정 저장소 읽기/쓰기 소요 시간"),
+        "scriptking_active_sessions": ("gauge", f"최근 {ACTIVE_SESSION_WINDOW}초 안에 재실행된 세션 수"),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # (이름, 라벨 튜플) -> 값
+        self._histograms = {}  # (이름, 라벨 튜플) -> [버킷별 개수..., 합계, 개수]
+        self._sessions = {}
+        self.server = None
+
+    def inc(self, name: str, labels: dict, amount: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe_histogram(self, name: str, labels: dict, value: float, buckets: tuple):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.setdefault(key, [buckets, [0] * len(buckets), 0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[1][i] += 1
+            hist[2] += value
+            hist[3] += 1
+
+    def touch_session(self, session_id: str):
+        with self._lock:
+            self._sessions[session_id] = time.time()
+
+    def observe(self, event: dict):
+        if event["kind"] == "config":
+            self.observe_histogram(
+                "scriptking_config_op_seconds", {"op": event["op"]}, event["wall"], self.CONFIG_BUCKETS
+            )
+            return
+        labels = {"model": event["model"] or "", "op": event["op"]}
+        if event["error"]:
+            self.inc("scriptking_generation_errors_total", labels)
+            return
+        self.inc(
+            "scriptking_generation_requests_total",
+            dict(labels, cache="hit" if event["cache_hit"] else "miss"),
+        )
+        if event["cache_hit"]:
+            return
+        self.observe_histogram(
+            "scriptking_generation_latency_seconds", labels, event["wall"], self.LATENCY_BUCKETS
+        )
+        if event["ttft"] is not None:
+            self.observe_histogram(
+                "scriptking_generation_ttft_seconds", labels, event["ttft"], self.LATENCY_BUCKETS
+            )
+        for token_type in ("prompt", "completion"):
+            count = event[f"{token_type}_tokens"]
+            if count:
+                self.inc(
+                    "scriptking_generation_tokens_total",
+                    {"model": labels["model"], "type": token_type}, count,
+                )
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        parts = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+            parts.append(f'{key}="{value}"')
+        return "{" + ",".join(parts) + "}"
+
+    def render(self) -> str:
+        now = time.time()
+        with self._lock:
+            self._sessions = {
+                sid: seen for sid, seen in self._sessions.items()
+                if now - seen <= ACTIVE_SESSION_WINDOW
+            }
+            values = dict(self._values)
+            values[("scriptking_active_sessions", ())] = len(self._sessions)
+            histograms = {key: (h[0], list(h[1]), h[2], h[3]) for key, h in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text) in self.METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(buckets, counts):
+                        bucket_labels = labels + (("le", f"{bound:g}"),)
+                        lines.append(f"{name}_bucket{self._format_labels(bucket_labels)} {bucket_count}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host: str, port: int):
+        """/metrics를 응답하는 HTTP 서버를 데몬 스레드로 띄운다."""
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(
+            target=self.server.serve_forever, name="scriptking-prometheus", daemon=True
+        ).start()
+
+
+@st.cache_resource
+def get_prometheus_exporter() -> PrometheusExporter:
+    exporter = PrometheusExporter()
+    if PROMETHEUS_PORT:
+        try:
+            exporter.serve(PROMETHEUS_HOST, PROMETHEUS_PORT)
+        except OSError as e:
+            # 같은 포트를 쓰는 다른 프로세스가 있으면 엔드포인트 없이 계속 돈다.
+            logger.warning("/metrics 엔드포인트를 열지 못했습니다 (포트 %s): %s", PROMETHEUS_PORT, e)
+    return exporter
+
+
+class MetricsLog:
+    """LLM 호출·설정 읽기/쓰기의 소요 시간과 토큰을 쌓아두는 SQLite 로그.
+
+    보관 기간이 지나거나 행 수가 상한을 넘으면 오래된 것부터 지운다.
+    """
+
+    PRUNE_EVERY = 500
+    COLUMNS = ["ts", "kind", "op", "model", "set_id", "wall", "ttft",
+               "prompt_tokens", "completion_tokens", "cache_hit", "error"]
+
+    def __init__(self, path: str, retention: int, max_rows: int, observers=()):
+        self.retention = retention
+        self.max_rows = max_rows
+        self.observers = list(observers)
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                kind TEXT NOT NULL,
+                op TEXT NOT NULL,
+                model TEXT,
+                set_id TEXT,
+                wall REAL NOT NULL,
+                ttft REAL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                cache_hit INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_kind_ts ON events (kind, ts)")
+        self._conn.commit()
+
+    def record(self, kind: str, op: str, wall: float, model=None, set_id=None, ttft=None,
+               prompt_tokens=None, completion_tokens=None, cache_hit: bool = False, error=None):
+        event = {
+            "ts": time.time(), "kind": kind, "op": op, "model": model, "set_id": set_id,
+            "wall": wall, "ttft": ttft, "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens, "cache_hit": int(cache_hit), "error": error,
+        }
+        for observer in self.observers:
+            observer.observe(event)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO events ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in self.COLUMNS)})",
+                [event[column] for column in self.COLUMNS],
+            )
+            self._inserts += 1
+            if self._inserts % self.PRUNE_EVERY == 0:
+                self._prune()
+            self._conn.commit()
+
+    def _prune(self):
+        self._conn.execute("DELETE FROM events WHERE ts < ?", (time.time() - self.retention,))
+        self._conn.execute(
+            "DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?", (self.max_rows,)
+        )
+
+    def events(self, kind: str, since: float) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM events WHERE kind = ? AND ts >= ? ORDER BY ts",
+                (kind, since),
+            ).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM events")
+            self._conn.commit()
+
+
+@st.cache_resource
+def get_metrics_log() -> MetricsLog:
+    return MetricsLog(
+        METRICS_PATH, METRICS_RETENTION, METRICS_MAX_ROWS, observers=[get_prometheus_exporter()]
+    )
+
+
+class TimedConfigStore:
+    """저장소 메서드 호출을 감싸 읽기/쓰기 시간을 MetricsLog에 남긴다. 나머지는 그대로 넘긴다."""
+
+    TIMED_METHODS = {
+        "load", "save_all", "set_settings", "upsert_set", "update_set_field",
+        "delete_set", "touch_history", "history_page", "add_output",
+    }
+
+    def __init__(self, store, metrics: MetricsLog):
+        self._store = store
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if name not in self.TIMED_METHODS:
+            return attr
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            error = None
+            try:
+                return attr(*args, **kwargs)
+            except Exception as e:
+                error = str(e)
+                raise
+            finally:
+                self._metrics.record("config", name, time.perf_counter() - started, error=error)
+
+        return timed
+
+
+class CachedConfigStore:
+    """사용자 저장소 앞의 읽기 캐시. load()는 처음 한 번만 디스크를 읽고, 설정을 바꾸는 호출이 오면 다시 읽는다.
+
+    같은 사용자의 새 세션(새 탭·새로고침)도 캐시에서 바로 설정을 받는다.
+    """
+
+    WRITE_METHODS = {
+        "save_all", "set_settings", "upsert_set", "update_set_field",
+        "delete_set", "touch_history", "reset",
+    }
+    # 이 호출이 끝나면 observers에게 observe(이름, 인자)로 알린다 (주제 추천 색인 갱신).
+    NOTIFY_METHODS = {"save_all", "touch_history", "add_output", "reset"}
+
+    def __init__(self, store, observers=()):
+        self._store = store
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.observers = list(observers)
+
+    def load(self) -> dict:
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._store.load()
+            return json.loads(json.dumps(self._snapshot))
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if name not in self.WRITE_METHODS and name not in self.NOTIFY_METHODS:
+            return attr
+
+        def write(*args, **kwargs):
+            if name in self.WRITE_METHODS:
+                # 쓰는 동안 load()가 옛 내용을 다시 캐시하지 않도록 같은 잠금 안에서 쓴다.
+                with self._lock:
+                    self._snapshot = None
+                    result = attr(*args, **kwargs)
+            else:
+                result = attr(*args, **kwargs)
+            for observer in self.observers:
+                observer.observe(name, args)
+            return result
+
+        return write
+
+
+HANGUL_BASE = 0xAC00
+HANGUL_LAST = 0xD7A3
+CHOSEONG = "ㄱㄲㄴㄷㄸㄹㅁㅂㅃㅅㅆㅇㅈㅉㅊㅋㅌㅍㅎ"
+JUNGSEONG = "ㅏㅐㅑㅒㅓㅔㅕㅖㅗㅘㅙㅚㅛㅜㅝㅞㅟㅠㅡㅢㅣ"
+JONGSEONG = ["", *"ㄱㄲㄳㄴㄵㄶㄷㄹㄺㄻㄼㄽㄾㄿㅀㅁㅂㅄㅅㅆㅇㅈㅊㅋㅌㅍㅎ"]
+# 겹받침·겹모음은 입력 도중에 둘로 나뉘어 보이므로(닭 ← 달+ㄱ) 낱자로 풀어 둔다.
+COMPOUND_JAMO = {
+    "ㄳ": "ㄱㅅ", "ㄵ": "ㄴㅈ", "ㄶ": "ㄴㅎ", "ㄺ": "ㄹㄱ", "ㄻ": "ㄹㅁ", "ㄼ": "ㄹㅂ",
+    "ㄽ": "ㄹㅅ", "ㄾ": "ㄹㅌ", "ㄿ": "ㄹㅍ", "ㅀ": "ㄹㅎ", "ㅄ": "ㅂㅅ",
+    "ㅘ": "ㅗㅏ", "ㅙ": "ㅗㅐ", "ㅚ": "ㅗㅣ", "ㅝ": "ㅜㅓ", "ㅞ": "ㅜㅔ", "ㅟ": "ㅜㅣ", "ㅢ": "ㅡㅣ",
+}
+
+
+def _decompose_syllable(code: int) -> str:
+    jung, jong = JUNGSEONG[code % 588 // 28], JONGSEONG[code % 28]
+    return CHOSEONG[code // 588] + COMPOUND_JAMO.get(jung, jung) + COMPOUND_JAMO.get(jong, jong)
+
+
+# 음절마다 미리 풀어둔 str.translate 표. 글자 단위 파이썬 반복 없이 키를 만든다.
+JAMO_TABLE = {
+    HANGUL_BASE + code: _decompose_syllable(code) for code in range(HANGUL_LAST - HANGUL_BASE + 1)
+}
+JAMO_TABLE.update({ord(jamo): parts for jamo, parts in COMPOUND_JAMO.items()})
+CHOSEONG_TABLE = {
+    HANGUL_BASE + code: CHOSEONG[code // 588] for code in range(HANGUL_LAST - HANGUL_BASE + 1)
+}
+
+
+def jamo_key(text: str) -> str:
+    """한글 음절을 자모로 풀어 쓴 검색 키. '한구'가 '한국'의, '곽'이 '과기'의 접두어가 된다."""
+    return text.translate(JAMO_TABLE)
+
+
+def choseong_key(text: str) -> str:
+    """초성만 남긴 검색 키 ('ㅎㄱㄱㅈ' → 한국 경제)."""
+    return text.translate(CHOSEONG_TABLE)
+
+
+def is_choseong_query(text: str) -> bool:
+    return any(ch in CHOSEONG for ch in text) and all(
+        ch in CHOSEONG or not ("가" <= ch <= "힣" or "ㄱ" <= ch <= "ㅣ") for ch in text
+    )
+
+
+class TopicIndex:
+    """지난 주제와 생성 아카이브 주제의 접두어 색인 (주제 추천용, 사용자마다 하나).
+
+    주제의 각 낱말부터 끝까지를 자모 키·초성 키로 바꿔 정렬된 목록에 넣고, 검색어 키로 bisect해
+    그 키로 시작하는 구간만 훑는다. 처음 찾을 때 저장소에서 한 번 읽은 뒤로는 디스크를 보지 않고,
+    새 생성·주제 기록은 CachedConfigStore가 observe()로 알려줘서 바로 반영한다.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader  # () -> (history 행 목록, 아카이브 주제 행 목록)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._topics = {}  # 주제 -> [주제 기록 횟수, 아카이브 생성 수, 마지막 사용 시각]
+        self._jamo = []  # (자모 키, 주제, 낱말 위치) 정렬 목록
+        self._choseong = []
+
+    @staticmethod
+    def _keys(topic: str):
+        words = topic.casefold().split()
+        for i in range(len(words)):
+            rest = "".join(words[i:])
+            yield jamo_key(rest)[:TOPIC_INDEX_KEY_LENGTH], choseong_key(rest)[:TOPIC_INDEX_KEY_LENGTH], i
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        history, archive = self._loader()
+        for row in history:
+            self._topics[row["topic"]] = [row["count"], 0, row["used_at"]]
+        for row in archive:
+            entry = self._topics.setdefault(row["topic"], [0, 0, row["used_at"]])
+            entry[1] = row["count"]
+            entry[2] = max(entry[2], row["used_at"])
+        for topic in self._topics:
+            for jamo, cho, i in self._keys(topic):
+                self._jamo.append((jamo, topic, i))
+                self._choseong.append((cho, topic, i))
+        self._jamo.sort()
+        self._choseong.sort()
+        self._loaded = True
+
+    def _add(self, topic: str, history: int, archive: int):
+        entry = self._topics.get(topic)
+        if entry is None:
+            entry = self._topics[topic] = [0, 0, 0.0]
+            for jamo, cho, i in self._keys(topic):
+                bisect.insort(self._jamo, (jamo, topic, i))
+                bisect.insort(self._choseong, (cho, topic, i))
+        entry[0] += history
+        entry[1] += archive
+        entry[2] = time.time()
+
+    def observe(self, op: str, args: tuple):
+        with self._lock:
+            if op in ("save_all", "reset"):
+                # 기록을 통째로 바꿨으므로 다음 검색 때 다시 읽는다.
+                self._loaded = False
+                self._topics, self._jamo, self._choseong = {}, [], []
+            elif not self._loaded:
+                return  # 아직 읽기 전이면 나중에 저장소에서 함께 읽힌다.
+            elif op == "touch_history":
+                self._add(args[0], 1, 0)
+            elif op == "add_output":
+                self._add(args[0], 0, 1)
+
+    def lookup(self, query: str, limit: int = TOPIC_SUGGEST_LIMIT) -> list:
+        """검색어로 시작하는 낱말이 있는 주제. 앞에서 맞은 것, 많이 쓴 것, 최근 것 순."""
+        text = "".join(query.casefold().split())
+        if not text:
+            return []
+        with self._lock:
+            # 다른 세션이 색인을 비우면 목록 자체가 새로 바뀌므로, 잠금 안에서 불러온 뒤에 고른다.
+            self._ensure_loaded()
+            if is_choseong_query(text):
+                entries, key = self._choseong, text[:TOPIC_INDEX_KEY_LENGTH]
+            else:
+                entries, key = self._jamo, jamo_key(text)[:TOPIC_INDEX_KEY_LENGTH]
+            matches = {}
+            start = bisect.bisect_left(entries, (key,))
+            for entry_key, topic, word in entries[start:start + TOPIC_INDEX_SCAN]:
+                if not entry_key.startswith(key):
+                    break
+                # 주제 전체와 같으면 2, 주제 맨 앞에서 맞으면 1, 중간 낱말에서 맞으면 0
+                rank = (2 if entry_key == key else 1) if word == 0 else 0
+                matches[topic] = max(matches.get(topic, 0), rank)
+            ranked = heapq.nlargest(
+                limit, matches.items(),
+                key=lambda item: (item[1], self._topics[item[0]][0] + self._topics[item[0]][1],
+                                  self._topics[item[0]][2]),
+            )
+            return [
+                {"topic": topic, "count": self._topics[topic][0],
+                 "outputs": self._topics[topic][1], "used_at": self._topics[topic][2]}
+                for topic, _ in ranked
+            ]
+
+
+@st.cache_resource
+def get_topic_index(user_id: str) -> TopicIndex:
+    """사용자마다 하나씩 두는 주제 추천 색인 (프로세스 전체 공유)."""
+
+    def load():
+        store = get_user_config_store(user_id)
+        return store.history_all(), store.output_topics()
+
+    return TopicIndex(load)
+
+
+def current_user_id() -> str:
+    """이 세션의 사용자. 로그인 → 사용자 헤더(USER_HEADER를 켠 경우만) → DEFAULT_USER 순."""
+    if st.user.get("is_logged_in"):
+        user = st.user.get("email") or st.user.get("sub")
+        if user:
+            return str(user)
+    if USER_HEADER:
+        user = (st.context.headers.get(USER_HEADER) or "").strip()
+        if user:
+            return user
+    return DEFAULT_USER
+
+
+def user_paths(user_id: str):
+    """(config.json 경로, SQLite 경로). 기본 사용자만 예전 위치를 쓴다."""
+    if user_id == DEFAULT_USER:
+        return CONFIG_PATH, STORE_PATH
+    base = user_dir(user_id)
+    os.makedirs(base, exist_ok=True)
+    return os.path.join(base, "config.json"), os.path.join(base, "scriptking.db")
+
+
+@st.cache_resource
+def get_user_config_store(user_id: str):
+    """사용자마다 하나씩 여는 설정 저장소 (프로세스 전체 공유)."""
+    config_path, store_path = user_paths(user_id)
+    if STORAGE_ENGINE == "json":
+        store = JsonConfigStore(config_path, get_config_writer())
+    else:
+        store = SqliteConfigStore(store_path, config_path)
+    return CachedConfigStore(
+        TimedConfigStore(store, get_metrics_log()), observers=[get_topic_index(user_id)]
+    )
+
+
+def get_config_store():
+    return get_user_config_store(st.session_state.user_id)
+
+
+class TopicHistory:
+    """지난 주제 기록. 최근 주제는 메모리(OrderedDict)에, 전체 기록(횟수·시각)은 저장소에 둔다.
+
+    재실행마다 필요한 최근 목록과 자동완성 후보는 메모리에서 주고, 검색·페이지 이동만 저장소에 묻는다.
+    """
+
+    def __init__(self, store, cache_size: int = HISTORY_CACHE_SIZE):
+        self._store = store
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._recent = None  # 주제 -> 행, 오래된 것부터
+
+    def _warm(self):
+        if self._recent is None:
+            rows = self._store.history_recent(self._cache_size)
+            self._recent = OrderedDict((row["topic"], row) for row in reversed(rows))
+
+    def touch(self, topic: str) -> dict:
+        row = self._store.touch_history(topic)
+        with self._lock:
+            self._warm()
+            self._recent.pop(topic, None)
+            self._recent[topic] = row
+            while len(self._recent) > self._cache_size:
+                self._recent.popitem(last=False)
+        return row
+
+    def recent(self, limit: int) -> list:
+        """최근에 쓴 주제부터 limit개."""
+        with self._lock:
+            self._warm()
+            return list(islice(reversed(self._recent), limit))
+
+    def page(self, query: str, offset: int, limit: int, order: str):
+        return self._store.history_page(query, offset, limit, order)
+
+    def export(self) -> list:
+        return self._store.history_all()
+
+    def clear_cache(self):
+        """저장소 쪽 기록을 통째로 바꾼 뒤(초기화·불러오기) 부른다."""
+        with self._lock:
+            self._recent = None
+
+
+@st.cache_resource
+def get_topic_history(user_id: str) -> TopicHistory:
+    """사용자마다 하나씩 두는 주제 기록 (프로세스 전체 공유)."""
+    return TopicHistory(get_user_config_store(user_id))
+
+
+def topic_history() -> TopicHistory:
+    return get_topic_history(st.session_state.user_id)
+
+
+metrics_log = get_metrics_log()
+get_prometheus_exporter().touch_session(st.session_state.setdefault("session_id", uuid4().hex))
+st.session_state.setdefault("user_id", current_user_id())
+
+
+@st.cache_resource
+def get_request_scheduler() -> RequestScheduler:
+    exporter = get_prometheus_exporter()
+
+    def on_retry(model, reason):
+        exporter.inc("scriptking_llm_retries_total", {"model": model, "reason": str(reason)})
+
+    return RequestScheduler(
+        RATE_LIMIT_RPM, RATE_LIMIT_TPM, RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+        on_retry=on_retry,
+    )
+
+
+scheduler = get_request_scheduler()
+
+
+class FlightAbandoned(RuntimeError):
+    """먼저 시작한 요청이 결과를 알리지 않고 멈췄다 (재실행·중지로 빠져나갔거나 응답이 없음)."""
+
+
+class Flight:
+    """진행 중인 생성 하나. 조각이 올 때마다 기다리는 쪽을 깨운다."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def publish(self, chunks: list):
+        with self.cond:
+            self.chunks = chunks
+            self.cond.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self.cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+
+    def follow(self, on_delta=None):
+        """끝날 때까지 기다리며 새 조각을 on_delta로 넘긴다. 선행 요청이 실패했으면 같은 예외를 낸다."""
+        seen = 0
+        while True:
+            with self.cond:
+                while len(self.chunks) == seen and not self.done:
+                    if not self.cond.wait(FLIGHT_IDLE_TIMEOUT):
+                        raise FlightAbandoned("먼저 시작한 같은 요청에서 응답이 오지 않습니다.")
+                chunks = self.chunks
+                seen = len(chunks)
+                done = self.done
+            if on_delta is not None and chunks:
+                on_delta(chunks[:seen])
+            if done:
+                break
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """같은 (모델, system 프롬프트, user 프롬프트) 요청이 동시에 들어오면 한 번만 호출한다.
+
+    먼저 온 요청(leader)이 실제로 호출하고, 뒤에 온 요청은 그 결과를 조각 단위로 나눠 받는다.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.coalesced = 0
+
+    def begin(self, key: str):
+        """(Flight, leader 여부). leader는 끝나면 반드시 end()를 불러야 한다."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            return flight, True
+
+    def end(self, key: str, flight: Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._flights), "coalesced": self.coalesced}
+
+
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    return SingleFlight()
+
+
+single_flight = get_single_flight()
+
+
+def create_completion(reserved_tokens: int, **kwargs):
+    """모든 chat.completions.create 호출이 지나가는 곳. 한도와 재시도는 scheduler가 맡는다."""
+    return scheduler.call(
+        lambda: client.chat.completions.create(**kwargs), reserved_tokens, kwargs["model"]
+    )
+
+
+def load_config():
+    data = get_config_store().load()
+
+    for key in INST_KEYS:
+        if isinstance(data.get(key), str):
+            setattr(st.session_state, key, data[key])
+
+    st.session_state.history = topic_history().recent(HISTORY_SHOWN)[::-1]
+
+    if isinstance(data.get("instruction_sets"), list):
+        st.session_state.instruction_sets = data["instruction_sets"]
+    if "active_instruction_set_id" in data:
+        st.session_state.active_instruction_set_id = data["active_instruction_set_id"]
+
+
+def save_config():
+    """세션 상태 전체를 저장소에 한 번에 반영한다. 평소에는 아래 부분 갱신 함수들을 쓴다."""
+    data = {
+        "inst_role": st.session_state.inst_role,
+        "inst_tone": st.session_state.inst_tone,
+        "inst_structure": st.session_state.inst_structure,
+        "inst_depth": st.session_state.inst_depth,
+        "inst_forbidden": st.session_state.inst_forbidden,
+        "inst_format": st.session_state.inst_format,
+        "inst_user_intent": st.session_state.inst_user_intent,
+        "instruction_sets": st.session_state.get("instruction_sets", []),
+        "active_instruction_set_id": st.session_state.get("active_instruction_set_id"),
+    }
+    get_config_store().save_all(data)
+
+
+def save_active_state():
+    """현재 지침 내용과 활성 set id만 저장한다."""
+    values = {key: st.session_state.get(key, "") for key in INST_KEYS}
+    values["active_instruction_set_id"] = st.session_state.get("active_instruction_set_id")
+    get_config_store().set_settings(values)
+
+
+def reset_config():
+    get_config_store().reset()
+    topic_history().clear_cache()
+    config_path = user_paths(st.session_state.user_id)[0]
+    get_config_writer().discard(config_path)
+    if os.path.exists(config_path):
+        os.remove(config_path)
+
+    for key in [
+        "inst_role",
+        "inst_tone",
+        "inst_structure",
+        "inst_depth",
+        "inst_forbidden",
+        "inst_format",
+        "inst_user_intent",
+        "history",
+        "history_query",
+        "history_order",
+        "history_page",
+        "topic_query",
+        "rerun_topic",
+        "current_input",
+        "last_output",
+        "output_editor",
+        "model_choice",
+        "stream_output",
+        "pending_generation",
+        "generation_error",
+        "last_metrics",
+        "generation_metrics",
+        "force_regenerate",
+        "longform_mode",
+        "batch_results",
+        "background_jobs",
+        "my_jobs",
+        "compare_models",
+        "compare_results",
+        "experiment_results",
+        "instruction_sets",
+        "instset_registry",
+        "active_instruction_set_id",
+        "show_instruction_set_editor",
+        "edit_instruction_set_id",
+        "instset_toolbar_run_id",
+        "instset_delete_mode",
+        "instset_query",
+        "instset_filter",
+        "instset_page",
+        "instset_del_query",
+        "instset_del_page",
+        "instset_delete_target",
+        "show_reset_confirm",
+        "reset_input_value",
+    ]:
+        if key in st.session_state:
+            del st.session_state[key]
+
+    if "config_loaded" in st.session_state:
+        del st.session_state["config_loaded"]
+
+    st.rerun()
+
+
+def search_text(text: str) -> str:
+    """검색 비교용: 대소문자·공백 차이를 없앤다."""
+    return " ".join(str(text).casefold().split())
+
+
+def fuzzy_score(query: str, text: str) -> float:
+    """query가 text에 얼마나 맞는지 (0이면 안 맞음). 앞부분 일치 > 단어 앞부분 > 포함 > 글자 순서 > 오타 허용."""
+    if not query or not text:
+        return 0.0
+    if text.startswith(query):
+        return 4 + len(query) / len(text)
+    if any(word.startswith(query) for word in text.split()):
+        return 3 + len(query) / len(text)
+    if query in text:
+        return 2 + len(query) / len(text)
+    # 글자가 순서대로 다 들어 있으면 (예: "다기" → "다큐 기본셋") 모여 있을수록 높게 친다.
+    # 공백은 맞춘 글자로 세지 않고, 포함(2점대)보다는 항상 낮게 1점대 안에서만 준다.
+    compact = text.replace(" ", "")
+    chars = query.replace(" ", "")
+    pos, first = -1, None
+    for ch in chars:
+        pos = compact.find(ch, pos + 1)
+        if pos < 0:
+            break
+        first = pos if first is None else first
+    else:
+        if first is not None:
+            return 1 + 0.99 * len(chars) / (pos - first + 1)
+    # 오타 한두 글자는 봐준다: 비슷한 길이의 단어와 비교
+    ratio = max(
+        difflib.SequenceMatcher(None, query, word).ratio()
+        for word in (text, *text.split())
+    )
+    return ratio if ratio >= INSTSET_FUZZY_CUTOFF else 0.0
+
+
+class InstructionSetRegistry:
+    """세션의 지침 set 색인: id → set, id → 위치, 화면에 쓰는 이름, 이름·태그 검색.
+
+    sets는 st.session_state.instruction_sets와 같은 리스트다. 추가·수정·삭제는 이 클래스를 거쳐
+    색인도 그 자리에서 고친다. 목록이 통째로 바뀌면(불러오기·초기화) instruction_set_registry()가 새로 만든다.
+    """
+
+    def __init__(self, sets: list):
+        self.sets = sets
+        self._by_id = {s.get("id"): s for s in sets}
+        self._pos = {s.get("id"): i for i, s in enumerate(sets)}
+        self._labels = {}
+        self._search_keys = {}
+        self._names = None
+        self._results = {}
+
+    def __len__(self):
+        return len(self.sets)
+
+    def get(self, set_id):
+        return self._by_id.get(set_id)
+
+    def index(self, set_id, default: int = 0) -> int:
+        return self._pos.get(set_id, default)
+
+    def name(self, i: int) -> str:
+        return self.sets[i].get("name", f"셋 {i+1}")
+
+    def label(self, i: int) -> str:
+        """선택 목록에 보이는 '이름 · 토큰 수'. 화면에 보이는 set만, 처음 볼 때 만든다."""
+        set_id = self.sets[i].get("id")
+        label = self._labels.get(set_id)
+        if label is None:
+            label = f"{self.name(i)} · {compiled_prompt_for(self.sets[i])['tokens']:,}tok"
+            self._labels[set_id] = label
+        return label
+
+    def names(self) -> dict:
+        """id → 이름 (지표·실험 표에서 쓴다)."""
+        if self._names is None:
+            self._names = {s.get("id"): s.get("name", s.get("id")) for s in self.sets}
+        return self._names
+
+    def _forget(self, set_id):
+        self._labels.pop(set_id, None)
+        self._search_keys.pop(set_id, None)
+        self._results.clear()
+        self._names = None
+
+    def add(self, set_obj: dict):
+        set_id = set_obj.get("id")
+        self.sets.append(set_obj)
+        self._by_id[set_id] = set_obj
+        self._pos[set_id] = len(self.sets) - 1
+        self._forget(set_id)
+
+    def update(self, set_obj: dict):
+        """내용이 바뀐 set의 색인·이름만 다시 만든다."""
+        set_id = set_obj.get("id")
+        i = self._pos.get(set_id)
+        if i is None:
+            self.add(set_obj)
+            return
+        self.sets[i] = set_obj
+        self._by_id[set_id] = set_obj
+        self._forget(set_id)
+
+    def remove(self, set_id):
+        i = self._pos.pop(set_id, None)
+        if i is None:
+            return None
+        removed = self.sets.pop(i)
+        del self._by_id[set_id]
+        self._forget(set_id)
+        # 뒤쪽 set만 한 칸씩 당긴다. 이름 없는 set은 '셋 N' 번호가 바뀌므로 이름도 다시 만든다.
+        for j in range(i, len(self.sets)):
+            self._pos[self.sets[j].get("id")] = j
+            if "name" not in self.sets[j]:
+                self._forget(self.sets[j].get("id"))
+        return removed
+
+    def _search_key(self, i: int):
+        set_id = self.sets[i].get("id")
+        key = self._search_keys.get(set_id)
+        if key is None:
+            tags = self.sets[i].get("tags") or []
+            key = (search_text(self.name(i)), [search_text(t) for t in tags])
+            self._search_keys[set_id] = key
+        return key
+
+    def _cached(self, key, build):
+        # 같은 검색어로 페이지만 넘기는 재실행은 다시 찾지 않는다. 목록이 바뀌면 _forget이 비운다.
+        if key not in self._results:
+            if len(self._results) >= INSTSET_SEARCH_CACHE:
+                self._results.clear()
+            self._results[key] = build()
+        return self._results[key]
+
+    def search(self, query: str) -> list:
+        """이름·태그로 찾은 set 위치 목록 (잘 맞는 순). 검색어가 없으면 전체를 원래 순서대로."""
+        query = search_text(query)
+        if not query:
+            return list(range(len(self.sets)))
+
+        def build():
+            scored = []
+            for i in range(len(self.sets)):
+                name_key, tag_keys = self._search_key(i)
+                score = max(
+                    [fuzzy_score(query, name_key), *(fuzzy_score(query, t) * 0.9 for t in tag_keys)]
+                )
+                if score > 0:
+                    scored.append((-score, i))
+            scored.sort()
+            return [i for _, i in scored]
+
+        return self._cached(("search", query), build)
+
+    def favorites(self) -> list:
+        return self._cached(
+            ("favorites",), lambda: [i for i, s in enumerate(self.sets) if s.get("favorite")]
+        )
+
+    def recent(self, limit: int) -> list:
+        """최근에 고른 set 위치 (최근 순)."""
+
+        def build():
+            used = [(s.get("last_used_at") or 0, i) for i, s in enumerate(self.sets)]
+            return [i for used_at, i in heapq.nlargest(limit, used) if used_at]
+
+        return self._cached(("recent", limit), build)
+
+    def view(self, query: str, mode: str) -> list:
+        """선택기에 보일 set 위치: 검색 결과를 보기 모드(all / favorites / recent)로 거른다."""
+
+        def build():
+            found = self.search(query)
+            if mode == "favorites":
+                favorites = set(self.favorites())
+                return [i for i in found if i in favorites]
+            if mode == "recent":
+                hits = set(found)
+                return [i for i in self.recent(INSTSET_RECENT_LIMIT) if i in hits]
+            return found
+
+        return self._cached(("view", mode, search_text(query)), build)
+
+
+def instruction_set_registry() -> InstructionSetRegistry:
+    sets = st.session_state.instruction_sets
+    registry = st.session_state.get("instset_registry")
+    if registry is None or registry.sets is not sets:
+        registry = InstructionSetRegistry(sets)
+        st.session_state.instset_registry = registry
+    return registry
+
+
+def set_reset_confirm(show: bool):
+    st.session_state.show_reset_confirm = show
+    st.session_state.reset_input_value = ""
+
+
+def apply_instruction_set(set_obj: dict):
+    for key in [
+        "inst_role",
+        "inst_tone",
+        "inst_structure",
+        "inst_depth",
+        "inst_forbidden",
+        "inst_format",
+        "inst_user_intent",
+    ]:
+        if key in set_obj:
+            setattr(st.session_state, key, set_obj.get(key, ""))
+    compiled_prompt_for(set_obj)
+    save_active_state()
+
+
+def select_instruction_set(set_id: str):
+    """선택기에서 set을 골랐을 때. 최근 사용 시각도 남긴다."""
+    registry = instruction_set_registry()
+    set_obj = registry.get(set_id)
+    if set_obj is None:
+        return
+    st.session_state.active_instruction_set_id = set_id
+    apply_instruction_set(set_obj)
+    set_obj["last_used_at"] = time.time()
+    registry.update(set_obj)
+    get_config_store().update_set_field(set_id, "last_used_at", set_obj["last_used_at"])
+
+
+def toggle_favorite_set(set_id: str):
+    registry = instruction_set_registry()
+    set_obj = registry.get(set_id)
+    if set_obj is None:
+        return
+    set_obj["favorite"] = not set_obj.get("favorite")
+    registry.update(set_obj)
+    get_config_store().update_set_field(set_id, "favorite", set_obj["favorite"])
+
+
+def set_list_page(page_key: str, page: int):
+    st.session_state[page_key] = page
+
+
+def pick_delete_target(set_id: str):
+    st.session_state.instset_delete_target = set_id
+
+
+def instset_page_slice(positions: list, page_key: str, start_at: int = 0):
+    """positions 중 지금 페이지 몫만 (window, page, pages)로. 처음 열 때는 start_at이 있는 페이지."""
+    pages = max(1, math.ceil(len(positions) / INSTSET_PAGE_SIZE))
+    page = st.session_state.get(page_key)
+    if page is None:
+        page = start_at // INSTSET_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    st.session_state[page_key] = page
+    return positions[page * INSTSET_PAGE_SIZE:(page + 1) * INSTSET_PAGE_SIZE], page, pages
+
+
+def list_page_controls(page_key: str, page: int, pages: int, total: int):
+    if pages <= 1:
+        return
+    col_prev, col_info, col_next = st.columns([1, 2, 1])
+    with col_prev:
+        st.button(
+            "◀ 이전", key=f"{page_key}_prev", disabled=page == 0, use_container_width=True,
+            on_click=set_list_page, args=(page_key, page - 1),
+        )
+    with col_info:
+        st.markdown(
+            f"<div style='text-align:center; font-size:0.8rem; color:#6b7280; padding-top:0.5rem;'>"
+            f"{page + 1} / {pages} 페이지 · {total:,}개</div>",
+            unsafe_allow_html=True,
+        )
+    with col_next:
+        st.button(
+            "다음 ▶", key=f"{page_key}_next", disabled=page >= pages - 1, use_container_width=True,
+            on_click=set_list_page, args=(page_key, page + 1),
+        )
+
+
+def sync_active_set_field(field_name: str, value: str):
+    active_id = st.session_state.get("active_instruction_set_id")
+    if not active_id or not st.session_state.get("instruction_sets"):
+        return
+    registry = instruction_set_registry()
+    active_set = registry.get(active_id)
+    if active_set is not None:
+        active_set[field_name] = value
+        invalidate_compiled_prompt(active_set)
+        registry.update(active_set)
+    store = get_config_store()
+    store.update_set_field(active_id, field_name, value)
+    store.set_settings({field_name: value})
+
+
+def ensure_active_set_applied():
+    active_id = st.session_state.get("active_instruction_set_id")
+    if not st.session_state.get("instruction_sets") or not active_id:
+        return
+    active_set = instruction_set_registry().get(active_id)
+    if active_set:
+        for key in [
+            "inst_role",
+            "inst_tone",
+            "inst_structure",
+            "inst_depth",
+            "inst_forbidden",
+            "inst_format",
+            "inst_user_intent",
+        ]:
+            if key in active_set:
+                setattr(st.session_state, key, active_set.get(key, ""))
+
+
+@st.cache_resource
+def get_token_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception:  # 인코딩 파일을 내려받지 못한 경우 등
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # tiktoken이 없을 때: 한글은 대략 글자당 1토큰, 영문/숫자는 4글자당 1토큰으로 본다.
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def parse_length_target(format_text: str):
+    """'전체 분량은 500자 이상' 같은 문장에서 목표 글자 수를 읽는다. 없으면 None."""
+    match = re.search(r"(\d[\d,]*)\s*자", format_text or "")
+    if not match:
+        return None
+    return int(match.group(1).replace(",", ""))
+
+
+def resolve_max_tokens(source) -> int:
+    """set의 max_tokens 지정값이 있으면 그대로, 없으면 목표 길이로 출력 토큰 예산을 정한다."""
+    override = source.get("max_tokens")
+    if isinstance(override, int) and override > 0:
+        return min(override, MAX_OUTPUT_TOKENS)
+    target_chars = parse_length_target(source.get("inst_format", ""))
+    if target_chars is None:
+        return DEFAULT_MAX_TOKENS
+    budget = math.ceil(target_chars * KOREAN_TOKENS_PER_CHAR * LENGTH_HEADROOM)
+    return max(DEFAULT_MAX_TOKENS, min(budget, MAX_OUTPUT_TOKENS))
+
+
+def compile_prompt(source) -> dict:
+    """지침 set(또는 세션 상태)으로 system 프롬프트 완성본과 해시·토큰 수·미리보기를 만든다."""
+    text = compose_system_text(source)
+    return {
+        "text": text,
+        "hash": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        "tokens": count_tokens(text),
+        "max_tokens": resolve_max_tokens(source),
+        "format_text": source.get("inst_format", ""),
+        "preview": build_instruction_preview(source),
+    }
+
+
+def estimate_input_tokens(compiled: dict, user_text: str) -> int:
+    return compiled["tokens"] + count_tokens(user_text) + 2 * MESSAGE_TOKEN_OVERHEAD
+
+
+def compiled_prompt_for(set_obj: dict) -> dict:
+    """set에 붙여둔 컴파일 결과를 쓰고, 없을 때만 새로 만든다. ('_' 키라 저장되지 않는다.)"""
+    compiled = set_obj.get("_compiled")
+    if compiled is None:
+        compiled = compile_prompt(set_obj)
+        set_obj["_compiled"] = compiled
+    return compiled
+
+
+def invalidate_compiled_prompt(set_obj: dict):
+    set_obj.pop("_compiled", None)
+
+
+def active_instruction_set():
+    if not st.session_state.get("instruction_sets"):
+        return None
+    return instruction_set_registry().get(st.session_state.get("active_instruction_set_id"))
+
+
+def active_compiled_prompt() -> dict:
+    active_set = active_instruction_set()
+    if active_set is None:
+        return compile_prompt(st.session_state)
+    return compiled_prompt_for(active_set)
+
+
+class ResponseCache:
+    """(모델, system 프롬프트, user 프롬프트) 해시를 키로 하는 디스크 응답 캐시.
+
+    TTL이 지난 항목은 조회 시 버리고, 항목 수나 총 용량이 상한을 넘으면
+    가장 오래 조회되지 않은 항목부터 지운다(LRU).
+    """
+
+    def __init__(self, path: str, ttl: int, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                output TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, system_hash: str, user_text: str, max_tokens: int) -> str:
+        payload = json.dumps([model, system_hash, user_text, max_tokens], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT output, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            output, created_at = row
+            if now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            return output
+
+    def put(self, key: str, model: str, output: str):
+        now = time.time()
+        size = len(output.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, model, output, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, output, size, now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        self._conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+        )
+        count, total = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall()
+        doomed = []
+        for key, size in rows:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {"entries": count, "bytes": total}
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(
+        RESPONSE_CACHE_PATH,
+        ttl=RESPONSE_CACHE_TTL,
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    )
+
+
+class GenerationJobQueue:
+    """생성 요청을 작업 스레드에서 실행하고 작업 id로 상태를 조회하게 해주는 큐.
+
+    작업은 세션이 아니라 프로세스에 속하므로 페이지를 새로 고쳐도 진행이 이어진다.
+    run(on_update)는 세션 상태를 건드리지 않는 함수여야 한다.
+    """
+
+    def __init__(self, max_workers: int, keep: int):
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scriptking-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, request: dict, run) -> str:
+        job_id = uuid4().hex[:12]
+        job = {
+            "id": job_id,
+            "mode": request.get("mode", "stream"),
+            "topic": request["topic"],
+            "model": request["model"],
+            "set_id": request.get("set_id"),
+            "status": "queued",
+            "partial": "",
+            "result": None,
+            "error": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            while len(self._jobs) > self.keep:
+                self._jobs.popitem(last=False)
+        self._pool.submit(self._run, job, run)
+        return job_id
+
+    def _run(self, job: dict, run):
+        job["status"] = "running"
+        job["started_at"] = time.time()
+
+        def on_update(partial):
+            # 스트리밍은 조각 목록을 그대로 넘기므로 읽을 때 한 번만 합친다.
+            job["partial"] = partial
+
+        try:
+            job["result"] = run(on_update)
+            job["status"] = "done"
+        except Exception as e:
+            job["error"] = str(e)
+            job["status"] = "failed"
+        job["finished_at"] = time.time()
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        snapshot = dict(job)
+        if isinstance(snapshot["partial"], list):
+            snapshot["partial"] = "".join(snapshot["partial"])
+        return snapshot
+
+    def get_many(self, job_ids: list) -> list:
+        return [job for job in (self.get(job_id) for job_id in job_ids) if job is not None]
+
+
+@st.cache_resource
+def get_job_queue() -> GenerationJobQueue:
+    return GenerationJobQueue(JOB_MAX_WORKERS, JOB_KEEP)
+
+
+def compose_system_text(source) -> str:
+    """7개 지침(inst_*)을 순서대로 이어 붙여 system 프롬프트를 만든다."""
+    system_parts = [source.get(key, "") for key in INST_KEYS]
+    return "\n\n".join(
+        part.strip() for part in system_parts if isinstance(part, str) and part.strip()
+    )
+
+
+def build_user_text(topic: str) -> str:
+    return f"다음 주제에 맞는 다큐멘터리 내레이션을 작성해줘.\n\n주제: {topic}"
+
+
+def generate_text(model: str, compiled: dict, user_text: str, cache: ResponseCache,
+                  force: bool = False, set_id=None, op: str = "generate") -> dict:
+    """세션 상태를 건드리지 않는 단일 생성. 일괄 생성의 작업 스레드에서도 호출된다."""
+    started = time.perf_counter()
+    cache_key = ResponseCache.make_key(model, compiled["hash"], user_text, compiled["max_tokens"])
+    if not force:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            metrics_log.record(
+                "llm", op, time.perf_counter() - started, model=model, set_id=set_id, cache_hit=True
+            )
+            return {
+                "text": cached,
+                "latency": time.perf_counter() - started,
+                "cache_hit": True,
+                "truncated": False,
+                "cache_key": cache_key,
+                "usage": usage_to_dict(None),
+            }
+
+    flight, leader = single_flight.begin(cache_key)
+    if not leader:
+        # 같은 요청이 이미 진행 중이면 호출하지 않고 그 결과를 받는다.
+        try:
+            shared = follow_flight(flight, model, set_id, started)
+        except FlightAbandoned:
+            # 먼저 시작한 요청이 중간에 멈췄으면 그 자리를 비우고 직접 다시 요청한다.
+            single_flight.end(cache_key, flight)
+            return generate_text(model, compiled, user_text, cache, force, set_id, op)
+        return {
+            "text": shared["text"],
+            "latency": time.perf_counter() - started,
+            "cache_hit": True,
+            "coalesced": True,
+            "truncated": shared["truncated"],
+            "cache_key": cache_key,
+            "usage": usage_to_dict(None),
+        }
+
+    try:
+        res = create_completion(
+            estimate_input_tokens(compiled, user_text) + compiled["max_tokens"],
+            model=model,
+            messages=[
+                {"role": "system", "content": compiled["text"]},
+                {"role": "user", "content": user_text},
+            ],
+            max_tokens=compiled["max_tokens"],
+        )
+        text = res.choices[0].message.content or ""
+        truncated = res.choices[0].finish_reason == "length"
+        flight.finish(result={"text": text, "truncated": truncated})
+    except Exception as e:
+        metrics_log.record(
+            "llm", op, time.perf_counter() - started, model=model, set_id=set_id, error=str(e)
+        )
+        flight.finish(error=e)
+        raise
+    finally:
+        if not flight.done:
+            # 재실행·중지(BaseException)로 빠져나가도 기다리던 쪽이 멈춰 있지 않게 끝을 알린다.
+            flight.finish(error=FlightAbandoned("먼저 시작한 같은 요청이 중단되었습니다."))
+        single_flight.end(cache_key, flight)
+    latency = time.perf_counter() - started
+    usage = usage_to_dict(res.usage)
+    metrics_log.record("llm", op, latency, model=model, set_id=set_id, **usage)
+    # 잘린 결과는 캐시에 남기지 않아 다음 요청이 다시 생성하도록 한다.
+    if text and not truncated:
+        cache.put(cache_key, model, text)
+    return {
+        "text": text,
+        "latency": latency,
+        "cache_hit": False,
+        "truncated": truncated,
+        "cache_key": cache_key,
+        "usage": usage,
+    }
+
+
+def follow_flight(flight: Flight, model: str, set_id, started: float, on_delta=None) -> dict:
+    """다른 요청이 진행 중인 생성에 붙어 결과를 받는다. 호출하지 않았으므로 캐시 적중으로 기록한다."""
+    try:
+        shared = flight.follow(on_delta)
+    except Exception as e:
+        metrics_log.record(
+            "llm", "coalesced", time.perf_counter() - started, model=model, set_id=set_id,
+            error=str(e),
+        )
+        raise
+    metrics_log.record(
+        "llm", "coalesced", time.perf_counter() - started, model=model, set_id=set_id, cache_hit=True
+    )
+    return shared
+
+
+def usage_to_dict(usage) -> dict:
+    if usage is None:
+        return {"prompt_tokens": None, "completion_tokens": None}
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+    }
+
+
+def parse_batch_topics(raw_text: str, uploaded_file) -> list:
+    """입력창의 줄 단위 주제와 업로드한 txt/csv의 첫 열을 합쳐 중복 없이 돌려준다."""
+    lines = raw_text.splitlines()
+    if uploaded_file is not None:
+        content = uploaded_file.getvalue().decode("utf-8-sig")
+        if uploaded_file.name.lower().endswith(".csv"):
+            rows = list(csv.reader(io.StringIO(content)))
+            if rows and rows[0] and rows[0][0].strip().lower() in ("topic", "주제"):
+                rows = rows[1:]
+            lines += [row[0] for row in rows if row]
+        else:
+            lines += content.splitlines()
+
+    topics = []
+    seen = set()
+    for line in lines:
+        topic = line.strip()
+        if topic and topic not in seen:
+            seen.add(topic)
+            topics.append(topic)
+    return topics
+
+
+def run_batch_generation(topics: list, concurrency: int, table_placeholder, progress) -> list:
+    """현재 지침으로 여러 주제를 스레드 풀에 나눠 생성하고, 끝나는 순서대로 표를 갱신한다."""
+    model = st.session_state.model_choice
+    compiled = active_compiled_prompt()
+    force = st.session_state.force_regenerate
+    cache = get_response_cache()
+    store = get_config_store()
+    set_id = st.session_state.active_instruction_set_id
+
+    rows = [
+        {"주제": topic, "상태": "대기", "글자 수": 0, "소요(초)": None, "캐시": "", "잘림": ""}
+        for topic in topics
+    ]
+    results = [None] * len(topics)
+    table_placeholder.dataframe(rows, use_container_width=True)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {
+            pool.submit(
+                generate_text, model, compiled, build_user_text(topic), cache, force, set_id, "batch"
+            ): i
+            for i, topic in enumerate(topics)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                result = future.result()
+            except Exception as exc:
+                rows[i]["상태"] = f"실패: {exc}"
+                results[i] = {"topic": topics[i], "text": "", "error": str(exc)}
+            else:
+                rows[i].update({
+                    "상태": "완료",
+                    "글자 수": len(result["text"]),
+                    "소요(초)": round(result["latency"], 2),
+                    "캐시": "✓" if result["cache_hit"] else "",
+                    "잘림": "⚠️" if result["truncated"] else "",
+                })
+                results[i] = {"topic": topics[i], "text": result["text"], "error": None}
+                if not result["cache_hit"]:
+                    store.add_output(
+                        topics[i], set_id, model, result["text"],
+                        cache_key=result["cache_key"],
+                        latency=result["latency"],
+                        **result["usage"],
+                    )
+            table_placeholder.dataframe(rows, use_container_width=True)
+            progress.progress(done / len(topics), text=f"{done}/{len(topics)} 완료")
+
+    return results
+
+
+def estimate_cost(model: str, prompt_tokens, completion_tokens):
+    """단가표에 없는 모델이거나 토큰 수를 모르면 None."""
+    prices = MODEL_PRICES.get(model)
+    if prices is None or prompt_tokens is None or completion_tokens is None:
+        return None
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+
+
+def run_model_comparison(topic: str, models: list) -> dict:
+    """같은 system/user 프롬프트를 여러 모델에 동시에 보내고 모델 순서대로 결과를 돌려준다."""
+    compiled = active_compiled_prompt()
+    user_text = build_user_text(topic)
+    force = st.session_state.force_regenerate
+    cache = get_response_cache()
+    store = get_config_store()
+    set_id = st.session_state.active_instruction_set_id
+
+    results = [None] * len(models)
+    with ThreadPoolExecutor(max_workers=len(models)) as pool:
+        futures = {
+            pool.submit(generate_text, model, compiled, user_text, cache, force, set_id, "compare"): i
+            for i, model in enumerate(models)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            model = models[i]
+            try:
+                result = future.result()
+            except Exception as exc:
+                results[i] = {"model": model, "text": "", "error": str(exc)}
+                continue
+            usage = result["usage"]
+            # 캐시에서 온 결과는 usage가 없으므로 토큰 수를 직접 세어 비용을 추정한다.
+            estimated = usage["prompt_tokens"] is None
+            prompt_tokens = estimate_input_tokens(compiled, user_text) if estimated else usage["prompt_tokens"]
+            completion_tokens = count_tokens(result["text"]) if estimated else usage["completion_tokens"]
+            results[i] = {
+                "model": model,
+                "text": result["text"],
+                "error": None,
+                "latency": result["latency"],
+                "cache_hit": result["cache_hit"],
+                "truncated": result["truncated"],
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "estimated": estimated,
+                "cost": estimate_cost(model, prompt_tokens, completion_tokens),
+            }
+            if not result["cache_hit"]:
+                store.add_output(
+                    topic, set_id, model, result["text"],
+                    cache_key=result["cache_key"],
+                    latency=result["latency"],
+                    **usage,
+                )
+    return {"topic": topic, "set_id": set_id, "results": results}
+
+
+def score_output(text: str, compiled: dict, truncated: bool) -> dict:
+    """간단한 품질 지표: 목표 길이 달성 여부와 잘림."""
+    target = parse_length_target(compiled.get("format_text", ""))
+    length = len(text.strip())
+    return {
+        "length": length,
+        "target": target,
+        "length_met": None if target is None else length >= target,
+        "truncated": truncated,
+    }
+
+
+def run_set_experiment(topics: list, set_ids: list, concurrency: int, progress) -> dict:
+    """주제 × 지침 set 조합을 모두 같은 모델로 생성해 set끼리 비교할 결과를 모은다."""
+    model = st.session_state.model_choice
+    force = st.session_state.force_regenerate
+    cache = get_response_cache()
+    store = get_config_store()
+    registry = instruction_set_registry()
+    compiled_by_set = {set_id: compiled_prompt_for(registry.get(set_id)) for set_id in set_ids}
+
+    pairs = [(topic, set_id) for topic in topics for set_id in set_ids]
+    cells = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {
+            pool.submit(
+                generate_text, model, compiled_by_set[set_id], build_user_text(topic), cache, force,
+                set_id, "experiment",
+            ): (topic, set_id)
+            for topic, set_id in pairs
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            topic, set_id = futures[future]
+            compiled = compiled_by_set[set_id]
+            try:
+                result = future.result()
+            except Exception as exc:
+                cells[(topic, set_id)] = {"error": str(exc)}
+            else:
+                usage = result["usage"]
+                cells[(topic, set_id)] = {
+                    "error": None,
+                    "latency": result["latency"],
+                    "cache_hit": result["cache_hit"],
+                    "completion_tokens": (
+                        usage["completion_tokens"]
+                        if usage["completion_tokens"] is not None
+                        else count_tokens(result["text"])
+                    ),
+                    **score_output(result["text"], compiled, result["truncated"]),
+                }
+                if not result["cache_hit"]:
+                    store.add_output(
+                        topic, set_id, model, result["text"],
+                        cache_key=result["cache_key"],
+                        latency=result["latency"],
+                        **usage,
+                    )
+            progress.progress(done / len(pairs), text=f"{done}/{len(pairs)} 완료")
+
+    return {"model": model, "topics": topics, "set_ids": set_ids, "cells": cells}
+
+
+def summarize_experiment(experiment: dict, set_names: dict) -> list:
+    """set별 평균 소요·출력 토큰·글자 수와 목표 길이 달성률."""
+    rows = []
+    for set_id in experiment["set_ids"]:
+        ok = [
+            cell for (topic, sid), cell in experiment["cells"].items()
+            if sid == set_id and not cell["error"]
+        ]
+        fresh = [cell for cell in ok if not cell["cache_hit"]]
+        judged = [cell for cell in ok if cell["length_met"] is not None]
+        rows.append({
+            "지침 set": set_names.get(set_id, set_id),
+            "성공": f"{len(ok)}/{len(experiment['topics'])}",
+            "평균 소요(초, 새 생성)": (
+                round(sum(c["latency"] for c in fresh) / len(fresh), 2) if fresh else None
+            ),
+            "평균 출력 토큰": round(sum(c["completion_tokens"] for c in ok) / len(ok)) if ok else None,
+            "평균 글자 수": round(sum(c["length"] for c in ok) / len(ok)) if ok else None,
+            "목표 길이 달성": (
+                f"{sum(c['length_met'] for c in judged)}/{len(judged)}" if judged else "목표 없음"
+            ),
+            "잘림": sum(c["truncated"] for c in ok),
+        })
+    return rows
+
+
+def experiment_matrix(experiment: dict, set_names: dict) -> list:
+    """행은 주제, 열은 set. 칸마다 글자 수 · 소요 시간 · 목표 달성 표시."""
+    rows = []
+    for topic in experiment["topics"]:
+        row = {"주제": topic}
+        for set_id in experiment["set_ids"]:
+            cell = experiment["cells"].get((topic, set_id))
+            if cell is None or cell["error"]:
+                text = "실패" if cell else "-"
+            else:
+                mark = {True: "✓", False: "✗", None: ""}[cell["length_met"]]
+                if cell["truncated"]:
+                    mark += "⚠️"
+                source = "캐시" if cell["cache_hit"] else f"{cell['latency']:.1f}초"
+                text = f"{cell['length']:,}자 {mark} · {source}"
+            row[set_names.get(set_id, set_id)] = text
+        rows.append(row)
+    return rows
+
+
+def build_batch_bundle(results: list) -> bytes:
+    """일괄 생성 결과를 주제별 txt + 요약 csv로 묶은 zip 바이트."""
+    buf = io.BytesIO()
+    summary = io.StringIO()
+    writer = csv.writer(summary)
+    writer.writerow(["번호", "주제", "파일", "오류"])
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i, item in enumerate(results, start=1):
+            safe_topic = "".join(c if c.isalnum() else "_" for c in item["topic"])[:40]
+            file_name = f"{i:03d}_{safe_topic}.txt" if not item["error"] else ""
+            if file_name:
+                zf.writestr(file_name, item["text"])
+            writer.writerow([i, item["topic"], file_name, item["error"] or ""])
+        zf.writestr("summary.csv", "\ufeff" + summary.getvalue())
+    return buf.getvalue()
+
+
+def set_last_output(text: str):
+    """결과 영역에 보여줄 대본을 바꾼다. 결과 편집기(output_editor)는 key가 있는 위젯이라
+    value=로는 바뀌지 않으므로 위젯 값도 같이 바꾼다. 결과 편집기를 그리기 전에만 부른다."""
+    st.session_state.last_output = text
+    st.session_state.output_editor = text
+
+
+def keep_output_edit():
+    # 사용자가 결과 편집기에서 고친 내용만 last_output에 반영한다.
+    st.session_state.last_output = st.session_state.output_editor
+
+
+def run_generation():
+    topic = st.session_state.current_input.strip()
+    if not topic:
+        return
+
+    history = topic_history()
+    history.touch(topic)
+    st.session_state.history = history.recent(HISTORY_SHOWN)[::-1]
+
+    compiled = active_compiled_prompt()
+    user_text = build_user_text(topic)
+    messages = [
+        {"role": "system", "content": compiled["text"]},
+        {"role": "user", "content": user_text},
+    ]
+
+    model = st.session_state.model_choice
+    max_tokens = compiled["max_tokens"]
+    input_tokens = estimate_input_tokens(compiled, user_text)
+    cache = get_response_cache()
+    cache_key = ResponseCache.make_key(model, compiled["hash"], user_text, max_tokens)
+
+    # 장편 모드: 개요/섹션 단위로 캐시하므로 전체 결과 캐시는 보지 않는다.
+    if st.session_state.longform_mode:
+        active_set = active_instruction_set() or {}
+        dispatch_generation({
+            "mode": "longform",
+            "model": model,
+            "compiled": compiled,
+            "topic": topic,
+            "set_id": st.session_state.active_instruction_set_id,
+            "sections": parse_structure_sections(st.session_state.inst_structure),
+            "section_instructions": dict(active_set.get("section_instructions") or {}),
+            "force": st.session_state.force_regenerate,
+        })
+        return
+
+    if not st.session_state.force_regenerate:
+        started = time.perf_counter()
+        cached = cache.get(cache_key)
+        if cached is not None:
+            set_last_output(cached)
+            latency = time.perf_counter() - started
+            metrics_log.record(
+                "llm", "generate", latency, model=model,
+                set_id=st.session_state.active_instruction_set_id, cache_hit=True,
+            )
+            record_generation_metrics(
+                model, None, latency, cache_hit=True,
+                input_tokens=input_tokens, max_tokens=max_tokens,
+            )
+            return
+
+    # 스트리밍/백그라운드 모드: 요청만 만들어 넘기고 바로 돌아간다.
+    if st.session_state.stream_output or st.session_state.background_jobs:
+        dispatch_generation({
+            "mode": "stream",
+            "model": model,
+            "messages": messages,
+            "cache_key": cache_key,
+            "topic": topic,
+            "set_id": st.session_state.active_instruction_set_id,
+            "max_tokens": max_tokens,
+            "input_tokens": input_tokens,
+        })
+        return
+
+    set_id = st.session_state.active_instruction_set_id
+    with st.spinner("🎬 대본을 작성하는 중입니다..."):
+        try:
+            # 캐시는 위에서 이미 확인했으므로 바로 호출한다 (같은 요청이 진행 중이면 공유).
+            result = generate_text(model, compiled, user_text, cache, True, set_id, "generate")
+        except openai.OpenAIError as e:
+            # on_change 콜백에서 예외가 나가면 화면이 깨지므로 결과 영역에 안내만 남긴다.
+            st.session_state.generation_error = describe_generation_error(e)
+            return
+
+    set_last_output(result["text"])
+    if not result["cache_hit"]:
+        get_config_store().add_output(
+            topic, set_id, model, result["text"],
+            cache_key=cache_key,
+            latency=result["latency"],
+            **result["usage"],
+        )
+    record_generation_metrics(
+        model, None, result["latency"], cache_hit=result["cache_hit"], input_tokens=input_tokens,
+        max_tokens=max_tokens, truncated=result["truncated"], coalesced=result.get("coalesced", False),
+    )
+
+
+def request_topic_rerun(topic: str):
+    # 지난 주제 목록·추천은 조각 안에 있으므로, 생성은 앱 전체를 다시 그릴 때 입력창 앞에서 한다.
+    st.session_state.rerun_topic = topic
+    st.session_state.topic_query = ""
+
+
+def dispatch_generation(request: dict):
+    """백그라운드 모드면 작업 큐에 넣고, 아니면 결과 영역이 이어받도록 pending으로 둔다."""
+    if st.session_state.background_jobs:
+        cache, store = get_response_cache(), get_config_store()
+        if request["mode"] == "longform":
+            def run(on_update):
+                return execute_longform(request, cache, store, on_progress=on_update)
+        else:
+            def run(on_update):
+                return execute_stream(request, cache, store, on_delta=on_update)
+        job_id = get_job_queue().submit(request, run)
+        st.session_state.my_jobs = (st.session_state.my_jobs + [job_id])[-JOB_SESSION_KEEP:]
+        return
+    st.session_state.pending_generation = request
+
+
+def execute_stream(request: dict, cache: ResponseCache, store, on_delta=None) -> dict:
+    """stream=True 생성 한 건. 세션 상태를 쓰지 않아 작업 스레드에서도 돌릴 수 있다.
+
+    on_delta(chunks)는 새 조각이 올 때마다 지금까지 받은 조각 목록으로 호출된다.
+    같은 요청이 이미 스트리밍 중이면 새로 호출하지 않고 그 조각을 함께 받는다.
+    """
+    started = time.perf_counter()
+    flight, leader = single_flight.begin(request["cache_key"])
+    if not leader:
+        try:
+            return follow_stream(request, flight, started, on_delta)
+        except FlightAbandoned:
+            # 먼저 시작한 스트림이 중간에 멈췄으면 그 자리를 비우고 직접 다시 요청한다.
+            single_flight.end(request["cache_key"], flight)
+            return execute_stream(request, cache, store, on_delta)
+
+    first_token_at = None
+    chunks = []
+    usage = None
+    finish_reason = None
+    try:
+        stream = create_completion(
+            request["input_tokens"] + request["max_tokens"],
+            model=request["model"],
+            messages=request["messages"],
+            max_tokens=request["max_tokens"],
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        for chunk in stream:
+            # include_usage를 켜면 마지막 조각은 choices 없이 usage만 담겨 온다.
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            chunks.append(delta)
+            flight.publish(chunks)
+            if on_delta is not None:
+                on_delta(chunks)
+        text = "".join(chunks)
+        truncated = finish_reason == "length"
+        flight.finish(result={"text": text, "truncated": truncated})
+    except Exception as e:
+        metrics_log.record(
+            "llm", "stream", time.perf_counter() - started, model=request["model"],
+            set_id=request["set_id"], error=str(e),
+        )
+        flight.finish(error=e)
+        raise
+    finally:
+        if not flight.done:
+            # on_delta(placeholder.markdown)에서 재실행·중지 예외가 나면 여기로 바로 온다.
+            # 기다리던 쪽(다른 세션·작업 스레드)이 멈춰 있지 않게 끝을 알린다.
+            flight.finish(error=FlightAbandoned("먼저 시작한 같은 요청이 중단되었습니다."))
+        single_flight.end(request["cache_key"], flight)
+
+    latency = time.perf_counter() - started
+    ttft = first_token_at - started if first_token_at is not None else None
+    usage = usage_to_dict(usage)
+    if usage["prompt_tokens"] is None:
+        # include_usage를 지원하지 않는 백엔드면 지출 집계를 위해 직접 센다.
+        usage = {"prompt_tokens": request["input_tokens"], "completion_tokens": count_tokens(text)}
+    metrics_log.record(
+        "llm", "stream", latency, model=request["model"], set_id=request["set_id"], ttft=ttft, **usage
+    )
+    if text and not truncated:
+        cache.put(request["cache_key"], request["model"], text)
+    if text:
+        store.add_output(
+            request["topic"], request["set_id"], request["model"], text,
+            cache_key=request["cache_key"],
+            latency=latency,
+            **usage,
+        )
+    return {
+        "text": text,
+        "metrics": {
+            "model": request["model"],
+            "ttft": ttft,
+            "latency": latency,
+            "input_tokens": request["input_tokens"],
+            "max_tokens": request["max_tokens"],
+            "truncated": truncated,
+        },
+    }
+
+
+def follow_stream(request: dict, flight: Flight, started: float, on_delta=None) -> dict:
+    """진행 중인 같은 스트림에 붙는다. 캐시 저장과 아카이브는 먼저 시작한 쪽이 한다."""
+    first_token_at = []
+
+    def on_shared_delta(chunks):
+        if not first_token_at:
+            first_token_at.append(time.perf_counter())
+        if on_delta is not None:
+            on_delta(chunks)
+
+    shared = follow_flight(flight, request["model"], request["set_id"], started, on_shared_delta)
+    return {
+        "text": shared["text"],
+        "metrics": {
+            "model": request["model"],
+            "ttft": first_token_at[0] - started if first_token_at else None,
+            "latency": time.perf_counter() - started,
+            "cache_hit": True,
+            "coalesced": True,
+            "input_tokens": request["input_tokens"],
+            "max_tokens": request["max_tokens"],
+            "truncated": shared["truncated"],
+        },
+    }
+
+
+def stream_generation(request: dict, placeholder) -> str:
+    """pending_generation 요청을 stream=True로 실행하며 placeholder에 조각을 이어 쓴다."""
+    last_render = [0.0]
+
+    def on_delta(chunks):
+        # 조각마다 다시 그리면 웹소켓 메시지가 너무 많아지므로 50ms 단위로 묶는다.
+        now = time.perf_counter()
+        if now - last_render[0] >= 0.05:
+            placeholder.markdown("".join(chunks) + "▌")
+            last_render[0] = now
+
+    try:
+        result = execute_stream(request, get_response_cache(), get_config_store(), on_delta)
+    except openai.OpenAIError as e:
+        st.session_state.generation_error = describe_generation_error(e)
+        return st.session_state.last_output
+    placeholder.markdown(result["text"])
+    record_generation_metrics(**result["metrics"])
+    return result["text"]
+
+
+def record_generation_metrics(model: str, ttft, latency: float, cache_hit: bool = False,
+                              input_tokens=None, max_tokens=None, truncated: bool = False,
+                              coalesced: bool = False):
+    metrics = {
+        "model": model,
+        "ttft": ttft,
+        "latency": latency,
+        "cache_hit": cache_hit,
+        "coalesced": coalesced,
+        "input_tokens": input_tokens,
+        "max_tokens": max_tokens,
+        "truncated": truncated,
+    }
+    st.session_state.last_metrics = metrics
+    log = st.session_state.generation_metrics
+    log.append(metrics)
+    st.session_state.generation_metrics = log[-50:]
+
+
+def format_generation_metrics(metrics: dict) -> str:
+    parts = [f"모델 {metrics['model']}"]
+    if metrics.get("coalesced"):
+        parts.append("진행 중이던 같은 요청과 공유")
+    elif metrics.get("cache_hit"):
+        parts.append("캐시에서 불러옴")
+    if metrics.get("ttft") is not None:
+        parts.append(f"첫 토큰 {metrics['ttft']:.2f}초")
+    parts.append(f"전체 {metrics['latency']:.2f}초")
+    if metrics.get("input_tokens") is not None:
+        parts.append(f"입력 약 {metrics['input_tokens']:,} 토큰 / 출력 상한 {metrics['max_tokens']:,}")
+    return "⏱ " + " · ".join(parts)
+
+
+METRICS_WINDOWS = {"최근 1시간": 60 * 60, "최근 24시간": 24 * 60 * 60, "최근 7일": 7 * 24 * 60 * 60}
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize_llm_events(events: list, group_key: str, window: float, labels: dict = None) -> list:
+    """모델별/set별 p50·p95 소요 시간, 처리량, 지출. 소요 시간은 캐시를 거치지 않은 호출만 본다."""
+    labels = labels or {}
+    groups = {}
+    for event in events:
+        groups.setdefault(event[group_key], []).append(event)
+
+    rows = []
+    for key, group in groups.items():
+        fresh = [e for e in group if not e["cache_hit"] and not e["error"]]
+        walls = [e["wall"] for e in fresh]
+        ttfts = [e["ttft"] for e in fresh if e["ttft"] is not None]
+        completion = sum(e["completion_tokens"] or 0 for e in fresh)
+        spend = sum(
+            estimate_cost(e["model"], e["prompt_tokens"], e["completion_tokens"]) or 0 for e in fresh
+        )
+        p50, p95, ttft50 = percentile(walls, 0.5), percentile(walls, 0.95), percentile(ttfts, 0.5)
+        rows.append({
+            "구분": labels.get(key, key or "-"),
+            "호출": len(group),
+            "캐시": f"{sum(e['cache_hit'] for e in group) / len(group):.0%}",
+            "실패": sum(1 for e in group if e["error"]),
+            "p50(초)": round(p50, 2) if p50 is not None else None,
+            "p95(초)": round(p95, 2) if p95 is not None else None,
+            "첫 토큰 p50(초)": round(ttft50, 2) if ttft50 is not None else None,
+            "시간당 호출": round(len(group) / (window / 3600), 1),
+            "출력 토큰/초": round(completion / sum(walls), 1) if walls else None,
+            "지출($)": round(spend, 4),
+        })
+    rows.sort(key=lambda row: -row["호출"])
+    return rows
+
+
+def summarize_config_events(events: list) -> list:
+    groups = {}
+    for event in events:
+        groups.setdefault(event["op"], []).append(event["wall"] * 1000)
+    return [
+        {
+            "작업": op,
+            "횟수": len(walls),
+            "p50(ms)": round(percentile(walls, 0.5), 2),
+            "p95(ms)": round(percentile(walls, 0.95), 2),
+        }
+        for op, walls in sorted(groups.items())
+    ]
+
+
+def parse_structure_sections(structure_text: str) -> list:
+    """콘텐츠 구성 지침의 '인트로 → 배경 → …' 흐름을 섹션 이름 목록으로 나눈다."""
+    parts = re.split(r"\s*(?:→|->|>|\n)\s*", structure_text or "")
+    sections = []
+    for part in parts:
+        # '… 결론 순서로 전개한다.' 처럼 끝에 붙은 서술어는 떼어낸다.
+        name = re.sub(r"\s*(순서로|순으로|단계로).*$", "", part).strip(" .·-")
+        if name and len(name) <= 20 and name not in sections:
+            sections.append(name)
+    if len(sections) < 2:
+        return list(LONGFORM_DEFAULT_SECTIONS)
+    return sections[:LONGFORM_MAX_SECTIONS]
+
+
+def build_outline_user_text(topic: str, sections: list) -> str:
+    section_list = ", ".join(f'"{name}"' for name in sections)
+    return (
+        "다음 주제로 다큐멘터리 내레이션의 개요를 먼저 잡아줘.\n"
+        f"섹션은 {section_list} 순서이고, 섹션마다 다룰 핵심 내용을 2~3문장으로 정리해줘.\n"
+        "섹션 이름을 키로, 요지를 값으로 하는 JSON 객체 하나만 출력해.\n\n"
+        f"주제: {topic}"
+    )
+
+
+def parse_outline(outline_text: str, sections: list) -> dict:
+    cleaned = re.sub(r"^```(?:json)?|```$", "", outline_text.strip(), flags=re.MULTILINE).strip()
+    try:
+        data = json.loads(cleaned)
+    except JSONDecodeError:
+        data = None
+    if isinstance(data, dict):
+        return {name: str(data.get(name, "")).strip() for name in sections}
+    # JSON으로 오지 않았으면 개요 전체를 모든 섹션의 공통 맥락으로 쓴다.
+    return {name: "" for name in sections}
 
 
-def sync_active_set_field(field_name: str, value: str):
-    active_id = st.session_state.get("active_instruction_set_id")
-    sets = st.session_state.get("instruction_sets", [])
-    if not active_id or not sets:
-        return
-    for s in sets:
-        if s.get("id") == active_id:
-            s[field_name] = value
-            break
-    st.session_state.instruction_sets = sets
-    save_config()
+def build_section_user_text(topic: str, outline_text: str, sections: list, index: int,
+                            section_note: str, target_chars) -> str:
+    name = sections[index]
+    lines = [
+        f"주제: {topic}",
+        "",
+        "[전체 개요]",
+        outline_text.strip(),
+        "",
+        f"전체 흐름은 {' → '.join(sections)} 이다.",
+        f"지금은 {index + 1}번째 섹션 '{name}' 부분의 내레이션만 작성해줘.",
+        "앞뒤 섹션과 자연스럽게 이어지도록 하되, 섹션 제목이나 번호는 쓰지 마.",
+    ]
+    if target_chars:
+        lines.append(f"이 섹션의 분량은 {max(target_chars // len(sections), 100)}자 이상으로 해줘.")
+    if section_note:
+        lines += ["", f"[이 섹션 지침]\n{section_note.strip()}"]
+    return "\n".join(lines)
 
 
-def ensure_active_set_applied():
-    sets = st.session_state.get("instruction_sets", [])
-    active_id = st.session_state.get("active_instruction_set_id")
-    if not sets or not active_id:
-        return
-    active_set = next((s for s in sets if s.get("id") == active_id), None)
-    if active_set:
-        for key in [
-            "inst_role",
-            "inst_tone",
-            "inst_structure",
-            "inst_depth",
-            "inst_forbidden",
-            "inst_format",
-            "inst_user_intent",
-        ]:
-            if key in active_set:
-                setattr(st.session_state, key, active_set.get(key, ""))
+def format_longform_progress(sections: list, texts: list) -> str:
+    blocks = []
+    for name, text in zip(sections, texts):
+        blocks.append(text if text is not None else f"⏳ _{name} 섹션을 작성하는 중입니다..._")
+    return "\n\n".join(blocks)
 
 
-def run_generation():
-    topic = st.session_state.current_input.strip()
-    if not topic:
-        return
+def execute_longform(request: dict, cache: ResponseCache, store, on_progress=None) -> dict:
+    """개요 → 섹션 동시 생성 → 순서대로 이어 붙이기. 개요와 각 섹션은 따로 캐시된다.
 
-    hist = st.session_state.history
-    if topic in hist:
-        hist.remove(topic)
-    hist.append(topic)
-    st.session_state.history = hist[-5:]
-    save_config()
+    on_progress(markdown)는 개요 단계와 섹션이 하나 끝날 때마다 호출된다.
+    """
+    started = time.perf_counter()
+    model = request["model"]
+    compiled = request["compiled"]
+    sections = request["sections"]
+    notes = request["section_instructions"]
+    force = request["force"]
 
-    system_parts = [
-        st.session_state.inst_role,
-        st.session_state.inst_tone,
-        st.session_state.inst_structure,
-        st.session_state.inst_depth,
-        st.session_state.inst_forbidden,
-        st.session_state.inst_format,
-        st.session_state.inst_user_intent,
-    ]
-    system_text = "\n\n".join(
-        part.strip() for part in system_parts if isinstance(part, str) and part.strip()
+    if on_progress is not None:
+        on_progress("🧭 _개요를 잡는 중입니다..._")
+    outline = generate_text(
+        model, compiled, build_outline_user_text(request["topic"], sections), cache, force,
+        request["set_id"], "longform",
     )
+    points = parse_outline(outline["text"], sections)
+    outline_text = "\n".join(
+        f"- {name}: {points[name]}" for name in sections if points[name]
+    ) or outline["text"]
 
-    user_text = f"다음 주제에 맞는 다큐멘터리 내레이션을 작성해줘.\n\n주제: {topic}"
+    texts = [None] * len(sections)
+    results = [outline]
+    if on_progress is not None:
+        on_progress(format_longform_progress(sections, texts))
+    target_chars = parse_length_target(compiled.get("format_text", ""))
+    with ThreadPoolExecutor(max_workers=min(len(sections), LONGFORM_MAX_CONCURRENCY)) as pool:
+        futures = {
+            pool.submit(
+                generate_text,
+                model,
+                compiled,
+                build_section_user_text(
+                    request["topic"], outline_text, sections, i, notes.get(name, ""), target_chars
+                ),
+                cache,
+                force,
+                request["set_id"],
+                "longform",
+            ): i
+            for i, name in enumerate(sections)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            result = future.result()
+            texts[i] = result["text"].strip()
+            results.append(result)
+            if on_progress is not None:
+                on_progress(format_longform_progress(sections, texts))
 
-    with st.spinner("🎬 대본을 작성하는 중입니다..."):
-        res = client.chat.completions.create(
-            model=st.session_state.model_choice,
-            messages=[
-                {"role": "system", "content": system_text},
-                {"role": "user", "content": user_text},
-            ],
-            max_tokens=600,
+    text = "\n\n".join(texts)
+    latency = time.perf_counter() - started
+    fresh = [r for r in results if not r["cache_hit"]]
+    usage = {
+        key: sum(r["usage"][key] or 0 for r in fresh) if fresh else None
+        for key in ("prompt_tokens", "completion_tokens")
+    }
+    if text and fresh:
+        store.add_output(
+            request["topic"], request["set_id"], model, text,
+            cache_key=outline.get("cache_key"),
+            latency=latency,
+            **usage,
+        )
+    return {
+        "text": text,
+        "metrics": {
+            "model": model,
+            "ttft": None,
+            "latency": latency,
+            "cache_hit": not fresh,
+            "input_tokens": usage["prompt_tokens"],
+            "max_tokens": compiled["max_tokens"],
+            "truncated": any(r.get("truncated") for r in results),
+        },
+    }
+
+
+def run_longform_generation(request: dict, placeholder) -> str:
+    try:
+        result = execute_longform(
+            request, get_response_cache(), get_config_store(), on_progress=placeholder.markdown
         )
+    except openai.OpenAIError as e:
+        st.session_state.generation_error = describe_generation_error(e)
+        return st.session_state.last_output
+    record_generation_metrics(**result["metrics"])
+    return result["text"]
+
 
-    st.session_state.last_output = res.choices[0].message.content
+@st.cache_data(max_entries=256, show_spinner=False)
+def recent_history_html(items: tuple) -> str:
+    """최근 입력 목록 HTML. 같은 목록이면 다시 만들지 않는다."""
+    if not items:
+        return """<div style="
+    max-width:460px;
+    margin:40px auto 40px auto;
+">
+  <div style="margin-left:100px; font-size:0.8rem; color:#d1d5db; text-align:left;">
+    최근 입력이 없습니다.
+  </div>
+</div>"""
+    html_items = "".join(
+        f"""
+<div style="
+    font-size:0.85rem;
+    color:#797979;
+    margin-bottom:4px;
+">{html.escape(h)}</div>
+"""
+        for h in items
+    )
+    return f"""<div style="
+    max-width:460px;
+    margin:40px auto 40px auto;
+">
+  <div style="margin-left:100px; text-align:left;">
+    <div style="font-size:0.8rem; color:#9ca3af; margin-bottom:10px;">
+      최근
+    </div>
+    {html_items}
+  </div>
+</div>"""
 
 
 def build_instruction_preview(source: dict) -> str:
@@ -289,6 +3441,10 @@ else:
 st.markdown(
     """
     <style>
+    textarea {
+        font-size: 0.8rem !important;
+        line-height: 1.3 !important;
+    }
     .block-container {
         max-width: 900px;
         padding-top: 4.5rem;
@@ -325,13 +3481,13 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-# ============================
-# 왼쪽 사이드바
-# ============================
-with st.sidebar:
-    st.markdown("<div class='sidebar-top'>", unsafe_allow_html=True)
-
-    st.markdown("### 📘 지침")
+@st.fragment
+def instruction_editors():
+    """사이드바 지침 편집. 입력 중에는 이 부분만 다시 그리고, 저장하면 가운데 영역의
+    set 이름·토큰 수도 바뀌므로 앱 전체를 다시 그린다."""
+    saved_message = st.session_state.pop("instruction_saved", None)
+    if saved_message:
+        st.success(saved_message)
 
     with st.expander("1. 역할 지침 (Role Instructions)", expanded=False):
         st.caption("ChatGPT가 어떤 캐릭터 / 전문가 / 화자인지 정의합니다.")
@@ -350,7 +3506,8 @@ with st.sidebar:
             if inst_role_edit.strip():
                 st.session_state.inst_role = inst_role_edit.strip()
                 sync_active_set_field("inst_role", st.session_state.inst_role)
-            st.success("역할 지침이 저장되었습니다.")
+            st.session_state.instruction_saved = "역할 지침이 저장되었습니다."
+            st.rerun()
 
     with st.expander("2. 톤 & 스타일 지침", expanded=False):
         st.caption("어떤 분위기/문체/리듬으로 말할지 정의합니다.")
@@ -369,7 +3526,8 @@ with st.sidebar:
             if inst_tone_edit.strip():
                 st.session_state.inst_tone = inst_tone_edit.strip()
                 sync_active_set_field("inst_tone", st.session_state.inst_tone)
-            st.success("톤 & 스타일 지침이 저장되었습니다.")
+            st.session_state.instruction_saved = "톤 & 스타일 지침이 저장되었습니다."
+            st.rerun()
 
     with st.expander("3. 콘텐츠 구성 지침", expanded=False):
         st.caption("초반–중반–후반 또는 장면 흐름을 어떻게 짤지 정의합니다.")
@@ -388,7 +3546,8 @@ with st.sidebar:
             if inst_structure_edit.strip():
                 st.session_state.inst_structure = inst_structure_edit.strip()
                 sync_active_set_field("inst_structure", st.session_state.inst_structure)
-            st.success("콘텐츠 구성 지침이 저장되었습니다.")
+            st.session_state.instruction_saved = "콘텐츠 구성 지침이 저장되었습니다."
+            st.rerun()
 
     with st.expander("4. 정보 밀도 & 조사 심도 지침", expanded=False):
         st.caption("얼마나 깊게, 얼마나 촘촘하게 설명할지 정의합니다.")
@@ -407,7 +3566,8 @@ with st.sidebar:
             if inst_depth_edit.strip():
                 st.session_state.inst_depth = inst_depth_edit.strip()
                 sync_active_set_field("inst_depth", st.session_state.inst_depth)
-            st.success("정보 밀도 지침이 저장되었습니다.")
+            st.session_state.instruction_saved = "정보 밀도 지침이 저장되었습니다."
+            st.rerun()
 
     with st.expander("5. 금지 지침 (Forbidden Rules)", expanded=False):
         st.caption("절대 쓰지 말아야 할 표현/스타일/토픽을 정의합니다.")
@@ -426,7 +3586,8 @@ with st.sidebar:
             if inst_forbidden_edit.strip():
                 st.session_state.inst_forbidden = inst_forbidden_edit.strip()
                 sync_active_set_field("inst_forbidden", st.session_state.inst_forbidden)
-            st.success("금지 지침이 저장되었습니다.")
+            st.session_state.instruction_saved = "금지 지침이 저장되었습니다."
+            st.rerun()
 
     with st.expander("6. 출력 형식 지침 (Output Format)", expanded=False):
         st.caption("길이, 단락, 제목, 마크다운 형식 등을 정의합니다.")
@@ -445,7 +3606,8 @@ with st.sidebar:
             if inst_format_edit.strip():
                 st.session_state.inst_format = inst_format_edit.strip()
                 sync_active_set_field("inst_format", st.session_state.inst_format)
-            st.success("출력 형식 지침이 저장되었습니다.")
+            st.session_state.instruction_saved = "출력 형식 지침이 저장되었습니다."
+            st.rerun()
 
     with st.expander("7. 사용자 요청 반영 지침", expanded=False):
         st.caption("사용자가 준 주제/키워드를 어떻게 스토리 안에 녹일지 정의합니다.")
@@ -463,30 +3625,144 @@ with st.sidebar:
             if inst_user_intent_edit.strip():
                 st.session_state.inst_user_intent = inst_user_intent_edit.strip()
                 sync_active_set_field("inst_user_intent", st.session_state.inst_user_intent)
-            st.success("사용자 요청 반영 지침이 저장되었습니다.")
-
-    st.markdown("</div><div class='sidebar-bottom'>", unsafe_allow_html=True)
+            st.session_state.instruction_saved = "사용자 요청 반영 지침이 저장되었습니다."
+            st.rerun()
 
-    st.markdown("### ⚙️ 설정")
 
+@st.fragment
+def settings_panels():
+    """모델 선택과 상태·지표 패널. 토글·새로고침은 이 부분만 다시 그린다."""
     with st.expander("GPT 모델 선택", expanded=False):
         model = st.selectbox(
             "",
-            ["gpt-4o-mini", "gpt-4o", "gpt-4.1"],
-            index=["gpt-4o-mini", "gpt-4o", "gpt-4.1"].index(
+            MODEL_OPTIONS,
+            index=MODEL_OPTIONS.index(
                 st.session_state.model_choice
             ),
             label_visibility="collapsed",
         )
         st.session_state.model_choice = model
+        st.toggle(
+            "스트리밍 출력",
+            key="stream_output",
+            help="응답을 기다리지 않고 생성되는 대로 결과 영역에 이어서 보여줍니다.",
+        )
+
+    with st.expander("🔌 연결 풀 상태", expanded=False):
+        st.caption("모든 세션이 공유하는 OpenAI HTTP 연결 풀의 재사용 현황입니다.")
+        if http_transport is None:
+            fake_config = client.config
+            st.markdown(
+                f"- 가짜 백엔드 사용 중 (SCRIPTKING_BACKEND=fake) · 호출 {client.completions.calls}회\n"
+                f"- 첫 토큰 지연 {fake_config.latency}초 · 초당 {fake_config.token_rate:g} 토큰 · "
+                f"오류율 {fake_config.error_rate:.0%} (HTTP {fake_config.error_status})"
+            )
+        else:
+            pool_stats = http_transport.stats()
+            st.markdown(
+                f"- 요청: {pool_stats['requests']}회 (진행 중 {pool_stats['in_flight']}, "
+                f"최대 동시 {pool_stats['peak_in_flight']})\n"
+                f"- 새로 연 연결: {pool_stats['connections_opened']}개 · "
+                f"재사용 {pool_stats['reused_requests']}회 ({pool_stats['reuse_ratio']:.0%})\n"
+                f"- 열린 연결: {pool_stats['open_connections']}개 "
+                f"(대기 {pool_stats['idle_connections']}) / 상한 {HTTP_MAX_CONNECTIONS}"
+            )
+        flight_stats = single_flight.stats()
+        st.markdown(
+            f"- 진행 중인 생성: {flight_stats['in_flight']}건 · "
+            f"같은 요청에 합류해 아낀 호출: {flight_stats['coalesced']}회"
+        )
+        scheduler_stats = scheduler.stats()
+        cooldown_text = (
+            f" · Retry-After로 {scheduler_stats['cooldown']:.1f}초 멈춤" if scheduler_stats["cooldown"] else ""
+        )
+        st.markdown(
+            f"- 요청 한도: 분당 {RATE_LIMIT_RPM}회 / {RATE_LIMIT_TPM:,} 토큰 "
+            f"(남은 여유 {scheduler_stats['requests_left']}회 / {scheduler_stats['tokens_left']:,} 토큰)\n"
+            f"- 한도 대기 중 {scheduler_stats['waiting']}건 · 재시도 {scheduler_stats['retries']}회 · "
+            f"대기 누계 {scheduler_stats['throttled_seconds']:.1f}초{cooldown_text}"
+        )
 
+    with st.expander("📈 성능 지표", expanded=False):
+        # 기록이 많으면 집계가 무거우므로, 재실행마다 돌지 않도록 켰을 때만 읽는다.
+        if st.toggle("지표 불러오기", key="metrics_show"):
+            metrics_window_label = st.selectbox(
+                "기간", list(METRICS_WINDOWS), index=1, key="metrics_window",
+                label_visibility="collapsed",
+            )
+            metrics_window = METRICS_WINDOWS[metrics_window_label]
+            metrics_since = time.time() - metrics_window
+            llm_events = metrics_log.events("llm", metrics_since)
+            if not llm_events:
+                st.caption("이 기간에 기록된 생성 요청이 없습니다.")
+            else:
+                spend_total = sum(
+                    estimate_cost(e["model"], e["prompt_tokens"], e["completion_tokens"]) or 0
+                    for e in llm_events if not e["cache_hit"]
+                )
+                st.caption(f"생성 요청 {len(llm_events)}건 · 예상 지출 ${spend_total:.4f}")
+                st.markdown("**모델별**")
+                st.dataframe(
+                    summarize_llm_events(llm_events, "model", metrics_window),
+                    use_container_width=True, hide_index=True,
+                )
+                st.markdown("**지침 set별**")
+                st.dataframe(
+                    summarize_llm_events(
+                        llm_events, "set_id", metrics_window,
+                        instruction_set_registry().names(),
+                    ),
+                    use_container_width=True, hide_index=True,
+                )
+            config_events = metrics_log.events("config", metrics_since)
+            if config_events:
+                st.markdown("**설정 읽기/쓰기**")
+                st.dataframe(
+                    summarize_config_events(config_events), use_container_width=True, hide_index=True
+                )
+            if st.button("지표 기록 비우기", use_container_width=True, key="metrics_clear"):
+                metrics_log.clear()
+                st.success("성능 지표 기록을 비웠습니다.")
+
+    with st.expander("🗃 응답 캐시", expanded=False):
+        st.caption("같은 모델·지침·주제로 생성한 결과는 저장해두었다가 바로 보여줍니다.")
+        cache_stats = get_response_cache().stats()
+        st.markdown(
+            f"- 저장된 응답: {cache_stats['entries']}개\n"
+            f"- 사용 용량: {cache_stats['bytes'] / 1024:.1f} KB"
+        )
+        if st.button("응답 캐시 비우기", use_container_width=True):
+            get_response_cache().clear()
+            st.success("응답 캐시를 비웠습니다.")
+
+
+def config_export_builder(settings: dict, history: TopicHistory):
+    """내보낼 config.json을 만드는 함수. 지난 주제 전체를 읽으므로 재실행마다가 아니라
+    내려받기를 누를 때만 불린다 (세션 밖 스레드에서 불리므로 필요한 값은 미리 받아둔다)."""
+
+    def build() -> bytes:
+        rows = history.export()
+        data = dict(settings)
+        data["history"] = [row["topic"] for row in rows]
+        data["history_stats"] = {row["topic"]: [row["count"], row["used_at"]] for row in rows}
+        return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+    return build
+
+
+@st.fragment
+def config_tools():
+    """설정 초기화·내보내기/불러오기. 실제로 설정을 바꿀 때만 앱 전체를 다시 그린다."""
     with st.expander("🧹 설정 초기화 (config.json)", expanded=False):
-        st.caption("모든 지침, 최근 입력, config.json 파일을 초기화합니다. 되돌릴 수 없습니다.")
+        st.caption(
+            f"사용자 '{st.session_state.user_id}'의 모든 지침, 최근 입력, config.json 파일을 초기화합니다. "
+            "다른 사용자의 설정은 그대로입니다. 되돌릴 수 없습니다."
+        )
         if not st.session_state.show_reset_confirm:
-            if st.button("config.json 초기화", use_container_width=True):
-                st.session_state.show_reset_confirm = True
-                st.session_state.reset_input_value = ""
-                st.rerun()
+            st.button(
+                "config.json 초기화", use_container_width=True,
+                on_click=set_reset_confirm, args=(True,),
+            )
         else:
             st.warning("정말 config.json을 초기화하시겠습니까? 아래에 '초기화'를 입력한 뒤 실행을 눌러주세요.")
             txt = st.text_input(
@@ -503,30 +3779,22 @@ with st.sidebar:
                     else:
                         st.error("입력한 내용이 '초기화'와 일치하지 않습니다.")
             with col_r2:
-                if st.button("취소", use_container_width=True):
-                    st.session_state.show_reset_confirm = False
-                    st.session_state.reset_input_value = ""
-                    st.rerun()
+                st.button(
+                    "취소", use_container_width=True,
+                    on_click=set_reset_confirm, args=(False,),
+                )
 
     with st.expander("💾 config.json 내보내기 / 불러오기", expanded=False):
         st.caption("현재 설정을 파일로 저장하거나, 기존 config.json 파일을 불러올 수 있습니다.")
 
-        export_data = {
-            "inst_role": st.session_state.inst_role,
-            "inst_tone": st.session_state.inst_tone,
-            "inst_structure": st.session_state.inst_structure,
-            "inst_depth": st.session_state.inst_depth,
-            "inst_forbidden": st.session_state.inst_forbidden,
-            "inst_format": st.session_state.inst_format,
-            "inst_user_intent": st.session_state.inst_user_intent,
-            "history": st.session_state.history[-5:],
-            "instruction_sets": st.session_state.get("instruction_sets", []),
-            "active_instruction_set_id": st.session_state.get("active_instruction_set_id"),
-        }
-        export_json_str = json.dumps(export_data, ensure_ascii=False, indent=2)
+        export_settings = {key: st.session_state[key] for key in INST_KEYS}
+        export_settings["instruction_sets"] = [
+            storable_set(s) for s in st.session_state.get("instruction_sets", [])
+        ]
+        export_settings["active_instruction_set_id"] = st.session_state.get("active_instruction_set_id")
         st.download_button(
             "⬇️ config.json 내보내기",
-            data=export_json_str.encode("utf-8"),
+            data=config_export_builder(export_settings, topic_history()),
             file_name="config.json",
             mime="application/json",
             use_container_width=True,
@@ -545,8 +3813,8 @@ with st.sidebar:
             except Exception:
                 st.error("❌ JSON 파일을 읽는 중 오류가 발생했습니다. 올바른 config.json인지 확인해주세요.")
             else:
-                with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-                    f.write(raw)
+                get_config_store().save_all(normalize_config_data(new_data))
+                topic_history().clear_cache()
 
                 if "config_loaded" in st.session_state:
                     del st.session_state["config_loaded"]
@@ -572,22 +3840,37 @@ with st.sidebar:
                 st.success("✅ config.json이 성공적으로 불러와졌습니다. 설정이 적용됩니다.")
                 st.rerun()
 
+
+# ============================
+# 왼쪽 사이드바
+# ============================
+with st.sidebar:
+    st.markdown("<div class='sidebar-top'>", unsafe_allow_html=True)
+
+    st.markdown("### 📘 지침")
+
+    instruction_editors()
+
+    st.markdown("</div><div class='sidebar-bottom'>", unsafe_allow_html=True)
+
+    st.markdown("### ⚙️ 설정")
+
+    settings_panels()
+    config_tools()
+
     st.markdown("</div>", unsafe_allow_html=True)
 
 # ============================
 # 메인 영역
 # ============================
 inst_sets_main = st.session_state.instruction_sets
+inst_registry_main = instruction_set_registry()
 active_id_main = st.session_state.active_instruction_set_id
-active_set_main = None
+active_set_main = inst_registry_main.get(active_id_main) if active_id_main else None
 active_name_main = "선택된 set 없음"
 
-if inst_sets_main and active_id_main:
-    for s in inst_sets_main:
-        if s.get("id") == active_id_main:
-            active_set_main = s
-            active_name_main = s.get("name", "이름 없는 set")
-            break
+if active_set_main is not None:
+    active_name_main = active_set_main.get("name", "이름 없는 set")
 
 if active_set_main is None:
     active_set_main = {
@@ -611,15 +3894,16 @@ st.markdown("---")
 # ============================
 # 지침 set 선택 & 관리 컨트롤 (가운데 정렬)
 # ============================
-if inst_sets_main:
-    names_main = [s.get("name", f"셋 {i+1}") for i, s in enumerate(inst_sets_main)]
-    active_index_main = 0
-    for i, s in enumerate(inst_sets_main):
-        if s.get("id") == active_id_main:
-            active_index_main = i
-            break
+@st.fragment
+def instruction_set_picker():
+    """지침 set 선택·관리 도구. 검색·보기 전환·페이지 넘김·즐겨찾기는 이 부분만 다시 그리고,
+    set을 고르거나 추가·편집·삭제로 넘어갈 때만 앱 전체를 다시 그린다."""
+    registry = instruction_set_registry()
+    active_id = st.session_state.active_instruction_set_id
+    active_index_main = registry.index(active_id)
+    instset_modes = {"전체": "all", "★ 즐겨찾기": "favorites", "최근 사용": "recent"}
 
-    # 1) 지침 set 선택 (가운데)
+    # 1) 지침 set 선택 (가운데): 검색 + 보기 모드 + 한 페이지 분량만 그린다
     col_l1, col_c1, col_r1 = st.columns([1, 4, 1])
     with col_c1:
         st.markdown(
@@ -627,21 +3911,54 @@ if inst_sets_main:
             "margin-bottom:0.2rem; text-align:center;'>지침 set 선택</div>",
             unsafe_allow_html=True,
         )
-        selected_index_main = st.radio(
-            "지침 set 선택",
-            options=list(range(len(inst_sets_main))),
-            format_func=lambda i: names_main[i],
-            index=active_index_main,
-            key="instset_main_radio",
+        st.text_input(
+            "지침 set 검색",
+            key="instset_query",
+            placeholder="이름·태그로 검색 (앞글자·띄엄띄엄·오타도 찾아요)",
+            label_visibility="collapsed",
+            on_change=set_list_page,
+            args=("instset_page", 0),
+        )
+        instset_mode = st.radio(
+            "보기",
+            list(instset_modes),
+            key="instset_filter",
             horizontal=True,
             label_visibility="collapsed",
+            on_change=set_list_page,
+            args=("instset_page", 0),
         )
-        selected_set = inst_sets_main[selected_index_main]
-        if selected_set.get("id") != active_id_main:
-            st.session_state.active_instruction_set_id = selected_set.get("id")
-            apply_instruction_set(selected_set)
-            save_config()
-            st.rerun()
+        instset_positions = registry.view(
+            st.session_state.instset_query, instset_modes[instset_mode]
+        )
+        instset_window, instset_page, instset_pages = instset_page_slice(
+            instset_positions, "instset_page", active_index_main
+        )
+        if not instset_positions:
+            st.caption("조건에 맞는 지침 set이 없습니다.")
+        for i in instset_window:
+            set_obj_main = registry.sets[i]
+            set_id_main = set_obj_main.get("id")
+            col_star, col_pick = st.columns([1, 9])
+            with col_star:
+                st.button(
+                    "★" if set_obj_main.get("favorite") else "☆",
+                    key=f"instset_fav_{set_id_main}",
+                    help="즐겨찾기",
+                    on_click=toggle_favorite_set,
+                    args=(set_id_main,),
+                )
+            with col_pick:
+                if st.button(
+                    registry.label(i),
+                    key=f"instset_pick_{set_id_main}",
+                    type="primary" if set_id_main == active_id else "secondary",
+                    use_container_width=True,
+                ):
+                    select_instruction_set(set_id_main)
+                    # 가운데 제목·토큰 수와 사이드바 지침까지 바뀌므로 앱 전체를 다시 그린다.
+                    st.rerun()
+        list_page_controls("instset_page", instset_page, instset_pages, len(instset_positions))
 
     # 2) 지침 set 관리 (아래, 가운데)
     col_l2, col_c2, col_r2 = st.columns([1, 4, 1])
@@ -675,18 +3992,32 @@ if inst_sets_main:
             st.session_state.instset_toolbar_run_id += 1
             st.rerun()
 
+
+if inst_sets_main:
+    instruction_set_picker()
+
 # 컨트롤 아래 separator bar
 st.markdown("---")
 
 # 현재 선택된 지침 set 이름 (더 크게, 가운데 정렬 / 아래 separator 없음)
 st.markdown(
     f"<h2 style='text-align:center; margin:0.8rem 0 1.5rem 0; "
-    f"font-size:26px; color:#111827;'>{active_name_main}</h2>",
+    f"font-size:26px; color:#111827;'>{html.escape(active_name_main)}</h2>",
+    unsafe_allow_html=True,
+)
+active_prompt_main = active_compiled_prompt()
+st.markdown(
+    f"<div style='text-align:center; font-size:0.8rem; color:#9ca3af; margin-top:-1rem;'>"
+    f"system 프롬프트 {active_prompt_main['tokens']:,} 토큰 · "
+    f"출력 상한 {active_prompt_main['max_tokens']:,} 토큰 · #{active_prompt_main['hash'][:8]}</div>",
     unsafe_allow_html=True,
 )
 
 # 지침 set 삭제 모드 (메인 영역에 표시)
-if st.session_state.get("instset_delete_mode", False):
+@st.fragment
+def instruction_set_delete_panel():
+    """지침 set 삭제. 검색·페이지 넘김·대상 고르기는 이 부분만 다시 그린다."""
+    registry = instruction_set_registry()
     sets = st.session_state.instruction_sets
     st.markdown("#### 🗑 지침 set 삭제")
 
@@ -694,21 +4025,34 @@ if st.session_state.get("instset_delete_mode", False):
         st.info("삭제할 지침 set이 없습니다.")
         st.session_state.instset_delete_mode = False
     else:
-        names_del = [s.get("name", f"셋 {i+1}") for i, s in enumerate(sets)]
-        del_index = st.selectbox(
-            "삭제할 지침 set 선택",
-            options=list(range(len(sets))),
-            format_func=lambda i: names_del[i],
+        st.text_input(
+            "삭제할 지침 set 검색",
+            key="instset_del_query",
+            placeholder="삭제할 지침 set 이름·태그 검색",
             label_visibility="collapsed",
-            key="delete_instruction_set_select_main",
+            on_change=set_list_page,
+            args=("instset_del_page", 0),
         )
+        del_positions = registry.search(st.session_state.instset_del_query)
+        del_window, del_page, del_pages = instset_page_slice(del_positions, "instset_del_page")
+        delete_id = st.session_state.instset_delete_target
+        if registry.get(delete_id) is None:
+            delete_id = None
+        for i in del_window:
+            set_id_del = sets[i].get("id")
+            st.button(
+                registry.name(i),
+                key=f"instset_del_pick_{set_id_del}",
+                type="primary" if set_id_del == delete_id else "secondary",
+                use_container_width=True,
+                on_click=pick_delete_target,
+                args=(set_id_del,),
+            )
+        list_page_controls("instset_del_page", del_page, del_pages, len(del_positions))
         col_del1, col_del2 = st.columns(2)
         with col_del1:
-            if st.button("선택한 지침 set 삭제", use_container_width=True):
-                delete_id = sets[del_index].get("id")
-                st.session_state.instruction_sets = [
-                    s for s in sets if s.get("id") != delete_id
-                ]
+            if st.button("선택한 지침 set 삭제", use_container_width=True, disabled=delete_id is None):
+                registry.remove(delete_id)
                 if delete_id == st.session_state.active_instruction_set_id:
                     if st.session_state.instruction_sets:
                         st.session_state.active_instruction_set_id = (
@@ -717,25 +4061,27 @@ if st.session_state.get("instset_delete_mode", False):
                         ensure_active_set_applied()
                     else:
                         st.session_state.active_instruction_set_id = None
-                save_config()
+                get_config_store().delete_set(delete_id)
+                save_active_state()
                 st.session_state.instset_delete_mode = False
+                st.session_state.instset_delete_target = None
                 st.rerun()
         with col_del2:
             if st.button("취소", use_container_width=True):
                 st.session_state.instset_delete_mode = False
+                st.session_state.instset_delete_target = None
                 st.rerun()
 
+
+if st.session_state.get("instset_delete_mode", False):
+    instruction_set_delete_panel()
+
 # 지침 set 추가/편집 에디터
 if st.session_state.get("show_instruction_set_editor", False):
     edit_id = st.session_state.get("edit_instruction_set_id")
     edit_mode = bool(edit_id)
 
-    target_set = None    # type: ignore
-    if edit_mode:
-        for s in st.session_state.instruction_sets:
-            if s.get("id") == edit_id:
-                target_set = s
-                break
+    target_set = inst_registry_main.get(edit_id) if edit_mode else None
 
     if edit_mode and target_set:
         title_text = "✏️ 지침 set 편집"
@@ -747,6 +4093,8 @@ if st.session_state.get("show_instruction_set_editor", False):
         forbid_txt_default = target_set.get("inst_forbidden", "")
         format_txt_default = target_set.get("inst_format", "")
         intent_txt_default = target_set.get("inst_user_intent", "")
+        max_tokens_default = target_set.get("max_tokens", 0)
+        tags_default = ", ".join(target_set.get("tags") or [])
     else:
         title_text = "✨ 새 지침 set 추가"
         default_name = ""
@@ -757,11 +4105,14 @@ if st.session_state.get("show_instruction_set_editor", False):
         forbid_txt_default = ""
         format_txt_default = ""
         intent_txt_default = ""
+        max_tokens_default = 0
+        tags_default = ""
 
     st.markdown(f"## {title_text}")
 
     with st.form("instruction_set_editor_form"):
         set_name = st.text_input("지침 set 이름", value=default_name, placeholder="예: 다큐 기본셋 / 연애의 경제학 셋 등")
+        tags_txt = st.text_input("태그 (쉼표로 구분, 검색에 쓰입니다)", value=tags_default, placeholder="예: 다큐, 쇼츠, 역사")
 
         role_txt = st.text_area("1. 역할 지침", role_txt_default, height=80)
         tone_txt = st.text_area("2. 톤 & 스타일 지침", tone_txt_default, height=80)
@@ -770,6 +4121,13 @@ if st.session_state.get("show_instruction_set_editor", False):
         forbid_txt = st.text_area("5. 금지 지침", forbid_txt_default, height=80)
         format_txt = st.text_area("6. 출력 형식 지침", format_txt_default, height=80)
         intent_txt = st.text_area("7. 사용자 요청 반영 지침", intent_txt_default, height=80)
+        max_tokens_value = st.number_input(
+            "최대 출력 토큰 (0 = 출력 형식 지침의 분량으로 자동 계산)",
+            min_value=0,
+            max_value=MAX_OUTPUT_TOKENS,
+            value=int(max_tokens_default or 0),
+            step=100,
+        )
 
         col_a, col_b = st.columns(2)
         with col_a:
@@ -787,8 +4145,10 @@ if st.session_state.get("show_instruction_set_editor", False):
             if not set_name.strip():
                 st.error("지침 set 이름을 입력해주세요.")
             else:
+                tags = [t.strip() for t in tags_txt.split(",") if t.strip()]
                 if edit_mode and target_set:
                     target_set["name"] = set_name.strip()
+                    target_set["tags"] = tags
                     target_set["inst_role"] = role_txt.strip()
                     target_set["inst_tone"] = tone_txt.strip()
                     target_set["inst_structure"] = struct_txt.strip()
@@ -796,11 +4156,11 @@ if st.session_state.get("show_instruction_set_editor", False):
                     target_set["inst_forbidden"] = forbid_txt.strip()
                     target_set["inst_format"] = format_txt.strip()
                     target_set["inst_user_intent"] = intent_txt.strip()
-                    for i, s in enumerate(st.session_state.instruction_sets):
-                        if s.get("id") == edit_id:
-                            st.session_state.instruction_sets[i] = target_set
-                            break
+                    target_set["max_tokens"] = int(max_tokens_value)
+                    invalidate_compiled_prompt(target_set)
+                    inst_registry_main.update(target_set)
                     st.session_state.active_instruction_set_id = edit_id
+                    saved_set = target_set
                 else:
                     new_id = str(uuid4())
                     new_set = {
@@ -813,14 +4173,19 @@ if st.session_state.get("show_instruction_set_editor", False):
                         "inst_forbidden": forbid_txt.strip(),
                         "inst_format": format_txt.strip(),
                         "inst_user_intent": intent_txt.strip(),
+                        "max_tokens": int(max_tokens_value),
+                        "tags": tags,
                     }
-                    st.session_state.instruction_sets.append(new_set)
+                    inst_registry_main.add(new_set)
                     st.session_state.active_instruction_set_id = new_id
+                    saved_set = new_set
 
                 ensure_active_set_applied()
                 st.session_state.show_instruction_set_editor = False
                 st.session_state.edit_instruction_set_id = None
-                save_config()
+                st.session_state.instset_page = None  # 저장한 set이 있는 페이지로
+                get_config_store().upsert_set(saved_set)
+                save_active_state()
                 st.success("✅ 지침 set이 저장되었습니다.")
                 st.rerun()
 
@@ -831,43 +4196,43 @@ if st.session_state.get("show_instruction_set_editor", False):
 # ============================
 # 최근 히스토리 및 입력
 # ============================
-if st.session_state.history:
-    items = st.session_state.history[-5:]
-    html_items = ""
-    for h in items:
-        html_items += f"""
-<div style="
-    font-size:0.85rem;
-    color:#797979;
-    margin-bottom:4px;
-">{h}</div>
-"""
-    st.markdown(
-        f"""<div style="
-    max-width:460px;
-    margin:40px auto 40px auto;
-">
-  <div style="margin-left:100px; text-align:left;">
-    <div style="font-size:0.8rem; color:#9ca3af; margin-bottom:10px;">
-      최근
-    </div>
-    {html_items}
-  </div>
-</div>""",
-        unsafe_allow_html=True,
-    )
-else:
-    st.markdown(
-        """<div style="
-    max-width:460px;
-    margin:40px auto 40px auto;
-">
-  <div style="margin-left:100px; font-size:0.8rem; color:#d1d5db; text-align:left;">
-    최근 입력이 없습니다.
-  </div>
-</div>""",
-        unsafe_allow_html=True,
+@st.fragment
+def topic_suggestions():
+    """입력창 아래 지난 주제·대본 추천. 검색어를 바꿀 때는 이 부분만 다시 그린다."""
+    query = st.text_input(
+        "지난 주제 찾기",
+        key="topic_query",
+        placeholder="🕒 지난 주제 찾기 (ㅎㄱ, 한구처럼 일부만 입력해도 됩니다)",
+        label_visibility="collapsed",
     )
+    if not query.strip():
+        return
+    hits = get_topic_index(st.session_state.user_id).lookup(query)
+    if not hits:
+        st.caption("비슷한 지난 주제가 없습니다.")
+    for i, hit in enumerate(hits):
+        badges = []
+        if hit["count"]:
+            badges.append(f"🕒 {hit['count']}회")
+        if hit["outputs"]:
+            badges.append(f"📄 대본 {hit['outputs']}개")
+        col_topic, col_go = st.columns([5, 1])
+        with col_topic:
+            st.markdown(f"**{hit['topic']}** · {' · '.join(badges)}")
+        with col_go:
+            st.button(
+                "↻ 생성", key=f"topic_suggest_{i}", use_container_width=True,
+                on_click=request_topic_rerun, args=(hit["topic"],),
+            )
+    if st.session_state.get("rerun_topic"):
+        st.rerun()
+
+
+if st.session_state.get("rerun_topic"):
+    st.session_state.current_input = st.session_state.pop("rerun_topic")
+    run_generation()
+
+st.markdown(recent_history_html(tuple(st.session_state.history)), unsafe_allow_html=True)
 
 pad_left, center_col, pad_right = st.columns([1, 7, 1])
 
@@ -885,22 +4250,401 @@ with center_col:
         label_visibility="collapsed",
         on_change=run_generation,
     )
+    topic_suggestions()
+    st.checkbox(
+        "캐시 무시하고 새로 생성",
+        key="force_regenerate",
+        help="같은 주제를 이전에 생성했더라도 저장된 결과 대신 새로 요청합니다.",
+    )
+    st.toggle(
+        "장편 모드 (개요 → 섹션별 동시 생성)",
+        key="longform_mode",
+        help="콘텐츠 구성 지침의 흐름대로 섹션을 나눠 생성한 뒤 이어 붙입니다.",
+    )
+    st.toggle(
+        "백그라운드 실행",
+        key="background_jobs",
+        help="생성을 작업 큐에 넣고 바로 돌아옵니다. 여러 주제를 연달아 넣어두고 끝난 것부터 볼 수 있습니다.",
+    )
+
+if st.session_state.longform_mode:
+    longform_set = active_instruction_set()
+    longform_sections = parse_structure_sections(st.session_state.inst_structure)
+    with st.expander(f"🧩 섹션별 지침 ({' → '.join(longform_sections)})", expanded=False):
+        if longform_set is None:
+            st.caption("섹션별 지침은 지침 set을 선택한 뒤 사용할 수 있습니다.")
+        else:
+            st.caption("섹션마다 덧붙일 지침입니다. 바꾼 섹션만 다시 생성되고 나머지는 캐시를 씁니다.")
+            section_notes = dict(longform_set.get("section_instructions") or {})
+            with st.form("section_instructions_form"):
+                for section_name in longform_sections:
+                    section_notes[section_name] = st.text_area(
+                        section_name,
+                        section_notes.get(section_name, ""),
+                        height=70,
+                        key=f"section_note_{section_name}",
+                    ).strip()
+                if st.form_submit_button("섹션별 지침 저장"):
+                    longform_set["section_instructions"] = section_notes
+                    get_config_store().update_set_field(
+                        longform_set["id"], "section_instructions", section_notes
+                    )
+                    st.success("섹션별 지침이 저장되었습니다.")
 
 st.markdown("<div style='height:32px;'></div>", unsafe_allow_html=True)
 
+# ============================
+# 백그라운드 작업 목록
+# ============================
+JOB_STATUS_LABELS = {"queued": "⏳ 대기", "running": "✍️ 생성 중", "done": "✅ 완료", "failed": "⚠️ 실패"}
+
+
+def open_job_result(job: dict):
+    set_last_output(job["result"]["text"])
+    record_generation_metrics(**job["result"]["metrics"])
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def render_job_list_live():
+    # 진행 중인 작업이 있을 때만 이 조각이 주기적으로 다시 그려진다.
+    jobs = get_job_queue().get_many(st.session_state.my_jobs)
+    render_job_rows(jobs)
+    if not any(job["status"] in ("queued", "running") for job in jobs):
+        st.rerun()
+
+
+def render_job_rows(jobs: list):
+    for job in reversed(jobs):
+        col_job, col_open = st.columns([5, 1])
+        with col_job:
+            elapsed = (job["finished_at"] or time.time()) - (job["started_at"] or job["created_at"])
+            label = JOB_STATUS_LABELS[job["status"]]
+            st.markdown(f"**{job['topic']}** · {job['model']} · {label} · {elapsed:.1f}초")
+            if job["status"] == "running" and job["partial"]:
+                st.caption(f"{len(job['partial']):,}자 받음 · …{job['partial'][-80:]}")
+            elif job["status"] == "failed":
+                st.caption(job["error"])
+        with col_open:
+            if job["status"] == "done":
+                if st.button("결과 보기", key=f"job_open_{job['id']}"):
+                    open_job_result(job)
+                    # 조각 안에서 눌려도 결과 영역까지 다시 그리도록 전체를 다시 실행한다.
+                    st.rerun()
+
+
+if st.session_state.my_jobs:
+    with st.expander("🗂 백그라운드 작업", expanded=True):
+        session_jobs = get_job_queue().get_many(st.session_state.my_jobs)
+        if any(job["status"] in ("queued", "running") for job in session_jobs):
+            render_job_list_live()
+        else:
+            render_job_rows(session_jobs)
+            if st.button("목록 비우기", key="job_clear"):
+                st.session_state.my_jobs = []
+                st.rerun()
+
+# ============================
+# 지난 주제: 전체 기록 검색 · 다시 생성
+# ============================
+@st.fragment
+def topic_history_panel():
+    """지난 주제 목록. 검색·정렬·페이지 넘김은 이 부분만 다시 그리고, 다시 생성할 때만 앱 전체를 다시 그린다."""
+    with st.expander("🕒 지난 주제", expanded=False):
+        col_query, col_order = st.columns([3, 2])
+        with col_query:
+            history_query = st.text_input(
+                "주제 검색", key="history_query", placeholder="지난 주제 검색",
+                label_visibility="collapsed", on_change=set_list_page, args=("history_page", 0),
+            )
+        with col_order:
+            history_order = st.radio(
+                "정렬", ["최근 순", "많이 쓴 순"], key="history_order", horizontal=True,
+                label_visibility="collapsed", on_change=set_list_page, args=("history_page", 0),
+            )
+        order = "frequent" if history_order == "많이 쓴 순" else "recent"
+        page = st.session_state.history_page
+        rows, total = topic_history().page(
+            history_query, page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE, order
+        )
+        pages = max(1, math.ceil(total / HISTORY_PAGE_SIZE))
+        if page >= pages and total:
+            # 기록이 줄어 지금 페이지가 사라졌으면 마지막 페이지로
+            st.session_state.history_page = page = pages - 1
+            rows, total = topic_history().page(
+                history_query, page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE, order
+            )
+        if not rows:
+            st.caption("조건에 맞는 주제가 없습니다." if history_query.strip() else "지난 주제가 없습니다.")
+        for i, row in enumerate(rows):
+            used = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["used_at"]))
+            col_topic, col_rerun = st.columns([5, 1])
+            with col_topic:
+                st.markdown(f"**{row['topic']}** · {row['count']}회 · {used}")
+            with col_rerun:
+                st.button(
+                    "↻ 다시", key=f"history_rerun_{page}_{i}", use_container_width=True,
+                    on_click=request_topic_rerun, args=(row["topic"],),
+                )
+        list_page_controls("history_page", page, pages, total)
+        if st.session_state.get("rerun_topic"):
+            st.rerun()
+
+
+topic_history_panel()
+
+# ============================
+# 지난 대본 검색 (생성 아카이브)
+# ============================
+@st.fragment
+def archive_search_panel():
+    """지난 대본 검색. 검색어 입력·불러오기 전까지는 이 부분만 다시 그린다."""
+    with st.expander("🔎 지난 대본 검색", expanded=False):
+        archive_store = get_config_store()
+        if not archive_store.archive_enabled:
+            st.caption("생성 아카이브는 SQLite 저장소(SCRIPTKING_STORAGE=sqlite)에서만 사용할 수 있습니다.")
+        else:
+            st.caption("지금까지 생성한 모든 대본을 주제와 본문으로 검색합니다.")
+            archive_query = st.text_input(
+                "검색어", key="archive_query", placeholder="예: 월드컵 경제", label_visibility="collapsed"
+            )
+            if archive_query.strip():
+                search_started = time.perf_counter()
+                archive_hits = archive_store.search_outputs(archive_query.strip())
+                search_ms = (time.perf_counter() - search_started) * 1000
+                st.caption(f"{len(archive_hits)}건 · {search_ms:.1f} ms")
+                for hit in archive_hits:
+                    created = time.strftime("%Y-%m-%d %H:%M", time.localtime(hit["created_at"]))
+                    col_hit, col_load = st.columns([5, 1])
+                    with col_hit:
+                        st.markdown(f"**{hit['topic']}** · {hit['model']} · {created}")
+                        st.caption(hit["snippet"])
+                    with col_load:
+                        if st.button("불러오기", key=f"archive_load_{hit['id']}"):
+                            record = archive_store.get_output(hit["id"])
+                            if record:
+                                set_last_output(record["output"])
+                                st.session_state.last_metrics = None
+                                st.rerun()
+
+
+archive_search_panel()
+
+# ============================
+# 모델 비교: 같은 프롬프트 × 여러 모델
+# ============================
+@st.fragment
+def model_compare_panel():
+    """모델 비교. 모델 고르기·비교 생성은 이 부분만 다시 그린다."""
+    with st.expander("⚖️ 모델 비교", expanded=False):
+        st.caption("입력한 주제를 현재 지침 set으로 여러 모델에 동시에 보내 결과와 속도·토큰·예상 비용을 나란히 봅니다.")
+        st.multiselect("비교할 모델", MODEL_OPTIONS, key="compare_models")
+
+        if st.button("비교 생성", use_container_width=True, key="compare_start"):
+            compare_topic = st.session_state.current_input.strip()
+            if not compare_topic:
+                st.error("먼저 위 입력창에 주제를 입력해주세요.")
+            elif len(st.session_state.compare_models) < 2:
+                st.error("비교할 모델을 두 개 이상 골라주세요.")
+            else:
+                with st.spinner(f"{len(st.session_state.compare_models)}개 모델에 동시에 요청하는 중..."):
+                    st.session_state.compare_results = run_model_comparison(
+                        compare_topic, list(st.session_state.compare_models)
+                    )
+                # 결과 칸은 key가 있는 위젯이라 새 비교 결과는 위젯 값에 직접 넣는다.
+                for item in st.session_state.compare_results["results"]:
+                    st.session_state[f"compare_text_{item['model']}"] = item["text"]
+
+        comparison = st.session_state.compare_results
+        if comparison:
+            st.markdown(f"**{comparison['topic']}**")
+            compare_cols = st.columns(len(comparison["results"]))
+            for col, item in zip(compare_cols, comparison["results"]):
+                with col:
+                    st.markdown(f"##### {item['model']}")
+                    if item["error"]:
+                        st.error(item["error"])
+                        continue
+                    cost_text = f"${item['cost']:.5f}" if item["cost"] is not None else "단가 미등록"
+                    token_note = " (추정)" if item["estimated"] else ""
+                    st.caption(
+                        f"{'캐시 · ' if item['cache_hit'] else ''}{item['latency']:.2f}초 · "
+                        f"입력 {item['prompt_tokens']:,} / 출력 {item['completion_tokens']:,} 토큰{token_note} · "
+                        f"{cost_text}"
+                    )
+                    if item["truncated"]:
+                        st.caption("⚠️ 출력 상한에서 잘림")
+                    text_key = f"compare_text_{item['model']}"
+                    if text_key not in st.session_state:
+                        st.session_state[text_key] = item["text"]
+                    st.text_area(
+                        item["model"], height=300,
+                        key=text_key, label_visibility="collapsed",
+                    )
+
+        compare_stats = get_config_store().model_stats()
+        if compare_stats:
+            set_names = instruction_set_registry().names()
+            st.markdown("**set × 모델 누적 기록**")
+            stats_rows = []
+            for row in compare_stats:
+                avg_cost = estimate_cost(row["model"], row["prompt_tokens"], row["completion_tokens"])
+                stats_rows.append({
+                    "지침 set": set_names.get(row["set_id"], row["set_id"] or "-"),
+                    "모델": row["model"],
+                    "생성 수": row["count"],
+                    "평균 소요(초)": round(row["latency"], 2) if row["latency"] is not None else None,
+                    "평균 출력 토큰": round(row["completion_tokens"]) if row["completion_tokens"] is not None else None,
+                    "평균 비용($)": round(avg_cost, 5) if avg_cost is not None else None,
+                })
+            st.dataframe(stats_rows, use_container_width=True)
+
+
+model_compare_panel()
+
+# ============================
+# 지침 set A/B 실험: 주제 목록 × 여러 set
+# ============================
+@st.fragment
+def set_experiment_panel():
+    """지침 set 비교 실험. 설정을 바꾸고 실행해도 이 부분만 다시 그린다."""
+    with st.expander("🧪 지침 set 비교 실험", expanded=False):
+        st.caption(
+            "여러 주제를 두 개 이상의 지침 set으로 같은 모델에 생성해 set끼리 비교합니다. "
+            "이미 만든 조합은 캐시를 씁니다."
+        )
+        experiment_set_names = instruction_set_registry().names()
+        experiment_set_ids = st.multiselect(
+            "비교할 지침 set",
+            list(experiment_set_names),
+            format_func=lambda set_id: experiment_set_names[set_id],
+            key="experiment_set_ids",
+        )
+        experiment_text = st.text_area(
+            "실험 주제",
+            height=120,
+            key="experiment_topics_input",
+            placeholder="한 줄에 하나씩 주제를 적어주세요.",
+            label_visibility="collapsed",
+        )
+        experiment_concurrency = st.slider(
+            "동시 요청 수", 1, BATCH_MAX_CONCURRENCY, 4, key="experiment_concurrency"
+        )
+
+        if st.button("실험 시작", use_container_width=True, key="experiment_start"):
+            experiment_topics = parse_batch_topics(experiment_text, None)
+            if len(experiment_set_ids) < 2:
+                st.error("비교할 지침 set을 두 개 이상 골라주세요.")
+            elif not experiment_topics:
+                st.error("실험할 주제를 입력해주세요.")
+            elif len(experiment_topics) * len(experiment_set_ids) > EXPERIMENT_MAX_PAIRS:
+                st.error(f"주제 × set 조합은 한 번에 {EXPERIMENT_MAX_PAIRS}개까지 실행할 수 있습니다.")
+            else:
+                experiment_progress = st.progress(
+                    0.0, text=f"0/{len(experiment_topics) * len(experiment_set_ids)} 완료"
+                )
+                st.session_state.experiment_results = run_set_experiment(
+                    experiment_topics, list(experiment_set_ids), experiment_concurrency, experiment_progress
+                )
+
+        experiment = st.session_state.experiment_results
+        if experiment:
+            st.markdown(f"**set별 요약** · {experiment['model']}")
+            st.dataframe(summarize_experiment(experiment, experiment_set_names), use_container_width=True)
+            st.markdown("**주제 × set**  (✓ 목표 길이 달성 · ✗ 미달 · ⚠️ 잘림)")
+            st.dataframe(experiment_matrix(experiment, experiment_set_names), use_container_width=True)
+
+
+set_experiment_panel()
+
+# ============================
+# 일괄 생성: 여러 주제 × 현재 지침 set
+# ============================
+@st.fragment
+def batch_generation_panel():
+    """일괄 생성. 주제 입력·실행은 이 부분만 다시 그린다."""
+    with st.expander("📦 일괄 생성 (여러 주제 한 번에)", expanded=False):
+        st.caption("한 줄에 하나씩 주제를 적거나 txt/csv 파일을 올리면, 현재 지침 set으로 동시에 생성합니다.")
+        batch_text = st.text_area(
+            "일괄 생성 주제",
+            height=140,
+            key="batch_topics_input",
+            placeholder="축구의 경제학\n인공지능이 바꿀 우리의 일상",
+            label_visibility="collapsed",
+        )
+        batch_file = st.file_uploader(
+            "주제 파일 (txt/csv)", type=["txt", "csv"], key="batch_topics_file",
+            help="csv는 첫 번째 열을 주제로 사용합니다.",
+        )
+        batch_concurrency = st.slider("동시 요청 수", 1, BATCH_MAX_CONCURRENCY, 4, key="batch_concurrency")
+
+        if st.button("일괄 생성 시작", use_container_width=True, key="batch_start"):
+            batch_topics = parse_batch_topics(batch_text, batch_file)
+            if not batch_topics:
+                st.error("생성할 주제를 입력하거나 파일을 올려주세요.")
+            else:
+                batch_progress = st.progress(0.0, text=f"0/{len(batch_topics)} 완료")
+                batch_table = st.empty()
+                st.session_state.batch_results = run_batch_generation(
+                    batch_topics, batch_concurrency, batch_table, batch_progress
+                )
+        elif st.session_state.batch_results:
+            st.dataframe(
+                [
+                    {"주제": r["topic"], "상태": "완료" if not r["error"] else f"실패: {r['error']}",
+                     "글자 수": len(r["text"])}
+                    for r in st.session_state.batch_results
+                ],
+                use_container_width=True,
+            )
+
+        if st.session_state.batch_results:
+            st.download_button(
+                "⬇️ 결과 묶음(zip) 내려받기",
+                data=build_batch_bundle(st.session_state.batch_results),
+                file_name="scriptking_batch.zip",
+                mime="application/zip",
+                use_container_width=True,
+            )
+
+
+batch_generation_panel()
+
 # ============================
 # 생성 결과: 가운데 정렬 제목 + 넓은 스크롤 texteditor
 # ============================
-if st.session_state.last_output:
+pending_generation = st.session_state.pending_generation
+st.session_state.pending_generation = None
+
+if pending_generation or st.session_state.last_output or st.session_state.generation_error:
     st.markdown(
         "<h3 style='text-align:center; margin-bottom:0.75rem;'>📄 생성된 내레이션</h3>",
         unsafe_allow_html=True,
     )
-    output_text = st.text_area(
-        "",
-        value=st.session_state.last_output,
+    if pending_generation:
+        stream_box = st.empty()
+        if pending_generation.get("mode") == "longform":
+            set_last_output(run_longform_generation(pending_generation, stream_box))
+        else:
+            set_last_output(stream_generation(pending_generation, stream_box))
+        stream_box.empty()
+    if st.session_state.generation_error:
+        st.error(st.session_state.generation_error)
+        st.session_state.generation_error = None
+        st.button("🔁 다시 시도", key="retry_generation", on_click=run_generation)
+    if "output_editor" not in st.session_state:
+        # 결과 영역을 그리지 않은 실행이 있으면 위젯 값이 지워지므로 last_output에서 다시 채운다.
+        st.session_state.output_editor = st.session_state.last_output
+    st.text_area(
+        "생성된 내레이션",
         height=400,
         key="output_editor",
         label_visibility="collapsed",
+        on_change=keep_output_edit,
     )
-    st.session_state.last_output = output_text
+    if st.session_state.last_metrics:
+        if st.session_state.last_metrics.get("truncated"):
+            st.warning(
+                "⚠️ 출력 토큰 상한에 걸려 대본이 중간에 잘렸습니다. "
+                "지침 set 편집에서 '최대 출력 토큰'을 늘리거나 분량 지침을 줄여주세요."
+            )
+        st.caption(format_generation_metrics(st.session_state.last_metrics))
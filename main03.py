@@ -1,35 +1,60 @@
 import streamlit as st
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 import os
-import json
-from json import JSONDecodeError
+import html
+
+from generation import format_generation_metrics, run_generation_request
+from user_config import AccountStore, UserConfigStore, migrate_legacy_config
 
 st.set_page_config(page_title="대본 마스터", page_icon="📝", layout="centered")
 
 LOGIN_ID_ENV = os.getenv("LOGIN_ID")
 LOGIN_PW_ENV = os.getenv("LOGIN_PW")
 api_key = os.getenv("GPT_API_KEY")
-client = OpenAI(api_key=api_key)
 
+# OpenAI HTTP 연결 풀 (프로세스 하나에서 모든 세션이 같이 쓴다)
+HTTP_MAX_CONNECTIONS = int(os.getenv("SCRIPTKING_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("SCRIPTKING_HTTP_MAX_KEEPALIVE", "10"))
+HTTP_TIMEOUT = float(os.getenv("SCRIPTKING_HTTP_TIMEOUT", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("SCRIPTKING_HTTP_CONNECT_TIMEOUT", "5"))
+
+
+@st.cache_resource
+def get_openai_client(key: str) -> OpenAI:
+    """재실행마다 새로 만들지 않고 프로세스 전체가 공유하는 OpenAI 클라이언트."""
+    timeout = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        ),
+        timeout=timeout,
+    )
+    return OpenAI(api_key=key, http_client=http_client, timeout=timeout)
+
+
+client = get_openai_client(api_key)
+
+# 예전에는 모든 세션이 이 파일 하나를 같이 썼다. 이제는 처음 한 번 옮겨올 때만 읽는다.
 CONFIG_PATH = "config.json"
 
-st.markdown(
-    """
-    <style>
-    textarea {
-        font-size: 0.8rem !important;
-        line-height: 1.3 !important;
-    }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+
+@st.cache_resource
+def get_user_stores():
+    """로그인 계정과 사용자별 설정 저장소. 예전 config.json의 설정·계정을 한 번 옮겨온다."""
+    accounts = AccountStore()
+    configs = UserConfigStore()
+    migrate_legacy_config(configs, CONFIG_PATH, owner=LOGIN_ID_ENV, accounts=accounts)
+    accounts.ensure(LOGIN_ID_ENV, LOGIN_PW_ENV)
+    return accounts, configs
+
+
+accounts, user_configs = get_user_stores()
 
 st.session_state.setdefault("logged_in", False)
 st.session_state.setdefault("history", [])
-st.session_state.setdefault("login_id", LOGIN_ID_ENV or "")
-st.session_state.setdefault("login_pw", LOGIN_PW_ENV or "")
-st.session_state.setdefault("remember_login", False)
+st.session_state.setdefault("user_id", None)
 
 st.session_state.setdefault(
     "inst_role",
@@ -63,16 +88,15 @@ st.session_state.setdefault(
 st.session_state.setdefault("current_input", "")
 st.session_state.setdefault("last_output", "")
 st.session_state.setdefault("model_choice", "gpt-4o-mini")
+st.session_state.setdefault("stream_output", True)
+st.session_state.setdefault("pending_generation", None)
+st.session_state.setdefault("generation_error", None)
+st.session_state.setdefault("last_metrics", None)
+st.session_state.setdefault("generation_metrics", [])
 
 
 def load_config():
-    if not os.path.exists(CONFIG_PATH):
-        return
-    try:
-        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except JSONDecodeError:
-        return
+    data = user_configs.load(st.session_state.user_id)
 
     if isinstance(data.get("inst_role"), str):
         st.session_state.inst_role = data["inst_role"]
@@ -94,13 +118,6 @@ def load_config():
     if isinstance(hist, list):
         st.session_state.history = hist[-5:]
 
-    if isinstance(data.get("login_id"), str):
-        st.session_state.login_id = data["login_id"]
-    if isinstance(data.get("login_pw"), str):
-        st.session_state.login_pw = data["login_pw"]
-    if "remember_login" in data:
-        st.session_state.remember_login = bool(data["remember_login"])
-
 
 def save_config():
     data = {
@@ -112,21 +129,19 @@ def save_config():
         "inst_format": st.session_state.inst_format,
         "inst_user_intent": st.session_state.inst_user_intent,
         "history": st.session_state.history[-5:],
-        "login_id": st.session_state.login_id,
-        "login_pw": st.session_state.login_pw,
-        "remember_login": st.session_state.remember_login,
     }
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    user_configs.save(st.session_state.user_id, data)
 
 
-# === config.json 및 세션 초기화 함수 ===
+# === 내 설정 및 세션 초기화 함수 ===
 def reset_config():
-    # config.json 파일 삭제
-    if os.path.exists(CONFIG_PATH):
-        os.remove(CONFIG_PATH)
+    # 로그인한 사용자의 설정 파일만 비운다 (다른 사용자·계정은 그대로)
+    user_configs.reset(st.session_state.user_id)
+    end_user_session()
+
 
-    # 세션 값 초기화 (지침/로그인/최근 기록/입력/결과 등)
+def end_user_session():
+    # 세션 값 초기화 (지침/최근 기록/입력/결과 등)
     for key in [
         "inst_role",
         "inst_tone",
@@ -136,12 +151,15 @@ def reset_config():
         "inst_format",
         "inst_user_intent",
         "history",
-        "login_id",
-        "login_pw",
-        "remember_login",
+        "user_id",
         "current_input",
         "last_output",
         "model_choice",
+        "stream_output",
+        "pending_generation",
+        "generation_error",
+        "last_metrics",
+        "generation_metrics",
     ]:
         if key in st.session_state:
             del st.session_state[key]
@@ -186,43 +204,40 @@ def login_screen():
         unsafe_allow_html=True,
     )
 
-    default_id = st.session_state.login_id if st.session_state.remember_login else ""
-    default_pw = st.session_state.login_pw if st.session_state.remember_login else ""
-
+    # 로그인 정보를 서버 파일에 저장해 미리 채워두면 접속한 모든 사람에게 보이므로 채우지 않는다.
+    # 아이디·비밀번호 저장은 브라우저의 비밀번호 관리자에 맡긴다.
     with st.form(key="login_form"):
-        user = st.text_input("아이디", placeholder="ID 입력", value=default_id)
-        pw = st.text_input("비밀번호", type="password", placeholder="비밀번호", value=default_pw)
-        remember = st.checkbox("로그인 정보 저장", value=st.session_state.remember_login)
+        user = st.text_input("아이디", placeholder="ID 입력")
+        pw = st.text_input("비밀번호", type="password", placeholder="비밀번호")
 
         submitted = st.form_submit_button("로그인")
         if submitted:
-            valid_id = st.session_state.login_id or LOGIN_ID_ENV or ""
-            valid_pw = st.session_state.login_pw or LOGIN_PW_ENV or ""
-
-            if user == valid_id and pw == valid_pw:
+            if user and accounts.verify(user, pw):
                 st.session_state["logged_in"] = True
-                st.session_state["remember_login"] = remember
-                if remember:
-                    st.session_state.login_id = user
-                    st.session_state.login_pw = pw
-                save_config()
+                st.session_state["user_id"] = user
+                st.session_state.pop("config_loaded", None)
                 st.rerun()
             else:
                 st.error("❌ 아이디 또는 비밀번호가 틀렸습니다.")
 
 
-if "config_loaded" not in st.session_state:
-    load_config()
-    st.session_state.config_loaded = True
-
 if not st.session_state["logged_in"]:
     login_screen()
     st.stop()
 
-# 메인 영역 폭 넓게 조정 + div3 인풋 스타일
+# 설정은 로그인한 사용자 것을 읽는다 (사용자별 캐시에서, 세션당 한 번)
+if "config_loaded" not in st.session_state:
+    load_config()
+    st.session_state.config_loaded = True
+
+# 메인 영역 폭 넓게 조정 + div3 인풋 스타일 (페이지 스타일은 이 블록 하나로 보낸다)
 st.markdown(
     """
     <style>
+    textarea {
+        font-size: 0.8rem !important;
+        line-height: 1.3 !important;
+    }
     .block-container {
         max-width: 900px;
         padding-top: 4.5rem;
@@ -285,25 +300,65 @@ def run_generation():
 
     user_text = f"다음 주제에 맞는 다큐멘터리 내레이션을 작성해줘.\n\n주제: {topic}"
 
-    with st.spinner("🎬 대본을 작성하는 중입니다..."):
-        res = client.chat.completions.create(
-            model=st.session_state.model_choice,
-            messages=[
-                {"role": "system", "content": system_text},
-                {"role": "user", "content": user_text},
-            ],
-            max_tokens=600,
-        )
+    messages = [
+        {"role": "system", "content": system_text},
+        {"role": "user", "content": user_text},
+    ]
 
-    st.session_state.last_output = res.choices[0].message.content
+    # 스트리밍 모드: 결과 영역에서 토큰을 받아가며 그리도록 요청만 넘겨둔다.
+    if st.session_state.stream_output:
+        st.session_state.pending_generation = {
+            "model": st.session_state.model_choice,
+            "messages": messages,
+        }
+        return
 
+    text = run_generation_request(
+        client, {"model": st.session_state.model_choice, "messages": messages}
+    )
+    if text is not None:
+        st.session_state.last_output = text
 
-# -------- 사이드바 --------
-with st.sidebar:
-    st.markdown("<div class='sidebar-top'>", unsafe_allow_html=True)
 
-    st.markdown("### 📘 지침")
+@st.cache_data(max_entries=256, show_spinner=False)
+def recent_history_html(items: tuple) -> str:
+    """최근 검색어 HTML. 같은 목록이면 다시 만들지 않는다."""
+    if not items:
+        return """<div style="
+    max-width:460px;
+    margin:64px auto 72px auto;
+">
+  <div style="margin-left:100px; font-size:0.8rem; color:#d1d5db; text-align:left;">
+    최근 입력이 없습니다.
+  </div>
+</div>"""
+    html_items = "".join(
+        f"""
+<div style="
+    font-size:0.85rem;
+    color:#797979;
+    margin-bottom:4px;
+">{html.escape(h)}</div>
+"""
+        for h in items
+    )
+    return f"""<div style="
+    max-width:460px;
+    margin:64px auto 72px auto;
+">
+  <div style="margin-left:100px; text-align:left;">
+    <div style="font-size:0.8rem; color:#9ca3af; margin-bottom:10px;">
+      최근
+    </div>
+    {html_items}
+  </div>
+</div>"""
 
+
+# -------- 사이드바 --------
+@st.fragment
+def instruction_editors():
+    """사이드바 지침 편집. 입력·저장은 이 부분만 다시 그린다 (지침은 생성할 때만 읽는다)."""
     with st.expander("1. 역할 지침 (Role Instructions)", expanded=False):
         st.caption("ChatGPT가 어떤 캐릭터 / 전문가 / 화자인지 정의합니다.")
         st.markdown(
@@ -436,10 +491,10 @@ with st.sidebar:
                 save_config()
             st.success("사용자 요청 반영 지침이 저장되었습니다.")
 
-    st.markdown("</div><div class='sidebar-bottom'>", unsafe_allow_html=True)
-
-    st.markdown("### ⚙️ 설정")
 
+@st.fragment
+def settings_panel():
+    """모델 선택·계정·초기화. 로그아웃·초기화할 때만 앱 전체를 다시 그린다."""
     with st.expander("GPT 모델 선택", expanded=False):
         model = st.selectbox(
             "",
@@ -451,6 +506,12 @@ with st.sidebar:
         )
         st.session_state.model_choice = model
 
+        st.toggle(
+            "스트리밍 출력",
+            key="stream_output",
+            help="응답을 기다리지 않고 생성되는 대로 결과 영역에 이어서 보여줍니다.",
+        )
+
     with st.expander("👤 계정 관리", expanded=False):
         st.caption("비밀번호 변경 및 로그아웃")
 
@@ -461,30 +522,40 @@ with st.sidebar:
             pw_submitted = st.form_submit_button("비밀번호 변경")
 
             if pw_submitted:
-                valid_pw = st.session_state.login_pw or LOGIN_PW_ENV or ""
-                if current_pw != valid_pw:
+                if not accounts.verify(st.session_state.user_id, current_pw):
                     st.error("현재 비밀번호가 올바르지 않습니다.")
                 elif not new_pw:
                     st.error("새 비밀번호를 입력하세요.")
                 elif new_pw != new_pw2:
                     st.error("새 비밀번호와 확인이 일치하지 않습니다.")
                 else:
-                    st.session_state.login_pw = new_pw
-                    save_config()
+                    accounts.set_password(st.session_state.user_id, new_pw)
                     st.success("비밀번호가 변경되었습니다.")
 
         if st.button("🚪 로그아웃", use_container_width=True):
-            st.session_state.logged_in = False
-            st.session_state.current_input = ""
-            st.session_state.last_output = ""
-            st.rerun()
-
-    # === config.json 초기화 섹션 ===
-    with st.expander("🧹 설정 초기화 (config.json)", expanded=False):
-        st.caption("모든 지침, 최근 입력, 로그인 정보, config.json 파일을 초기화합니다. 되돌릴 수 없습니다.")
-        if st.button("config.json 초기화", use_container_width=True):
+            # 같은 브라우저에서 다른 사람이 로그인해도 앞사람의 지침이 남지 않게 세션을 비운다.
+            end_user_session()
+
+    # === 내 설정 초기화 섹션 ===
+    with st.expander("🧹 설정 초기화", expanded=False):
+        st.caption("내 지침과 최근 입력을 초기화합니다. 계정과 다른 사용자의 설정은 그대로입니다. 되돌릴 수 없습니다.")
+        if st.button("내 설정 초기화", use_container_width=True):
             reset_config()
 
+
+with st.sidebar:
+    st.markdown("<div class='sidebar-top'>", unsafe_allow_html=True)
+
+    st.markdown("### 📘 지침")
+
+    instruction_editors()
+
+    st.markdown("</div><div class='sidebar-bottom'>", unsafe_allow_html=True)
+
+    st.markdown("### ⚙️ 설정")
+
+    settings_panel()
+
     st.markdown("</div>", unsafe_allow_html=True)
 
 # -------- div1: 상단 로고 + 타이틀 --------
@@ -505,45 +576,7 @@ st.markdown(
 )
 
 # -------- div2: 최근 검색어 --------
-if st.session_state.history:
-    items = st.session_state.history[-5:]
-
-    html_items = ""
-    for h in items:
-        html_items += f"""
-<div style="
-    font-size:0.85rem;
-    color:#797979;
-    margin-bottom:4px;
-">{h}</div>
-"""
-
-    st.markdown(
-        f"""<div style="
-    max-width:460px;
-    margin:64px auto 72px auto;
-">
-  <div style="margin-left:100px; text-align:left;">
-    <div style="font-size:0.8rem; color:#9ca3af; margin-bottom:10px;">
-      최근
-    </div>
-    {html_items}
-  </div>
-</div>""",
-        unsafe_allow_html=True,
-    )
-else:
-    st.markdown(
-        """<div style="
-    max-width:460px;
-    margin:64px auto 72px auto;
-">
-  <div style="margin-left:100px; font-size:0.8rem; color:#d1d5db; text-align:left;">
-    최근 입력이 없습니다.
-  </div>
-</div>""",
-        unsafe_allow_html=True,
-    )
+st.markdown(recent_history_html(tuple(st.session_state.history[-5:])), unsafe_allow_html=True)
 
 # -------- div3: 입력 영역 (가운데 정렬, 버튼 제거) --------
 pad_left, center_col, pad_right = st.columns([1, 7, 1])
@@ -565,6 +598,20 @@ with center_col:
 st.markdown("<div style='height:32px;'></div>", unsafe_allow_html=True)
 
 # -------- 결과 --------
-if st.session_state.last_output:
+pending_generation = st.session_state.pending_generation
+st.session_state.pending_generation = None
+
+if pending_generation or st.session_state.last_output or st.session_state.generation_error:
     st.subheader("📄 생성된 내레이션")
-    st.write(st.session_state.last_output)
+    streamed = None
+    if pending_generation:
+        streamed = run_generation_request(client, pending_generation, st.empty())
+        if streamed is not None:
+            st.session_state.last_output = streamed
+    if st.session_state.generation_error:
+        st.error(st.session_state.generation_error)
+        st.session_state.generation_error = None
+    if streamed is None:
+        st.write(st.session_state.last_output)
+    if st.session_state.last_metrics:
+        st.caption(format_generation_metrics(st.session_state.last_metrics))
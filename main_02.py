@@ -1,8 +1,10 @@
 import streamlit as st
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 import os
-import json
-from json import JSONDecodeError
+
+from generation import format_generation_metrics, run_generation_request
+from user_config import UserConfigStore, migrate_legacy_config
 
 # -------------------------
 # 기본 설정
@@ -12,14 +14,49 @@ st.set_page_config(page_title="대본 마스터", page_icon="📝", layout="cent
 LOGIN_ID = os.getenv("LOGIN_ID")
 LOGIN_PW = os.getenv("LOGIN_PW")
 api_key = os.getenv("GPT_API_KEY")
-client = OpenAI(api_key=api_key)
 
+# OpenAI HTTP 연결 풀 (프로세스 하나에서 모든 세션이 같이 쓴다)
+HTTP_MAX_CONNECTIONS = int(os.getenv("SCRIPTKING_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("SCRIPTKING_HTTP_MAX_KEEPALIVE", "10"))
+HTTP_TIMEOUT = float(os.getenv("SCRIPTKING_HTTP_TIMEOUT", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("SCRIPTKING_HTTP_CONNECT_TIMEOUT", "5"))
+
+
+@st.cache_resource
+def get_openai_client(key: str) -> OpenAI:
+    """재실행마다 새로 만들지 않고 프로세스 전체가 공유하는 OpenAI 클라이언트."""
+    timeout = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        ),
+        timeout=timeout,
+    )
+    return OpenAI(api_key=key, http_client=http_client, timeout=timeout)
+
+
+client = get_openai_client(api_key)
+
+# 예전에는 모든 세션이 이 파일 하나를 같이 썼다. 이제는 처음 한 번 옮겨올 때만 읽는다.
 CONFIG_PATH = "config.json"
 
+
+@st.cache_resource
+def get_user_config_store() -> UserConfigStore:
+    """사용자별 설정 저장소. 예전 config.json은 LOGIN_ID 사용자의 설정으로 옮겨온다."""
+    configs = UserConfigStore()
+    migrate_legacy_config(configs, CONFIG_PATH, owner=LOGIN_ID)
+    return configs
+
+
+user_configs = get_user_config_store()
+
 # -------------------------
 # 세션 기본값
 # -------------------------
 st.session_state.setdefault("logged_in", False)
+st.session_state.setdefault("user_id", None)
 st.session_state.setdefault("history", [])
 
 # 역할 지침 (system)
@@ -38,20 +75,18 @@ st.session_state.setdefault(
 st.session_state.setdefault("current_input", "")
 st.session_state.setdefault("last_output", "")
 st.session_state.setdefault("model_choice", "gpt-4o-mini")
+st.session_state.setdefault("stream_output", True)
+st.session_state.setdefault("pending_generation", None)
+st.session_state.setdefault("generation_error", None)
+st.session_state.setdefault("last_metrics", None)
+st.session_state.setdefault("generation_metrics", [])
 
 
 # -------------------------
 # 설정 JSON 로드/저장
 # -------------------------
 def load_config():
-    if not os.path.exists(CONFIG_PATH):
-        return
-
-    try:
-        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except JSONDecodeError:
-        return
+    data = user_configs.load(st.session_state.user_id)
 
     # 이전 버전 호환: instruction → role_instruction
     if isinstance(data.get("role_instruction"), str):
@@ -73,13 +108,7 @@ def save_config():
         "task_instruction": st.session_state.task_instruction,
         "history": st.session_state.history[-5:]
     }
-    with open(CONFIG_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-
-if "config_loaded" not in st.session_state:
-    load_config()
-    st.session_state.config_loaded = True
+    user_configs.save(st.session_state.user_id, data)
 
 
 # -------------------------
@@ -107,6 +136,7 @@ def login_screen():
         if submitted:
             if user == LOGIN_ID and pw == LOGIN_PW:
                 st.session_state["logged_in"] = True
+                st.session_state["user_id"] = user
                 st.rerun()
             else:
                 st.error("❌ 아이디 또는 비밀번호가 틀렸습니다.")
@@ -116,6 +146,11 @@ if not st.session_state["logged_in"]:
     login_screen()
     st.stop()
 
+# 설정은 로그인한 사용자 것을 읽는다 (사용자별 캐시에서, 세션당 한 번)
+if "config_loaded" not in st.session_state:
+    load_config()
+    st.session_state.config_loaded = True
+
 
 # -------------------------
 # 메인 화면 공통 스타일
@@ -158,17 +193,24 @@ def run_generation():
     task = st.session_state.task_instruction.strip()
     prompt = f"{task}\n\n주제: {topic}"
 
-    with st.spinner("🎬 대본을 작성하는 중입니다..."):
-        res = client.chat.completions.create(
-            model=st.session_state.model_choice,
-            messages=[
-                {"role": "system", "content": st.session_state.role_instruction},
-                {"role": "user", "content": prompt},
-            ],
-            max_tokens=600,
-        )
+    messages = [
+        {"role": "system", "content": st.session_state.role_instruction},
+        {"role": "user", "content": prompt},
+    ]
 
-    st.session_state.last_output = res.choices[0].message.content
+    # 스트리밍 모드: 결과 영역에서 토큰을 받아가며 그리도록 요청만 넘겨둔다.
+    if st.session_state.stream_output:
+        st.session_state.pending_generation = {
+            "model": st.session_state.model_choice,
+            "messages": messages,
+        }
+        return
+
+    text = run_generation_request(
+        client, {"model": st.session_state.model_choice, "messages": messages}
+    )
+    if text is not None:
+        st.session_state.last_output = text
 
 
 # -------------------------
@@ -184,6 +226,12 @@ with st.sidebar:
     )
     st.session_state.model_choice = model
 
+    st.toggle(
+        "스트리밍 출력",
+        key="stream_output",
+        help="응답을 기다리지 않고 생성되는 대로 결과 영역에 이어서 보여줍니다.",
+    )
+
     # 역할 지침
     with st.expander("역할 지침 수정하기", expanded=False):
         st.caption("현재 역할 지침:")
@@ -287,6 +335,20 @@ st.markdown("<div style='height:20px;'></div>", unsafe_allow_html=True)
 # -------------------------
 # 결과 출력
 # -------------------------
-if st.session_state.last_output:
+pending_generation = st.session_state.pending_generation
+st.session_state.pending_generation = None
+
+if pending_generation or st.session_state.last_output or st.session_state.generation_error:
     st.subheader("📄 생성된 내레이션")
-    st.write(st.session_state.last_output)
+    streamed = None
+    if pending_generation:
+        streamed = run_generation_request(client, pending_generation, st.empty())
+        if streamed is not None:
+            st.session_state.last_output = streamed
+    if st.session_state.generation_error:
+        st.error(st.session_state.generation_error)
+        st.session_state.generation_error = None
+    if streamed is None:
+        st.write(st.session_state.last_output)
+    if st.session_state.last_metrics:
+        st.caption(format_generation_metrics(st.session_state.last_metrics))
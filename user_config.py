@@ -0,0 +1,179 @@
+"""사용자별 설정 저장소와 로그인 계정 (main03.py · main_02.py · main-x.py 공용).
+
+예전에는 세 앱이 모두 작업 폴더의 config.json 하나를 같이 읽고 덮어써서,
+한 사람이 저장하면 다른 사람의 지침과 최근 입력이 사라졌다.
+이제 설정은 user_data/<사용자>/config.json에 따로 두고, 비밀번호는 설정 파일이 아니라
+accounts.json에 해시로만 저장한다.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+from contextlib import contextmanager
+from json import JSONDecodeError
+
+try:
+    import fcntl
+except ImportError:  # Windows: 파일 잠금 없이 프로세스 안의 잠금과 원자적 교체만 쓴다.
+    fcntl = None
+
+USER_DATA_DIR = "user_data"
+LEGACY_CONFIG_PATH = "config.json"
+ACCOUNTS_PATH = "accounts.json"
+PASSWORD_ITERATIONS = 200_000
+CREDENTIAL_KEYS = ("login_id", "login_pw", "remember_login")
+
+
+def user_dir(user_id: str, root: str = USER_DATA_DIR) -> str:
+    """사용자 id를 폴더 이름으로 바꾼다. 안전한 글자만 남기고, 겹치지 않도록 해시를 붙인다."""
+    slug = re.sub(r"[^0-9A-Za-z가-힣_.-]", "_", user_id).strip("._")[:40] or "user"
+    digest = hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(root, f"{slug}-{digest}")
+
+
+def atomic_write_json(path: str, data: dict):
+    """같은 폴더의 임시 파일에 쓴 뒤 os.replace로 바꿔 끼워, 읽는 쪽이 반쯤 쓴 파일을 보지 않게 한다."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (JSONDecodeError, OSError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+@contextmanager
+def file_lock(path: str):
+    """다른 프로세스와 같은 파일을 동시에 고치지 않도록 옆에 둔 .lock 파일을 잠근다."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class UserConfigStore:
+    """사용자별 config.json. 한 번 읽은 설정은 메모리에 두어 재실행·새 세션마다 디스크를 읽지 않는다."""
+
+    def __init__(self, root: str = USER_DATA_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def path(self, user_id: str) -> str:
+        return os.path.join(user_dir(user_id, self.root), "config.json")
+
+    def exists(self, user_id: str) -> bool:
+        return os.path.exists(self.path(user_id))
+
+    def load(self, user_id: str) -> dict:
+        with self._lock:
+            if user_id not in self._cache:
+                self._cache[user_id] = read_json(self.path(user_id))
+            # 세션이 고쳐도 캐시가 바뀌지 않도록 복사본을 준다.
+            return json.loads(json.dumps(self._cache[user_id]))
+
+    def save(self, user_id: str, data: dict):
+        path = self.path(user_id)
+        with self._lock:
+            with file_lock(path):
+                atomic_write_json(path, data)
+            self._cache[user_id] = json.loads(json.dumps(data))
+
+    def reset(self, user_id: str):
+        path = self.path(user_id)
+        with self._lock:
+            with file_lock(path):
+                # 파일을 지우지 않고 비워두어야 예전 공용 config.json을 다시 옮겨오지 않는다.
+                atomic_write_json(path, {})
+            self._cache[user_id] = {}
+
+
+class AccountStore:
+    """로그인 계정. 비밀번호는 PBKDF2 해시로만 저장한다."""
+
+    def __init__(self, path: str = ACCOUNTS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._accounts = read_json(path)
+
+    @staticmethod
+    def _hash(password: str, salt: str) -> str:
+        return hashlib.pbkdf2_hmac(
+            "sha256", password.encode("utf-8"), bytes.fromhex(salt), PASSWORD_ITERATIONS
+        ).hex()
+
+    def exists(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._accounts
+
+    def verify(self, user_id: str, password: str) -> bool:
+        with self._lock:
+            account = self._accounts.get(user_id)
+        if not account:
+            return False
+        return hmac.compare_digest(account["hash"], self._hash(password, account["salt"]))
+
+    def set_password(self, user_id: str, password: str):
+        salt = secrets.token_hex(16)
+        with self._lock:
+            with file_lock(self.path):
+                # 다른 프로세스가 바꾼 계정을 덮어쓰지 않도록 잠근 뒤 다시 읽어서 고친다.
+                self._accounts = read_json(self.path)
+                self._accounts[user_id] = {"salt": salt, "hash": self._hash(password, salt)}
+                atomic_write_json(self.path, self._accounts)
+
+    def ensure(self, user_id: str, password: str):
+        """계정이 없을 때만 만든다. 환경변수나 예전 config.json의 계정을 옮겨올 때 쓴다."""
+        if user_id and password and not self.exists(user_id):
+            self.set_password(user_id, password)
+
+
+def migrate_legacy_config(configs: UserConfigStore, legacy_path: str = LEGACY_CONFIG_PATH,
+                          owner: str = None, accounts: AccountStore = None):
+    """예전 공용 config.json을 한 사용자의 설정으로 옮긴다. 프로세스가 뜰 때 한 번 부른다.
+
+    주인은 파일에 저장된 login_id, 없으면 owner다. 평문 login_id/login_pw는 accounts로 옮긴 뒤
+    파일에서 지운다. 이미 그 사용자의 설정 파일이 있으면 설정은 다시 옮기지 않는다.
+    """
+    with file_lock(legacy_path):
+        data = read_json(legacy_path)
+        if not data:
+            return
+        login_id, login_pw = data.get("login_id"), data.get("login_pw")
+        if isinstance(login_id, str) and login_id:
+            owner = login_id
+        settings = {k: v for k, v in data.items() if k not in CREDENTIAL_KEYS}
+        if owner and not configs.exists(owner):
+            configs.save(owner, settings)
+        if accounts is not None and isinstance(login_id, str) and isinstance(login_pw, str):
+            accounts.ensure(login_id, login_pw)
+        if len(settings) != len(data):
+            atomic_write_json(legacy_path, settings)